@@ -0,0 +1,76 @@
+# Итоговые счетчики для админ-панели (таблица totals). Ведутся триггерами,
+# поэтому учитываются любые записи, в том числе пакетные из журнала
+# сообщений. recount/check сверяют их с исходными таблицами.
+
+# Счетчик -> запрос, которым он считается по исходным таблицам
+TOTALS = {
+    'users': 'SELECT COUNT(*) FROM users',
+    'messages': 'SELECT COUNT(*) FROM messages',
+    'chats': 'SELECT COUNT(*) FROM chats',
+    'banned': 'SELECT COUNT(*) FROM ratings WHERE banned = 1',
+    'blacklist': 'SELECT COUNT(*) FROM blacklist',
+}
+
+def create_triggers(cursor):
+    """Триггеры, поддерживающие счетчики при вставке и удалении строк"""
+    for name, table in (
+        ('users', 'users'),
+        ('messages', 'messages'),
+        ('chats', 'chats'),
+        ('blacklist', 'blacklist'),
+    ):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS totals_{table}_insert AFTER INSERT ON {table} BEGIN
+                UPDATE totals SET value = value + 1 WHERE name = '{name}';
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS totals_{table}_delete AFTER DELETE ON {table} BEGIN
+                UPDATE totals SET value = value - 1 WHERE name = '{name}';
+            END
+        ''')
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS totals_ratings_insert AFTER INSERT ON ratings
+        WHEN NEW.banned = 1 BEGIN
+            UPDATE totals SET value = value + 1 WHERE name = 'banned';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS totals_ratings_delete AFTER DELETE ON ratings
+        WHEN OLD.banned = 1 BEGIN
+            UPDATE totals SET value = value - 1 WHERE name = 'banned';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS totals_ratings_ban AFTER UPDATE OF banned ON ratings
+        WHEN (NEW.banned = 1) != (OLD.banned = 1) BEGIN
+            UPDATE totals SET value = value + (CASE WHEN NEW.banned = 1 THEN 1 ELSE -1 END)
+            WHERE name = 'banned';
+        END
+    ''')
+
+def read(cursor) -> dict:
+    cursor.execute('SELECT name, value FROM totals')
+    return {name: value for name, value in cursor.fetchall()}
+
+def check(cursor) -> dict:
+    """Сверяет счетчики с исходными таблицами.
+    
+    Возвращает расхождения в виде {счетчик: (сохранено, на самом деле)}.
+    """
+    stored = read(cursor)
+    mismatches = {}
+    for name, query in TOTALS.items():
+        actual = cursor.execute(query).fetchone()[0]
+        if stored.get(name) != actual:
+            mismatches[name] = (stored.get(name), actual)
+    return mismatches
+
+def recount(cursor, names=None):
+    """Пересчитывает счетчики (все или указанные) по исходным таблицам"""
+    for name in names or TOTALS:
+        cursor.execute(f'''
+            INSERT INTO totals (name, value) VALUES (?, ({TOTALS[name]}))
+            ON CONFLICT(name) DO UPDATE SET value = excluded.value
+        ''', (name,))
@@ -0,0 +1,183 @@
+# Архив сообщений: сообщения старше срока хранения переносятся пачками в
+# помесячные файлы БД рядом с основной (tyumenchat-archive-2024-05.db).
+# Таблица messages остается маленькой, а архивы подключаются через ATTACH
+# для поиска в админке. Место после удаления возвращается
+# PRAGMA incremental_vacuum без блокирующего VACUUM.
+import os
+import json
+
+# Сколько дней сообщения лежат в основной таблице (0 - не архивировать)
+DEFAULT_RETENTION_DAYS = 90
+
+# Сообщений за одну транзакцию переноса
+ARCHIVE_BATCH_SIZE = 2000
+
+# Пачек за один проход (остальное перенесется в следующий)
+ARCHIVE_MAX_BATCHES = 50
+
+# Сколько свободных страниц возвращать ОС за проход
+ARCHIVE_VACUUM_PAGES = 5000
+
+# Как часто запускать архивацию (сек)
+ARCHIVE_INTERVAL = 600
+
+# Имя, под которым архив подключается к соединению
+SCHEMA = 'archive'
+
+# PRAGMA auto_vacuum, при котором работает incremental_vacuum
+INCREMENTAL = 2
+
+COLUMNS = 'id, chat_id, from_user, to_user, from_nick, to_nick, message_text, message_type, file_id, timestamp'
+
+def archive_path(db_name: str, month: str) -> str:
+    """Файл архива месяца YYYY-MM рядом с основной БД"""
+    root, ext = os.path.splitext(db_name)
+    return f"{root}-archive-{month}{ext or '.db'}"
+
+def next_month(month: str) -> str:
+    """'2024-12' -> '2025-01-01' (граница для сравнения с timestamp)"""
+    year, mon = map(int, month.split('-'))
+    return f"{year + mon // 12:04d}-{mon % 12 + 1:02d}-01"
+
+def attach(conn, path: str, create: bool = False, fts: bool = False) -> bool:
+    """Подключает файл архива как SCHEMA. Без create несуществующий файл пропускается"""
+    if not create and not os.path.exists(path):
+        return False
+    conn.execute(f'ATTACH DATABASE ? AS {SCHEMA}', (path,))
+    if create:
+        _create_schema(conn, fts)
+    return True
+
+def detach(conn):
+    # DETACH невозможен внутри транзакции
+    if conn.in_transaction:
+        conn.rollback()
+    # ATTACH мог и не пройти, а соединение вернется в пул
+    if any(row[1] == SCHEMA for row in conn.execute('PRAGMA database_list')):
+        conn.execute(f'DETACH DATABASE {SCHEMA}')
+
+def _create_schema(conn, fts: bool):
+    # id сохраняется из основной таблицы, поэтому без AUTOINCREMENT
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {SCHEMA}.messages (
+            id INTEGER PRIMARY KEY,
+            chat_id TEXT NOT NULL,
+            from_user INTEGER NOT NULL,
+            to_user INTEGER NOT NULL,
+            from_nick TEXT NOT NULL,
+            to_nick TEXT NOT NULL,
+            message_text TEXT,
+            message_type TEXT DEFAULT 'text',
+            file_id TEXT,
+            timestamp TIMESTAMP
+        )
+    ''')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {SCHEMA}.idx_messages_timestamp ON messages (timestamp)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {SCHEMA}.idx_messages_chat ON messages (chat_id)')
+    if not fts:
+        return
+    # Тот же индекс, что и в основной БД; архив только пополняется
+    conn.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {SCHEMA}.messages_fts USING fts5(
+            message_text,
+            content='messages',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {SCHEMA}.messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message_text) VALUES (new.id, new.message_text);
+        END
+    ''')
+
+def has_fts(conn) -> bool:
+    """Есть ли полнотекстовый индекс в подключенном архиве"""
+    return conn.execute(
+        f"SELECT 1 FROM {SCHEMA}.sqlite_master WHERE name = 'messages_fts'"
+    ).fetchone() is not None
+
+def move_batch(conn, db_name: str, cutoff: str, batch_size: int, fts: bool = False) -> int:
+    """Переносит до batch_size самых старых сообщений раньше cutoff в архив их месяца.
+    
+    Возвращает число перенесенных сообщений (0 - переносить нечего).
+    В WAL транзакция над несколькими файлами атомарна только для каждого
+    файла по отдельности, поэтому сначала сообщения копируются (повтор
+    безопасен благодаря OR IGNORE), а потом из основной таблицы удаляются
+    только те, что уже лежат в архиве: при сбое между шагами ничего не
+    теряется и не удваивается.
+    """
+    row = conn.execute('''
+        SELECT timestamp FROM messages WHERE timestamp < ?
+        ORDER BY timestamp LIMIT 1
+    ''', (cutoff,)).fetchone()
+    if row is None:
+        return 0
+    month = row[0][:7]
+    # Пачка не выходит за месяц самого старого сообщения
+    upper = min(cutoff, next_month(month))
+    ids = json.dumps([r[0] for r in conn.execute('''
+        SELECT id FROM messages WHERE timestamp < ?
+        ORDER BY timestamp LIMIT ?
+    ''', (upper, batch_size))])
+    
+    try:
+        attach(conn, archive_path(db_name, month), create=True, fts=fts)
+        conn.execute(f'''
+            INSERT OR IGNORE INTO {SCHEMA}.messages ({COLUMNS})
+            SELECT {COLUMNS} FROM main.messages
+            WHERE id IN (SELECT value FROM json_each(?))
+        ''', (ids,))
+        conn.commit()
+        
+        # Триггеры основной БД поправят totals и полнотекстовый индекс
+        moved = conn.execute(f'''
+            DELETE FROM main.messages
+            WHERE id IN (SELECT id FROM {SCHEMA}.messages WHERE id IN (SELECT value FROM json_each(?)))
+        ''', (ids,)).rowcount
+        conn.execute('''
+            INSERT INTO message_archives (month, messages) VALUES (?, ?)
+            ON CONFLICT(month) DO UPDATE SET
+                messages = messages + excluded.messages,
+                updated_at = CURRENT_TIMESTAMP
+        ''', (month, moved))
+        conn.commit()
+    finally:
+        detach(conn)
+    return moved
+
+def reclaim(conn, pages: int) -> int:
+    """Возвращает ОС до pages свободных страниц, возвращает сколько вернул.
+    
+    Пока БД не переведена в auto_vacuum = INCREMENTAL
+    (Database.enable_incremental_vacuum), ничего не делает.
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != INCREMENTAL:
+        return 0
+    before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    # execute выполняет прагму на один шаг (одну страницу),
+    # executescript - до конца
+    conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+    return before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+def months(cursor) -> list:
+    """Месяцы, у которых есть архив, от новых к старым"""
+    cursor.execute('SELECT month FROM message_archives ORDER BY month DESC')
+    return [row[0] for row in cursor.fetchall()]
+
+def archived_count(cursor) -> int:
+    cursor.execute('SELECT COALESCE(SUM(messages), 0) FROM message_archives')
+    return cursor.fetchone()[0]
+
+def count_by_day(conn, path: str) -> list:
+    """[(день, сообщений)] из файла архива - для пересчета дневной статистики"""
+    if not attach(conn, path):
+        return []
+    try:
+        return conn.execute(f'''
+            SELECT DATE(timestamp), COUNT(*) FROM {SCHEMA}.messages
+            WHERE timestamp IS NOT NULL
+            GROUP BY 1
+        ''').fetchall()
+    finally:
+        detach(conn)
@@ -0,0 +1,78 @@
+"""Маршрутизация нажатий на кнопки: нажатий в секунду на одно ядро.
+
+Сначала измеряется только поиск обработчика в таблицах user_callbacks
+и admin_callbacks (строки и CallbackData вперемешку, как в работе), затем
+полный путь нажатия через dp.feed_update с Bot API, подмененным сессией,
+которая отвечает сразу.
+
+Запуск: python bench_callbacks.py (нужен config.py; БД создается во
+временном каталоге). Параметры - переменные окружения RESOLVES, CALLBACKS.
+"""
+import os
+import time
+import asyncio
+import logging
+import tempfile
+
+RESOLVES = int(os.getenv("RESOLVES", 200000))
+CALLBACKS = int(os.getenv("CALLBACKS", 3000))
+USER_ID = 1000
+
+async def run():
+    import bot as app
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Update
+    from callbacks import RateCallback, BlacklistCallback, DistrictCallback
+    
+    class FakeSession(BaseSession):
+        async def make_request(self, bot, method, timeout=None):
+            return True
+        
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+        
+        async def close(self):
+            pass
+    
+    app.bot.session = FakeSession()
+    await app.db.add_user(USER_ID, f"u{USER_ID}")
+    
+    datas = ["menu", "settings", "admin_logs", "top_rating", "toggle_anon", "cancel",
+             RateCallback(target=5, chat=7, like=True).pack(),
+             BlacklistCallback(action="remove", user_id=9).pack(),
+             DistrictCallback(index=1).pack(), "unknown_button"]
+    datas = (datas * (RESOLVES // len(datas) + 1))[:RESOLVES]
+    start = time.perf_counter()
+    for data in datas:
+        app.admin_callbacks.resolve(data) or app.user_callbacks.resolve(data)
+    resolve_rate = len(datas) / (time.perf_counter() - start)
+    
+    def callback_update(update_id: int, data: str) -> Update:
+        return Update.model_validate({"update_id": update_id, "callback_query": {
+            "id": str(update_id), "chat_instance": "bench", "data": data,
+            "from": {"id": USER_ID, "is_bot": False, "first_name": "Test"},
+            "message": {"message_id": 1, "date": 1, "chat": {"id": USER_ID, "type": "private"}, "text": "меню"},
+        }}, context={"bot": app.bot})
+    
+    updates = [callback_update(n, "change_nick") for n in range(1, CALLBACKS + 1)]
+    try:
+        start = time.perf_counter()
+        for update in updates:
+            await app.dp.feed_update(app.bot, update)
+        feed_rate = len(updates) / (time.perf_counter() - start)
+    finally:
+        await app.db.close()
+    
+    print(f"Поиск обработчика: {resolve_rate:,.0f} нажатий/с")
+    print(f"Полный путь через dp.feed_update: {feed_rate:,.0f} нажатий/с")
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="bench_callbacks_")
+    # Рабочая БД из config не используется: путь подменяется до импорта database
+    import config
+    config.DB_NAME = os.path.join(workdir, "bench.db")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
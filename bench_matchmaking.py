@@ -0,0 +1,70 @@
+"""Скорость подбора пары при большой очереди поиска.
+
+В очереди WAITING пользователей по всем районам; каждый десятый
+забанен, треть очереди в черном списке у одного пользователя.
+Выводится число поисков в секунду (match_or_enqueue: половина по
+всей Тюмени, половина в своем районе) и время отмены поиска - для
+очереди в памяти и для общей очереди в SQLite (STATE_BACKEND=sqlite).
+
+Запуск: python bench_matchmaking.py (нужен config.py; файл общего
+состояния создается во временном каталоге). Параметры - переменные
+окружения WAITING, SEARCHES.
+"""
+import os
+import time
+import tempfile
+from config import TYUMEN_DISTRICTS
+from moderation import ModerationIndex
+from sessions import SessionRegistry
+from state_backend import connect, SqliteSessionRegistry
+
+WAITING = int(os.getenv("WAITING", 10000))
+SEARCHES = int(os.getenv("SEARCHES", 5000))
+# Пользователь, у которого в черном списке треть очереди
+PICKY_USER = WAITING + SEARCHES + 1
+
+def moderation() -> ModerationIndex:
+    index = ModerationIndex()
+    index.load(range(0, WAITING, 10), [(PICKY_USER, uid) for uid in range(0, WAITING, 3)])
+    return index
+
+def district(user_id: int) -> str:
+    return TYUMEN_DISTRICTS[user_id % len(TYUMEN_DISTRICTS)]
+
+def run(queue, searches: int) -> dict:
+    queue.moderation = moderation()
+    for user_id in range(WAITING):
+        queue.enqueue(user_id, district(user_id))
+    
+    start = time.perf_counter()
+    matched = 0
+    for user_id in range(WAITING, WAITING + searches):
+        if queue.match_or_enqueue(user_id, district(user_id), same_district=bool(user_id % 2)) is not None:
+            matched += 1
+    search_rate = searches / (time.perf_counter() - start)
+    
+    # Треть очереди у него в черном списке, эти кандидаты пропускаются
+    start = time.perf_counter()
+    queue.match_or_enqueue(PICKY_USER, district(PICKY_USER))
+    picky = (time.perf_counter() - start) * 1000
+    
+    waiting = list(queue)[:searches]
+    start = time.perf_counter()
+    for user_id in waiting:
+        queue.cancel(user_id)
+    cancel = (time.perf_counter() - start) / len(waiting) * 1e6
+    return {'поисков/с': search_rate, 'совпало': matched, 'привередливый, мс': picky, 'отмена, мкс': cancel}
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="bench_matchmaking_")
+    results = {
+        'память': run(SessionRegistry().queue, SEARCHES),
+        'SQLite': run(SqliteSessionRegistry(connect(os.path.join(workdir, 'state.db'))).queue, SEARCHES // 10),
+    }
+    print(f"Очередь: {WAITING} ожидающих, {len(TYUMEN_DISTRICTS)} районов")
+    print(f"{'':<20}" + ''.join(f"{name:>12}" for name in results))
+    for metric in next(iter(results.values())):
+        print(f"{metric:<20}" + ''.join(f"{values[metric]:>12.1f}" for values in results.values()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Задержка вызовов Database с пулом соединений и без него.
+
+Одни и те же чтения (get_user, get_blacklist) и запись (save_message)
+выполняются с pool_size=0 (новое соединение на каждый вызов, как было)
+и с пулом долгоживущих соединений; выводится время одного вызова.
+Кеш профилей отключен, чтобы каждый get_user доходил до SQLite.
+
+Запуск: python bench_pool.py (нужен config.py; БД создается во
+временном каталоге). Параметры - переменные окружения CALLS, POOL_SIZE.
+"""
+import os
+import time
+import tempfile
+from database import Database
+
+CALLS = int(os.getenv("CALLS", 3000))
+POOL_SIZE = int(os.getenv("POOL_SIZE", 4))
+
+def per_call(func, calls: int) -> float:
+    """Среднее время одного вызова (мкс)"""
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - start) / calls * 1e6
+
+def run(path: str, pool_size: int) -> dict:
+    db = Database(path, pool_size=pool_size, message_batch_size=1, profile_cache_size=0)
+    try:
+        db.add_user(1, 'u1')
+        db.add_user(2, 'u2')
+        db.create_chat('c1', 1, 2, 'u1', 'u2')
+        return {
+            'get_user': per_call(lambda: db.get_user(1), CALLS),
+            'get_blacklist': per_call(lambda: db.get_blacklist(1), CALLS),
+            'save_message': per_call(lambda: db.save_message('c1', 1, 2, 'u1', 'u2', 'привет'), CALLS // 5),
+        }
+    finally:
+        db.close()
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="bench_pool_")
+    results = {
+        'без пула': run(os.path.join(workdir, 'nopool.db'), 0),
+        f'пул из {POOL_SIZE}': run(os.path.join(workdir, 'pool.db'), POOL_SIZE),
+    }
+    print(f"{'мкс/вызов':<14}" + ''.join(f"{name:>16}" for name in results))
+    for method in next(iter(results.values())):
+        print(f"{method:<14}" + ''.join(f"{timings[method]:>16.1f}" for timings in results.values()))
+
+if __name__ == "__main__":
+    main()
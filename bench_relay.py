@@ -0,0 +1,101 @@
+"""Пересылка сообщений в активном чате: сообщений в секунду на одно ядро.
+
+Бот работает в одном процессе, Bot API подменен сессией, которая
+отвечает сразу, поэтому измеряется только обработка апдейта ботом:
+PAIRS пар в активных чатах, от каждого участника MSGS текстовых
+сообщений через dp.feed_update. Прогон повторяется со сбросом профиля
+отправителя перед каждым сообщением - так контекст пересылки строится
+заново из БД, как без кеша контекстов.
+
+Запуск: python bench_relay.py (нужен config.py; БД создается во
+временном каталоге). Параметры - переменные окружения PAIRS, MSGS.
+"""
+import os
+import time
+import asyncio
+import logging
+import datetime
+import tempfile
+
+PAIRS = int(os.getenv("PAIRS", 50))
+MSGS = int(os.getenv("MSGS", 100))
+FIRST_USER_ID = 1000
+
+def users() -> list:
+    return list(range(FIRST_USER_ID, FIRST_USER_ID + PAIRS * 2))
+
+async def run():
+    import bot as app
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Update, Message, Chat, User
+    
+    sent = []
+    
+    class FakeSession(BaseSession):
+        async def make_request(self, bot, method, timeout=None):
+            sent.append(type(method).__name__)
+            return True
+        
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+        
+        async def close(self):
+            pass
+    
+    app.bot.session = FakeSession()
+    
+    ids = users()
+    for user_id in ids:
+        await app.db.add_user(user_id, f"u{user_id}")
+    for user1_id, user2_id in zip(ids[::2], ids[1::2]):
+        chat_uuid = f"{user1_id}_{user2_id}"
+        await app.db.create_chat(chat_uuid, user1_id, user2_id, f"u{user1_id}", f"u{user2_id}")
+        await app.sessions.start(user1_id, user2_id, chat_uuid)
+    
+    update_id = 0
+    
+    def text_update(user_id: int, text: str) -> Update:
+        nonlocal update_id
+        update_id += 1
+        user = User(id=user_id, is_bot=False, first_name='Test')
+        return Update(update_id=update_id, message=Message(
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=Chat(id=user_id, type='private'),
+            from_user=user,
+            text=text,
+        ))
+    
+    async def relay_all(reset_profiles: bool) -> float:
+        updates = [text_update(user_id, f"сообщение {n}") for n in range(MSGS) for user_id in ids]
+        sent.clear()
+        start = time.perf_counter()
+        for update in updates:
+            if reset_profiles:
+                app.db.profiles.invalidate(update.message.from_user.id)
+            await app.dp.feed_update(app.bot, update)
+        elapsed = time.perf_counter() - start
+        assert sent.count('SendMessage') == len(updates), sent[:5]
+        return len(updates) / elapsed
+    
+    try:
+        # Прогрев: контексты строятся при первом сообщении каждого участника
+        await relay_all(False)
+        cached = await relay_all(False)
+        rebuilt = await relay_all(True)
+        print(f"Пар: {PAIRS}, сообщений от участника: {MSGS}")
+        print(f"С контекстом пересылки: {cached:,.0f} сообщений/с")
+        print(f"Контекст из БД на каждое сообщение: {rebuilt:,.0f} сообщений/с")
+    finally:
+        await app.db.close()
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="bench_relay_")
+    # Рабочая БД из config не используется: путь подменяется до импорта database
+    import config
+    config.DB_NAME = os.path.join(workdir, "bench.db")
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
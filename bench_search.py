@@ -0,0 +1,94 @@
+"""Поиск сообщений в админке: FTS5 против LIKE на большой истории.
+
+Создает БД с MESSAGES синтетическими сообщениями (полнотекстовый
+индекс заполняется триггерами, как при обычной записи) и выполняет
+search_messages для редкого слова, частого префикса и фразы - через
+FTS5 и через прежний LIKE '%...%' (has_fts = False).
+
+Запуск: python bench_search.py (нужен config.py; БД создается во
+временном каталоге, на 2 млн сообщений - около минуты подготовки).
+Параметры - переменные окружения MESSAGES, REPEAT.
+"""
+import os
+import time
+import random
+import tempfile
+from database import Database
+
+MESSAGES = int(os.getenv("MESSAGES", 2000000))
+REPEAT = int(os.getenv("REPEAT", 5))
+CHATS = 1000
+
+WORDS = ("привет как дела что делаешь тюмень набережная мост влюбленных погода сегодня "
+         "холодно вечером пойдем гулять кино учеба работа нефтяник сибирь фонтан парк "
+         "студент завтра вчера отлично нормально скучно весело музыка футбол").split()
+# Встречается примерно в одном сообщении из ста тысяч
+RARE_WORD = "гилево"
+
+QUERIES = {
+    'редкое слово': RARE_WORD,
+    'частый префикс': 'набереж',
+    'фраза': '"как дела"',
+}
+
+def fill(db: Database):
+    conn = db.get_connection()
+    try:
+        conn.executemany(
+            "INSERT INTO chats (chat_id, user1_id, user2_id, user1_nick, user2_nick) VALUES (?, 1, 2, 'u1', 'u2')",
+            [(f'c{n}',) for n in range(CHATS)]
+        )
+        rng = random.Random(1)
+        batch = []
+        for n in range(MESSAGES):
+            text = ' '.join(rng.choices(WORDS, k=rng.randint(3, 10)))
+            if n % 100000 == 0:
+                text += f' {RARE_WORD}'
+            batch.append((f'c{n % CHATS}', text))
+            if len(batch) == 50000:
+                conn.executemany(
+                    "INSERT INTO messages (chat_id, from_user, to_user, from_nick, to_nick, message_text) "
+                    "VALUES (?, 1, 2, 'u1', 'u2', ?)", batch
+                )
+                conn.commit()
+                batch.clear()
+        if batch:
+            conn.executemany(
+                "INSERT INTO messages (chat_id, from_user, to_user, from_nick, to_nick, message_text) "
+                "VALUES (?, 1, 2, 'u1', 'u2', ?)", batch
+            )
+            conn.commit()
+        conn.execute("ANALYZE")
+    finally:
+        conn.close()
+
+def timed(db: Database, text: str) -> tuple:
+    """Среднее время поиска (мс) и число найденных (не больше 50)"""
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        found = db.search_messages(text)
+    return (time.perf_counter() - start) / REPEAT * 1000, len(found)
+
+def main():
+    path = os.path.join(tempfile.mkdtemp(prefix="bench_search_"), 'search.db')
+    db = Database(path, message_batch_size=1, message_retention_days=0)
+    try:
+        if not db.has_fts:
+            print("SQLite собран без FTS5 - сравнивать не с чем")
+            return
+        start = time.perf_counter()
+        fill(db)
+        print(f"Сообщений: {MESSAGES}, подготовка {time.perf_counter() - start:.0f} с")
+        
+        print(f"{'':<16}{'FTS5, мс':>12}{'LIKE, мс':>12}{'найдено':>10}")
+        for name, text in QUERIES.items():
+            fts, found = timed(db, text)
+            db.has_fts = False
+            like, _ = timed(db, text.strip('"'))
+            db.has_fts = True
+            print(f"{name:<16}{fts:>12.1f}{like:>12.1f}{found:>10}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
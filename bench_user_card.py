@@ -0,0 +1,112 @@
+"""Время открытия карточки пользователя в админке.
+
+В БД MESSAGES сообщений и CHATS чатов; у одного пользователя HEAVY_SHARE
+всех сообщений, четверть чатов и несколько сотен записей в черных списках.
+Сравнивается get_user_details (один запрос, счетчики из users) с прежней
+карточкой: COUNT(*) по chats и messages, два COUNT(*) по blacklist и
+последние чаты через OR - для тяжелого и для обычного пользователя.
+
+Запуск: python bench_user_card.py (нужен config.py; БД создается во
+временном каталоге). Параметры - переменные окружения MESSAGES, CHATS, REPEAT.
+"""
+import os
+import time
+import random
+import tempfile
+from database import Database
+
+MESSAGES = int(os.getenv("MESSAGES", 1000000))
+CHATS = int(os.getenv("CHATS", 20000))
+REPEAT = int(os.getenv("REPEAT", 50))
+USERS = 2000
+HEAVY_SHARE = 0.15
+HEAVY_USER = 1
+ORDINARY_USER = 77
+
+# Запросы карточки до перехода на счетчики в users
+OLD_CARD_QUERIES = (
+    ("SELECT u.*, r.likes, r.dislikes, r.rating, r.banned, r.ban_date, r.ban_reason "
+     "FROM users u LEFT JOIN ratings r ON u.user_id = r.user_id WHERE u.user_id = :uid"),
+    "SELECT COUNT(*) FROM chats WHERE user1_id = :uid OR user2_id = :uid",
+    "SELECT COUNT(*) FROM messages WHERE from_user = :uid",
+    "SELECT COUNT(*) FROM blacklist WHERE user_id = :uid",
+    "SELECT COUNT(*) FROM blacklist WHERE blocked_id = :uid",
+    ("SELECT chat_id, start_time, message_count FROM chats "
+     "WHERE user1_id = :uid OR user2_id = :uid ORDER BY start_time DESC LIMIT 5"),
+    ("SELECT b.blocked_id, u.nickname, u.district, r.rating FROM blacklist b "
+     "JOIN users u ON b.blocked_id = u.user_id LEFT JOIN ratings r ON b.blocked_id = r.user_id "
+     "WHERE b.user_id = :uid"),
+)
+
+def fill(db: Database):
+    rng = random.Random(1)
+    for user_id in range(1, USERS + 1):
+        db.add_user(user_id, f'u{user_id}')
+    
+    chats = []
+    for n in range(CHATS):
+        first = HEAVY_USER if n < CHATS // 4 else rng.randint(2, USERS)
+        second = rng.randint(2, USERS)
+        if rng.random() < 0.5:
+            first, second = second, first
+        chats.append((f'c{n}', first, second, f'u{first}', f'u{second}', rng.randint(0, 10 ** 6)))
+    heavy_messages = int(MESSAGES * HEAVY_SHARE)
+    
+    conn = db.get_connection()
+    try:
+        conn.executemany('''
+            INSERT INTO chats (chat_id, user1_id, user2_id, user1_nick, user2_nick, start_time)
+            VALUES (?, ?, ?, ?, ?, datetime('now', '-' || ? || ' seconds'))
+        ''', chats)
+        conn.executemany('''
+            INSERT INTO messages (chat_id, from_user, to_user, from_nick, to_nick, message_text)
+            VALUES ('c0', ?, 2, 'a', 'b', 'привет')
+        ''', ((HEAVY_USER if n < heavy_messages else rng.randint(2, USERS),) for n in range(MESSAGES)))
+        conn.executemany(
+            "INSERT OR IGNORE INTO blacklist (user_id, blocked_id) VALUES (?, ?)",
+            [(HEAVY_USER, uid) for uid in range(2, 40)] + [(uid, HEAVY_USER) for uid in range(2, 300)]
+        )
+        # Счетчики, которые в работе ведет журнал сообщений и create_chat
+        conn.execute('''
+            UPDATE users SET
+                total_chats = (SELECT COUNT(*) FROM chats WHERE user1_id = users.user_id)
+                            + (SELECT COUNT(*) FROM chats WHERE user2_id = users.user_id),
+                total_messages = (SELECT COUNT(*) FROM messages WHERE from_user = users.user_id)
+        ''')
+        conn.commit()
+        conn.execute("ANALYZE")
+    finally:
+        conn.close()
+    db.profiles.clear()
+
+def old_card(db: Database, user_id: int):
+    conn = db.get_connection()
+    try:
+        for sql in OLD_CARD_QUERIES:
+            conn.execute(sql, {'uid': user_id}).fetchall()
+    finally:
+        conn.close()
+
+def per_call(func) -> float:
+    """Среднее время одного вызова (мс)"""
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        func()
+    return (time.perf_counter() - start) / REPEAT * 1000
+
+def main():
+    path = os.path.join(tempfile.mkdtemp(prefix="bench_user_card_"), 'card.db')
+    db = Database(path, message_batch_size=1, message_retention_days=0)
+    try:
+        fill(db)
+        print(f"Сообщений: {MESSAGES}, чатов: {CHATS}")
+        print(f"{'мс/карточка':<14}{'было':>10}{'стало':>10}")
+        for name, user_id in (('тяжелый', HEAVY_USER), ('обычный', ORDINARY_USER)):
+            old = per_call(lambda: old_card(db, user_id))
+            new = per_call(lambda: db.get_user_details(user_id))
+            print(f"{name:<14}{old:>10.2f}{new:>10.2f}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
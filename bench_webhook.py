@@ -0,0 +1,165 @@
+"""Нагрузочный прогон webhook-режима на фейковом Telegram.
+
+Бот запускается как при WEBHOOK_URL, но Bot API подменен локальным
+aiohttp-сервером, который отвечает с задержкой API_DELAY. Отдельный
+процесс заводит PAIRS пар в активных чатах и шлет от каждого участника
+MSGS текстовых сообщений в webhook, а затем выводит пропускную
+способность (апдейтов/с), задержку пересылки собеседнику и соблюдение
+порядка сообщений каждого отправителя.
+
+Запуск: python bench_webhook.py (нужен config.py; БД и файл общего
+состояния создаются во временном каталоге, рабочая БД не трогается).
+Параметры - переменные окружения PAIRS, MSGS, API_DELAY, CONCURRENCY.
+"""
+import os
+import time
+import signal
+import asyncio
+import logging
+import tempfile
+import multiprocessing
+
+PAIRS = int(os.getenv("PAIRS", 200))
+MSGS = int(os.getenv("MSGS", 20))
+API_DELAY = float(os.getenv("API_DELAY", 0.02))     # задержка ответа фейкового Bot API (сек)
+CONCURRENCY = int(os.getenv("CONCURRENCY", 64))
+WEBHOOK_PORT = 18080
+API_PORT = 18081
+FIRST_USER_ID = 1000
+
+def users() -> list:
+    return list(range(FIRST_USER_ID, FIRST_USER_ID + PAIRS * 2))
+
+# ========== ФЕЙКОВЫЙ TELEGRAM (отдельный процесс) ==========
+async def run_client(ready, bot_pid: int):
+    from aiohttp import web, ClientSession, TCPConnector
+    
+    expected = PAIRS * 2 * MSGS
+    sent_at = {}
+    received = []
+    done = asyncio.Event()
+    
+    async def fake_api(request):
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        await asyncio.sleep(API_DELAY)
+        if method != 'sendMessage':
+            return web.json_response({"ok": True, "result": True})
+        text = data.get('text', '')
+        received.append((time.perf_counter(), text.rsplit(' ', 1)[-1]))
+        if len(received) >= expected:
+            done.set()
+        chat = {"id": int(data['chat_id']), "type": "private"}
+        return web.json_response({"ok": True, "result": {
+            "message_id": 1, "date": int(time.time()), "chat": chat, "text": text,
+        }})
+    
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', fake_api)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', API_PORT).start()
+    ready.set()
+    
+    # Ждем, пока бот поднимет webhook
+    webhook = f"http://127.0.0.1:{WEBHOOK_PORT}/webhook"
+    async with ClientSession(connector=TCPConnector(limit=100)) as session:
+        while True:
+            try:
+                async with session.get(webhook):
+                    break
+            except OSError:
+                await asyncio.sleep(0.1)
+        
+        update_id = 0
+        
+        async def user_stream(user_id: int):
+            nonlocal update_id
+            for n in range(MSGS):
+                update_id += 1
+                marker = f"{user_id}:{n}"
+                update = {"update_id": update_id, "message": {
+                    "message_id": n + 1,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+                    "text": f"hi {marker}",
+                }}
+                sent_at[marker] = time.perf_counter()
+                async with session.post(webhook, json=update) as response:
+                    assert response.status == 200, response.status
+        
+        start = time.perf_counter()
+        await asyncio.gather(*(user_stream(user_id) for user_id in users()))
+        posted = time.perf_counter() - start
+        await asyncio.wait_for(done.wait(), 120)
+        total = time.perf_counter() - start
+    
+    latency = sorted((at - sent_at[marker]) * 1000 for at, marker in received)
+    last = {}
+    ordered = True
+    for _, marker in received:
+        user_id, n = map(int, marker.split(':'))
+        if last.get(user_id, -1) > n:
+            ordered = False
+        last[user_id] = n
+    
+    print(f"Апдейтов: {expected}, задержка API {API_DELAY * 1000:.0f} мс")
+    print(f"Отправка в webhook: {posted:.2f} с, всего: {total:.2f} с, {expected / total:.0f} апдейтов/с")
+    print(f"Задержка пересылки, мс: p50={latency[len(latency) // 2]:.1f} "
+          f"p95={latency[int(len(latency) * 0.95)]:.1f} max={latency[-1]:.1f}")
+    print(f"Порядок сообщений каждого отправителя сохранен: {'да' if ordered else 'НЕТ'}")
+    await runner.cleanup()
+    # Бот останавливается так же, как по SIGTERM в работе
+    os.kill(bot_pid, signal.SIGTERM)
+
+def client_process(ready, bot_pid: int):
+    asyncio.run(run_client(ready, bot_pid))
+
+# ========== БОТ ==========
+async def run_bot():
+    import bot as app
+    from aiogram.client.telegram import TelegramAPIServer
+    
+    app.bot.session.api = TelegramAPIServer.from_base(f"http://127.0.0.1:{API_PORT}")
+    app.update_queue.concurrency = CONCURRENCY
+    app.update_queue._slots = asyncio.Semaphore(CONCURRENCY)
+    app.update_queue.max_pending = MSGS
+    
+    ids = users()
+    for user_id in ids:
+        await app.db.add_user(user_id, f"u{user_id}")
+    for user1_id, user2_id in zip(ids[::2], ids[1::2]):
+        chat_uuid = f"{user1_id}_{user2_id}"
+        await app.db.create_chat(chat_uuid, user1_id, user2_id, f"u{user1_id}", f"u{user2_id}")
+        await app.sessions.start(user1_id, user2_id, chat_uuid)
+    
+    try:
+        await app.run_webhook(app.dp, app.bot, f"http://127.0.0.1:{WEBHOOK_PORT}", "/webhook",
+                              None, "127.0.0.1", WEBHOOK_PORT)
+    finally:
+        print(f"Очередь апдейтов: {app.update_queue.stats()}")
+        await app.db.close()
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="bench_webhook_")
+    # Рабочая БД из config не используется: путь подменяется до импорта database
+    import config
+    config.DB_NAME = os.path.join(workdir, "bench.db")
+    os.environ["STATE_DB"] = os.path.join(workdir, "bench_state.db")
+    logging.basicConfig(level=logging.WARNING)
+    
+    ready = multiprocessing.Event()
+    client = multiprocessing.Process(target=client_process, args=(ready, os.getpid()))
+    client.start()
+    ready.wait()
+    try:
+        asyncio.run(run_bot())
+    finally:
+        client.join()
+
+if __name__ == "__main__":
+    main()
@@ -2,21 +2,38 @@ import asyncio
 import logging
 import datetime
 import os
-import shutil
 import random
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.state import State, StatesGroup
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.utils.callback_answer import CallbackAnswer, CallbackAnswerMiddleware
 
 from config import BOT_TOKEN, ADMIN_IDS, TYUMEN_DISTRICTS, DEBUG
-from database import Database
+from database import Database, AsyncDatabase
+from state_backend import create_state
+from sessions import RelayContext, RelayCache
+from online_stats import OnlineStats, ONLINE_FLUSH_INTERVAL
+from broadcast import BroadcastManager, BROADCAST_CLAIM_INTERVAL
+from webhook import run_webhook
+from user_queue import UserQueueMiddleware
+from votes import VOTE_FLUSH_INTERVAL
+from archive import DEFAULT_RETENTION_DAYS, ARCHIVE_INTERVAL
+from cache import ProfileCache
+from moderation import MODERATION_SYNC_INTERVAL
+from callbacks import (CallbackTable, DistrictCallback, ChangeDistrictCallback, BlacklistCallback,
+                       RateCallback, AdminUserCallback, BroadcastStopCallback)
+from relay import relay_message, MediaGroupBuffer, ALBUM_MEDIA
 import keyboards as kb
 from states import States
 
+class AdminStates(StatesGroup):
+    """Состояния админ-панели в дополнение к States"""
+    ban_reason = State()        # ждем причину бана, цель - в данных FSM (ban_target)
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.DEBUG if DEBUG else logging.INFO,
@@ -26,17 +43,45 @@ logger = logging.getLogger(__name__)
 
 # Инициализация
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
-db = Database()
+# STATE_BACKEND=sqlite позволяет запускать несколько процессов бота с общим состоянием
+# (апдейты тогда принимаются только через webhook, см. WEBHOOK_URL)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_DB = os.getenv("STATE_DB", "bot_state.db")
+sessions, storage = create_state(STATE_BACKEND, STATE_DB)
+# Если задан WEBHOOK_URL, бот принимает апдейты через webhook вместо polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Процессы с общим состоянием не могут получать апдейты через polling: Telegram
+# отвечает 409 Conflict на параллельные getUpdates с одним токеном
+if sessions.shared and not WEBHOOK_URL:
+    raise RuntimeError(f"STATE_BACKEND={STATE_BACKEND} requires WEBHOOK_URL: polling allows only one bot process")
+dp = Dispatcher(storage=storage)
+# Апдейты одного пользователя - по порядку, разных - параллельно
+update_queue = UserQueueMiddleware()
+update_queue.setup(dp)
+# Сообщения старше MESSAGE_RETENTION_DAYS дней переносятся в помесячные архивы (0 - не переносить)
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", DEFAULT_RETENTION_DAYS))
+db = AsyncDatabase(Database(message_retention_days=MESSAGE_RETENTION_DAYS))
+broadcasts = BroadcastManager(bot, db, done_markup=kb.admin_menu())
+# Альбомы пересылаются одним send_media_group
+albums = MediaGroupBuffer(bot)
 
 # Глобальные переменные
-waiting_users = []
-active_chats = {}
+waiting_users = sessions.queue
+# Изменения профилей сбрасывают контексты пересылки в активных чатах
+relays = RelayCache()
+db.profiles.listeners.append(relays.invalidate)
+# Готовые тексты главного меню, сбрасываются вместе с профилем
+main_menu_texts = ProfileCache()
+db.profiles.listeners.append(main_menu_texts.invalidate)
+# Подбор пары проверяет баны и ЧС по индексу, который ведет Database
+waiting_users.sync.moderation = db.moderation
+online_stats = OnlineStats()
 chat_messages = {}
 user_last_message = {}
-search_mode = {}
-active_chat_ids = {}
-broadcast_data = {}
 
 bot_stats = {
     "total_messages": 0,
@@ -63,62 +108,63 @@ def get_rating_level(rating):
     return "👎 Нарушитель"
 
 async def force_cleanup_user(user_id, db):
-    if user_id in waiting_users:
-        waiting_users.remove(user_id)
-        db.update_online_status(user_id, False)
-    
-    if user_id in active_chats:
-        pid = active_chats[user_id]
-        if pid in active_chats:
-            if pid in active_chat_ids:
-                db.end_chat(active_chat_ids[pid])
-                del active_chat_ids[pid]
-            db.update_online_status(pid, False)
-            del active_chats[pid]
-        if user_id in active_chat_ids:
-            db.end_chat(active_chat_ids[user_id])
-            del active_chat_ids[user_id]
-        del active_chats[user_id]
-    
-    if user_id in search_mode:
-        del search_mode[user_id]
-
-async def update_online_stats(db):
-    online_users = set(active_chats.keys()) | set(waiting_users)
-    online_by_district = {}
-    
-    for uid in online_users:
-        user = db.get_user(uid)
-        if user and not db.check_banned(uid):
-            district = user['district']
-            online_by_district[district] = online_by_district.get(district, 0) + 1
-    
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE district_stats SET online_now = 0')
-    for district, count in online_by_district.items():
-        cursor.execute('UPDATE district_stats SET online_now = ? WHERE district = ?', (count, district))
-    conn.commit()
-    conn.close()
-    
-    bot_stats["online_users"] = len(online_users)
-    return online_users, online_by_district
+    await waiting_users.cancel(user_id)
+    online_stats.set_offline(user_id)
+    
+    session = await sessions.end(user_id)
+    if session:
+        relays.invalidate(user_id, session.partner)
+        await db.end_chat(session.chat_uuid)
+        online_stats.set_offline(session.partner)
 
-async def show_main_menu(message, user_id):
-    user = db.get_user(user_id)
+async def notify_auto_ban(user_id):
+    """Убирает автоматически забаненного из поиска и сообщает ему о бане"""
+    if await waiting_users.cancel(user_id):
+        online_stats.set_offline(user_id)
+    try:
+        await bot.send_message(
+            user_id,
+            "🚫 Вы были заблокированы из-за большого количества дизлайков.\n"
+            "Обратитесь к администратору для разблокировки."
+        )
+    except:
+        pass
+
+async def rebuild_online_stats(db):
+    """Пересобирает онлайн из очереди и активных чатов и сразу сохраняет его"""
+    online_users = {}
+    for uid in await sessions.online_ids():
+        user = await db.get_user(uid)
+        if user and not user['banned']:
+            online_users[uid] = user['district']
+    
+    online_stats.reset(online_users)
+    await online_stats.flush(db)
+    bot_stats["online_users"] = len(online_stats)
+
+def format_online_by_district(limit: int = None):
+    counts = sorted(online_stats.by_district().items(), key=lambda x: x[1], reverse=True)
+    return "".join(f"  {district}: {count} чел.\n" for district, count in counts[:limit])
+
+async def render_main_menu(user_id):
+    """Текст главного меню. Кеш сбрасывается при изменении профиля,
+    а при изменении онлайна в районе текст перестраивается.
+    """
+    cached = main_menu_texts.get(user_id)
+    if cached is not None:
+        district, online, text = cached
+        if online_stats.count(district) == online:
+            return text
+    
+    user = await db.get_user(user_id)
     if not user:
-        return
+        return None
     
     anon = "🕵️ Вкл" if user['anon_mode'] else "👁️ Выкл"
     rating = user['rating'] or 50.0
     rating_level = get_rating_level(rating)
     
-    stats = db.get_district_stats()
-    online = 0
-    for s in stats:
-        if s['district'] == user['district']:
-            online = s['online_now']
-            break
+    online = online_stats.count(user['district'])
     
     text = (
         f"👋 <b>ТюменьChat</b>\n\n"
@@ -127,6 +173,13 @@ async def show_main_menu(message, user_id):
         f"{anon} | Рейтинг: {rating:.1f}% ({rating_level})\n"
         f"📍 В районе онлайн: {online}"
     )
+    main_menu_texts.put(user_id, (user['district'], online, text))
+    return text
+
+async def show_main_menu(message, user_id):
+    text = await render_main_menu(user_id)
+    if text is None:
+        return
     
     try:
         await message.edit_text(text, reply_markup=kb.main_menu())
@@ -134,8 +187,8 @@ async def show_main_menu(message, user_id):
         await message.answer(text, reply_markup=kb.main_menu())
 
 async def create_chat(user1_id, user2_id, db, bot):
-    user1 = db.get_user(user1_id)
-    user2 = db.get_user(user2_id)
+    user1 = await db.get_user(user1_id)
+    user2 = await db.get_user(user2_id)
     
     if not user1 or not user2:
         return False
@@ -143,15 +196,16 @@ async def create_chat(user1_id, user2_id, db, bot):
     chat_uuid = f"{min(user1_id, user2_id)}_{max(user1_id, user2_id)}_{datetime.datetime.now().timestamp()}"
     chat_district = user1['district'] if user1['district'] == user2['district'] else 'разные районы'
     
-    db.create_chat(chat_uuid, user1_id, user2_id, user1['nickname'], user2['nickname'], chat_district)
+    await db.create_chat(chat_uuid, user1_id, user2_id, user1['nickname'], user2['nickname'], chat_district)
+    
+    await sessions.start(user1_id, user2_id, chat_uuid, chat_district)
     
-    active_chats[user1_id] = user2_id
-    active_chats[user2_id] = user1_id
-    active_chat_ids[user1_id] = chat_uuid
-    active_chat_ids[user2_id] = chat_uuid
+    online_stats.set_online(user1_id, user1['district'])
+    online_stats.set_online(user2_id, user2['district'])
     
     bot_stats["total_chats"] += 1
-    bot_stats["active_chats"] = len(active_chats) // 2
+    bot_stats["active_chats"] = await sessions.chat_count()
+    bot_stats["online_users"] = len(online_stats)
     
     try:
         if user1['district'] == user2['district']:
@@ -178,33 +232,45 @@ async def create_chat(user1_id, user2_id, db, bot):
         logger.error(f"Error notifying users: {e}")
         return False
     
-    await update_online_stats(db)
     return True
 
+async def get_relay(user_id):
+    """Контекст пересылки для пользователя в чате (None - пересылать нельзя).
+    
+    Строится при первом сообщении и живет до конца чата или до изменения
+    профиля кого-то из пары (relays.invalidate через кеш профилей).
+    """
+    session = await sessions.get(user_id)
+    if not session:
+        return None
+    relay = relays.get(user_id, session.chat_uuid)
+    if relay is not None:
+        return relay
+    
+    user = await db.get_user(user_id)
+    partner = await db.get_user(session.partner)
+    if not user or not partner or user['banned']:
+        return None
+    
+    relay = RelayContext(session.partner, session.chat_uuid, user['nickname'], bool(user['anon_mode']), partner['nickname'])
+    relays.put(user_id, relay)
+    return relay
+
 async def stop_chat(user_id, db, bot):
-    partner_id = active_chats.get(user_id)
-    if not partner_id:
+    session = await sessions.end(user_id)
+    if not session:
         return
+    partner_id = session.partner
+    relays.invalidate(user_id, partner_id)
     
-    user = db.get_user(user_id)
-    partner = db.get_user(partner_id)
-    
-    if user_id in active_chat_ids:
-        db.end_chat(active_chat_ids[user_id])
+    user = await db.get_user(user_id)
+    partner = await db.get_user(partner_id)
     
-    if user_id in active_chats:
-        del active_chats[user_id]
-        db.update_online_status(user_id, False)
-    if partner_id in active_chats:
-        del active_chats[partner_id]
-        db.update_online_status(partner_id, False)
+    chat_row = await db.end_chat(session.chat_uuid)
+    online_stats.set_offline(user_id)
+    online_stats.set_offline(partner_id)
     
-    if user_id in active_chat_ids:
-        del active_chat_ids[user_id]
-    if partner_id in active_chat_ids:
-        del active_chat_ids[partner_id]
-    
-    await update_online_stats(db)
+    bot_stats["online_users"] = len(online_stats)
     
     # Уведомляем обоих о завершении чата
     try:
@@ -214,42 +280,22 @@ async def stop_chat(user_id, db, bot):
         pass
     
     # Отправляем клавиатуру для оценки ОБОИМ пользователям
-    if user and not db.check_banned(user_id):
-        rating_keyboard1 = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="👍", callback_data=f"like_{partner_id}"),
-                InlineKeyboardButton(text="👎", callback_data=f"dislike_{partner_id}")
-            ],
-            [
-                InlineKeyboardButton(text="🚫 В ЧС", callback_data=f"blacklist_add_{partner_id}"),
-                InlineKeyboardButton(text="🔍 Новый поиск", callback_data="search_menu")
-            ]
-        ])
+    if user and not await db.check_banned(user_id):
         try:
             await bot.send_message(
                 user_id,
                 f"👤 Как тебе общение с {partner['nickname']}?\nОцени собеседника:",
-                reply_markup=rating_keyboard1
+                reply_markup=kb.rating_keyboard(partner_id, chat_row)
             )
         except:
             pass
     
-    if partner and not db.check_banned(partner_id):
-        rating_keyboard2 = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="👍", callback_data=f"like_{user_id}"),
-                InlineKeyboardButton(text="👎", callback_data=f"dislike_{user_id}")
-            ],
-            [
-                InlineKeyboardButton(text="🚫 В ЧС", callback_data=f"blacklist_add_{user_id}"),
-                InlineKeyboardButton(text="🔍 Новый поиск", callback_data="search_menu")
-            ]
-        ])
+    if partner and not await db.check_banned(partner_id):
         try:
             await bot.send_message(
                 partner_id,
                 f"👤 Как тебе общение с {user['nickname']}?\nОцени собеседника:",
-                reply_markup=rating_keyboard2
+                reply_markup=kb.rating_keyboard(user_id, chat_row)
             )
         except:
             pass
@@ -261,11 +307,11 @@ async def cmd_start(message: types.Message, state: FSMContext):
     
     await force_cleanup_user(user_id, db)
     
-    if db.check_banned(user_id):
+    if await db.check_banned(user_id):
         await message.answer("❌ Вы заблокированы.")
         return
     
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     if not user:
         nickname = generate_nickname()
         await message.answer(
@@ -276,8 +322,8 @@ async def cmd_start(message: types.Message, state: FSMContext):
         await state.update_data(new_user=True, nickname=nickname)
         return
     
-    db.update_user_activity(user_id)
-    db.update_daily_stats()
+    await db.update_user_activity(user_id)
+    await db.update_daily_stats()
     await show_main_menu(message, user_id)
 
 @dp.message(Command("admin"))
@@ -290,7 +336,7 @@ async def cmd_admin(message: types.Message):
 @dp.message(Command("myid"))
 async def cmd_myid(message: types.Message):
     user_id = message.from_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     text = f"🆔 Твой ID: <code>{user_id}</code>"
     if user:
         text += f"\n✅ Ник: {user['nickname']}"
@@ -300,17 +346,14 @@ async def cmd_myid(message: types.Message):
 
 @dp.message(Command("online"))
 async def cmd_online(message: types.Message):
-    online_users, online_by_district = await update_online_stats(db)
-    
     text = "🟢 <b>Сейчас онлайн</b>\n\n"
-    text += f"👥 Всего: {len(online_users)} человек\n"
-    text += f"⏳ В очереди: {len(waiting_users)}\n"
-    text += f"💬 В чатах: {len(active_chats) // 2}\n\n"
+    text += f"👥 Всего: {len(online_stats)} человек\n"
+    text += f"⏳ В очереди: {await waiting_users.size()}\n"
+    text += f"💬 В чатах: {await sessions.chat_count()}\n\n"
     
-    if online_by_district:
+    if len(online_stats):
         text += "📊 <b>По районам:</b>\n"
-        for district, count in sorted(online_by_district.items(), key=lambda x: x[1], reverse=True)[:5]:
-            text += f"  {district}: {count} чел.\n"
+        text += format_online_by_district(5)
     
     await message.answer(text)
 
@@ -319,404 +362,437 @@ async def cmd_fix_online(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
         return
     
-    online_users, online_by_district = await update_online_stats(db)
+    await rebuild_online_stats(db)
     
     report = "✅ Онлайн статистика исправлена!\n\n"
-    report += f"👥 Всего онлайн: {len(online_users)}\n"
-    report += f"⏳ В очереди: {len(waiting_users)}\n"
-    report += f"💬 В чатах: {len(active_chats) // 2}\n\n"
+    report += f"👥 Всего онлайн: {len(online_stats)}\n"
+    report += f"⏳ В очереди: {await waiting_users.size()}\n"
+    report += f"💬 В чатах: {await sessions.chat_count()}\n\n"
     report += "📊 По районам:\n"
+    report += format_online_by_district()
+    
+    await message.answer(report)
+
+@dp.message(Command("backfill_stats"))
+async def cmd_backfill_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    await db.backfill_daily_stats()
+    today = await db.update_daily_stats()
+    
+    report = "✅ Дневная статистика пересчитана!\n\n"
+    report += f"📅 Сегодня ({today['date']}):\n"
+    report += f"💬 Сообщений: {today['messages']}\n"
+    report += f"🔄 Чатов: {today['chats']}\n"
+    report += f"🆕 Новых: {today['new_users']}\n"
+    report += f"🟢 Активных: {today['active_users']}"
+    
+    await message.answer(report)
+
+@dp.message(Command("vacuum"))
+async def cmd_vacuum(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    await message.answer("⏳ Перестраиваю базу, запись на это время остановится...")
+    if await db.enable_incremental_vacuum():
+        await message.answer("✅ Место после архивации сообщений теперь возвращается автоматически")
+    else:
+        await message.answer("✅ Уже включено, ничего делать не нужно")
+
+@dp.message(Command("check_stats"))
+async def cmd_check_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
     
-    for district, count in sorted(online_by_district.items(), key=lambda x: x[1], reverse=True):
-        report += f"  {district}: {count} чел.\n"
+    mismatches = await db.check_totals(fix=True)
+    if not mismatches:
+        await message.answer("✅ Счетчики статистики совпадают с таблицами")
+        return
     
+    report = "⚠️ Счетчики исправлены:\n\n"
+    for name, (stored, actual) in mismatches.items():
+        report += f"• {name}: {stored} → {actual}\n"
     await message.answer(report)
 
 @dp.message(Command("cancel"))
 async def cmd_cancel(message: types.Message, state: FSMContext):
-    if message.from_user.id in broadcast_data:
-        del broadcast_data[message.from_user.id]
     await state.clear()
     await message.answer("❌ Отменено", reply_markup=kb.main_menu())
 
-# ========== УНИВЕРСАЛЬНЫЙ ОБРАБОТЧИК ВСЕХ КНОПОК ==========
+# ========== КНОПКИ ==========
+# Кнопки разбираются таблицами (O(1) на нажатие), а не перебором фильтров:
+# admin_callbacks - админ-панель, рассылки и баны (только ADMIN_IDS),
+# user_callbacks - все остальное. Единственный aiogram-хендлер - route_callback,
+# отдельные aiogram Router на каждую таблицу добавляли бы проход по роутерам.
+# На callback отвечает CallbackAnswerMiddleware, текст ответа задается через answer.
+admin_callbacks = CallbackTable()
+user_callbacks = CallbackTable()
+dp.callback_query.middleware(CallbackAnswerMiddleware())
+
 @dp.callback_query()
-async def handle_all_callbacks(callback: types.CallbackQuery, state: FSMContext):
-    data = callback.data
+async def route_callback(callback: types.CallbackQuery, state: FSMContext, callback_answer: CallbackAnswer):
+    resolved = admin_callbacks.resolve(callback.data)
+    if resolved is not None:
+        if callback.from_user.id not in ADMIN_IDS:
+            callback_answer.text = "❌ Нет доступа"
+            callback_answer.show_alert = True
+            return
+        await admin_callbacks.dispatch(callback, state, callback_answer, resolved)
+    elif not await user_callbacks.dispatch(callback, state, callback_answer):
+        # Кнопка из сообщения, отправленного старой версией бота
+        callback_answer.text = "⌛ Кнопка устарела, открой меню заново"
+
+async def safe_edit(callback, text, reply_markup=None):
+    try:
+        await callback.message.edit_text(text, reply_markup=reply_markup)
+    except:
+        await callback.message.answer(text, reply_markup=reply_markup)
+
+def settings_text(user) -> str:
+    anon = "🕵️ Вкл" if user['anon_mode'] else "👁️ Выкл"
+    return f"⚙️ <b>Настройки</b>\n\n👤 {user['nickname']}\n🏘️ {user['district']}\n{anon}"
+
+def blacklist_markup(blacklist):
+    keyboard = []
+    for b in blacklist:
+        keyboard.append([InlineKeyboardButton(
+            text=f"❌ {b['nickname']}",
+            callback_data=BlacklistCallback(action="remove", user_id=b['blocked_id']).pack()
+        )])
+    keyboard.append([InlineKeyboardButton(text="◀️ Назад", callback_data="blacklist")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+# ===== АДМИН-ПАНЕЛЬ =====
+@admin_callbacks.on("admin_stats")
+async def admin_stats(callback, state, answer):
+    stats = await db.get_all_stats()
+    online = len(online_stats)
+    text = f"👑 <b>Статистика</b>\n\n👥 Всего: {stats['total_users']}\n🚫 Бан: {stats['banned_users']}\n🟢 Онлайн: {online}\n⏳ В очереди: {await waiting_users.size()}\n💬 В чатах: {await sessions.chat_count()}"
+    cache = db.profiles.stats()
+    text += f"\n\n🗄 Кеш профилей: {cache['size']} | попаданий {cache['hit_rate']:.0%}"
+    queue = update_queue.stats()
+    text += f"\n📥 Апдейты: в работе {queue['active']} | ждут {queue['pending']} (макс. {queue['max_depth']}) | сверх лимита {queue['throttled']}"
+    await safe_edit(callback, text, kb.admin_menu())
+
+@admin_callbacks.on("admin_online")
+async def admin_online(callback, state, answer):
+    online = list(online_stats)
+    if not online:
+        text = "👥 Сейчас нет онлайн пользователей"
+    else:
+        text = "👥 <b>Онлайн пользователи</b>\n\n"
+        for uid in online[:20]:
+            user = await db.get_user(uid)
+            if user:
+                status = "💬 в чате" if await sessions.contains(uid) else "⏳ в очереди"
+                text += f"• {user['nickname']} - {status}\n"
+    await safe_edit(callback, text, kb.admin_menu())
+
+@admin_callbacks.on("admin_districts")
+async def admin_districts(callback, state, answer):
+    stats = await db.get_district_stats()
+    text = "🗺️ <b>Статистика по районам</b>\n\n"
+    for s in stats:
+        text += f"{s['district']}\n   👥 {s['user_count']} | 🟢 {s['online_now']}\n\n"
+    await safe_edit(callback, text, kb.admin_menu())
+
+@admin_callbacks.on("admin_bans")
+async def admin_bans(callback, state, answer):
+    banned = await db.get_banned_users()
+    if not banned:
+        text = "✅ Нет забаненных пользователей"
+    else:
+        text = "🔨 <b>Забаненные пользователи</b>\n\n"
+        for u in banned[:20]:
+            text += f"• {u['nickname']} (ID: {u['user_id']})\n"
+            if u['ban_reason']:
+                text += f"  Причина: {u['ban_reason']}\n"
+    await safe_edit(callback, text, kb.admin_menu())
+
+@admin_callbacks.on("admin_daily")
+async def admin_daily(callback, state, answer):
+    stats = await db.get_all_stats()
+    text = "📈 <b>Статистика по дням</b>\n\n"
+    for d in stats['daily_stats'][:7]:
+        text += f"<b>{d['date']}:</b> 💬{d['total_messages']} 👥+{d['new_users']}\n"
+    await safe_edit(callback, text, kb.admin_menu())
+
+@admin_callbacks.on("admin_logs")
+async def admin_logs(callback, state, answer):
+    logs = await db.get_admin_logs(20)
+    if not logs:
+        text = "📋 Логов нет"
+    else:
+        text = "📋 <b>Последние действия</b>\n\n"
+        for log in logs:
+            admin = await db.get_user(log['admin_id'])
+            name = admin['nickname'] if admin else str(log['admin_id'])
+            text += f"• {log['timestamp'][:16]} {name}: {log['action']}\n"
+    await safe_edit(callback, text, kb.admin_menu())
+
+@admin_callbacks.on("admin_getdb")
+async def admin_getdb(callback, state, answer):
+    # Копия БД делается долго - отвечаем на нажатие сразу
+    answer.disable()
+    await callback.answer("⏳ Загружаю...")
+    try:
+        ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        backup = f"tyumenchat_backup_{ts}.db"
+        await db.backup(backup)
+        await callback.message.answer_document(FSInputFile(backup), caption=f"📊 База данных на {ts}")
+        os.remove(backup)
+    except Exception as e:
+        await callback.message.answer(f"❌ Ошибка: {e}")
+
+@admin_callbacks.on("admin_menu")
+async def admin_menu(callback, state, answer):
+    await safe_edit(callback, "👑 Панель администратора", kb.admin_menu())
+
+@admin_callbacks.on("admin_search_district")
+async def admin_search_district(callback, state, answer):
+    districts = "\n".join([f"• {d}" for d in TYUMEN_DISTRICTS])
+    await safe_edit(callback, f"🔍 Введи название района:\n\n{districts}", kb.cancel_keyboard())
+    await state.set_state(States.admin_search_district)
+
+@admin_callbacks.on("admin_search_messages")
+async def admin_search_messages(callback, state, answer):
+    await safe_edit(callback, "🔍 Введи текст для поиска:", kb.cancel_keyboard())
+    await state.set_state(States.admin_search_messages)
+
+@admin_callbacks.on("admin_user_details")
+async def admin_user_details(callback, state, answer):
+    await safe_edit(callback, "👤 Введи ID или ник:", kb.cancel_keyboard())
+    await state.set_state(States.admin_get_user)
+
+@admin_callbacks.on("admin_broadcast")
+async def admin_broadcast(callback, state, answer):
+    await safe_edit(callback, "📤 Отправь текст для рассылки:", kb.cancel_keyboard())
+    await state.set_state(States.admin_broadcast)
+    await state.set_data({'broadcast': 'waiting'})
+
+# ===== МЕНЮ И ПОИСК =====
+@user_callbacks.on("menu", "cancel")
+async def menu(callback, state, answer):
+    if callback.data == "cancel":
+        await state.clear()
+    await show_main_menu(callback.message, callback.from_user.id)
+
+@user_callbacks.on("search_menu")
+async def search_menu(callback, state, answer):
+    await safe_edit(callback, "🔍 <b>Поиск собеседника</b>\n\nВыбери режим:", kb.search_menu_keyboard())
+
+@user_callbacks.on("search_all", "search_district")
+async def search(callback, state, answer):
     user_id = callback.from_user.id
+    user = await db.get_user(user_id)
+    if not user:
+        await safe_edit(callback, "❌ Сначала нажми /start", kb.main_menu())
+        return
+    # Забаненного не с кем соединить: в очередь и в онлайн он не попадает
+    if await db.check_banned(user_id):
+        answer.text = "❌ Вы заблокированы"
+        answer.show_alert = True
+        return
     
-    print(f"\n🔴 НАЖАТА КНОПКА: {data}")
+    await force_cleanup_user(user_id, db)
     
-    async def safe_edit(text, reply_markup=None):
-        try:
-            await callback.message.edit_text(text, reply_markup=reply_markup)
-        except:
-            await callback.message.answer(text, reply_markup=reply_markup)
+    same_district = callback.data == "search_district"
+    partner_id = await waiting_users.match_or_enqueue(user_id, user['district'], same_district=same_district)
     
-    # АДМИН-ПАНЕЛЬ
-    if data.startswith('admin_'):
-        if user_id not in ADMIN_IDS:
-            await callback.answer("❌ Нет доступа", show_alert=True)
-            return
-        
-        if data == "admin_stats":
-            stats = db.get_all_stats()
-            online = len(set(active_chats.keys()) | set(waiting_users))
-            text = f"👑 <b>Статистика</b>\n\n👥 Всего: {stats['total_users']}\n🚫 Бан: {stats['banned_users']}\n🟢 Онлайн: {online}\n⏳ В очереди: {len(waiting_users)}\n💬 В чатах: {len(active_chats)//2}"
-            await safe_edit(text, kb.admin_menu())
-        
-        elif data == "admin_online":
-            online = set(active_chats.keys()) | set(waiting_users)
-            if not online:
-                text = "👥 Сейчас нет онлайн пользователей"
-            else:
-                text = "👥 <b>Онлайн пользователи</b>\n\n"
-                for uid in list(online)[:20]:
-                    user = db.get_user(uid)
-                    if user:
-                        status = "💬 в чате" if uid in active_chats else "⏳ в очереди"
-                        text += f"• {user['nickname']} - {status}\n"
-            await safe_edit(text, kb.admin_menu())
-        
-        elif data == "admin_districts":
-            stats = db.get_district_stats()
-            text = "🗺️ <b>Статистика по районам</b>\n\n"
-            for s in stats:
-                text += f"{s['district']}\n   👥 {s['user_count']} | 🟢 {s['online_now']}\n\n"
-            await safe_edit(text, kb.admin_menu())
-        
-        elif data == "admin_bans":
-            banned = db.get_banned_users()
-            if not banned:
-                text = "✅ Нет забаненных пользователей"
-            else:
-                text = "🔨 <b>Забаненные пользователи</b>\n\n"
-                for u in banned[:20]:
-                    text += f"• {u['nickname']} (ID: {u['user_id']})\n"
-                    if u['ban_reason']:
-                        text += f"  Причина: {u['ban_reason']}\n"
-            await safe_edit(text, kb.admin_menu())
-        
-        elif data == "admin_daily":
-            stats = db.get_all_stats()
-            text = "📈 <b>Статистика по дням</b>\n\n"
-            for d in stats['daily_stats'][:7]:
-                text += f"<b>{d['date']}:</b> 💬{d['total_messages']} 👥+{d['new_users']}\n"
-            await safe_edit(text, kb.admin_menu())
-        
-        elif data == "admin_logs":
-            logs = db.get_admin_logs(20)
-            if not logs:
-                text = "📋 Логов нет"
-            else:
-                text = "📋 <b>Последние действия</b>\n\n"
-                for log in logs:
-                    admin = db.get_user(log['admin_id'])
-                    name = admin['nickname'] if admin else str(log['admin_id'])
-                    text += f"• {log['timestamp'][:16]} {name}: {log['action']}\n"
-            await safe_edit(text, kb.admin_menu())
-        
-        elif data == "admin_getdb":
-            await callback.answer("⏳ Загружаю...")
-            try:
-                ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                backup = f"tyumenchat_backup_{ts}.db"
-                shutil.copy2(db.db_name, backup)
-                await callback.message.answer_document(FSInputFile(backup), caption=f"📊 База данных на {ts}")
-                os.remove(backup)
-            except Exception as e:
-                await callback.message.answer(f"❌ Ошибка: {e}")
-        
-        elif data == "admin_menu":
-            await safe_edit("👑 Панель администратора", kb.admin_menu())
-        
-        elif data == "admin_search_district":
-            districts = "\n".join([f"• {d}" for d in TYUMEN_DISTRICTS])
-            await safe_edit(f"🔍 Введи название района:\n\n{districts}", kb.cancel_keyboard())
-            await state.set_state(States.admin_search_district)
-        
-        elif data == "admin_search_messages":
-            await safe_edit("🔍 Введи текст для поиска:", kb.cancel_keyboard())
-            await state.set_state(States.admin_search_messages)
-        
-        elif data == "admin_user_details":
-            await safe_edit("👤 Введи ID или ник:", kb.cancel_keyboard())
-            await state.set_state(States.admin_get_user)
-        
-        elif data == "admin_broadcast":
-            broadcast_data[user_id] = "waiting"
-            await safe_edit("📤 Отправь текст для рассылки:", kb.cancel_keyboard())
-            await state.set_state(States.admin_broadcast)
+    if partner_id:
+        await create_chat(user_id, partner_id, db, bot)
+        await safe_edit(callback, "✅ Собеседник найден! Чат создан.")
+    else:
+        online_stats.set_online(user_id, user['district'])
+        where = f" в районе {user['district']}" if same_district else ""
+        await safe_edit(
+            callback,
+            f"⏳ <b>Поиск собеседника{where}...</b>\n\nПозиция в очереди: {await waiting_users.size()}",
+            kb.cancel_search_keyboard()
+        )
+
+@user_callbacks.on("cancel_search")
+async def cancel_search(callback, state, answer):
+    if await waiting_users.cancel(callback.from_user.id):
+        online_stats.set_offline(callback.from_user.id)
+    await safe_edit(callback, "❌ Поиск отменен", kb.main_menu())
+    await state.clear()
+
+@user_callbacks.on("stop")
+async def stop(callback, state, answer):
+    user_id = callback.from_user.id
+    if await sessions.contains(user_id):
+        await stop_chat(user_id, db, bot)
+        await safe_edit(callback, "✅ Чат завершен", kb.main_menu())
+    elif await waiting_users.cancel(user_id):
+        online_stats.set_offline(user_id)
+        await safe_edit(callback, "✅ Ты удален из очереди поиска", kb.main_menu())
+    else:
+        answer.text = "❌ Ты не в чате"
+        answer.show_alert = True
+
+# ===== РАЙОНЫ И РЕЙТИНГ =====
+@user_callbacks.on("districts_menu")
+async def districts_menu(callback, state, answer):
+    stats = await db.get_district_stats()
+    text = "🗺️ <b>Районы Тюмени</b>\n\n"
+    for s in stats:
+        text += f"{s['district']}\n   👥 {s['user_count']} | 🟢 {s['online_now']}\n\n"
+    await safe_edit(callback, text, kb.districts_keyboard())
+
+@user_callbacks.on(DistrictCallback)
+async def choose_district(callback, state, answer, callback_data: DistrictCallback):
+    user_id = callback.from_user.id
+    district = TYUMEN_DISTRICTS[callback_data.index - 1]
+    st = await state.get_data()
     
-    # ПОЛЬЗОВАТЕЛЬСКИЕ КНОПКИ
-    elif data == "menu":
+    if st.get('new_user'):
+        await db.add_user(user_id, st['nickname'], district)
+        await state.clear()
         await show_main_menu(callback.message, user_id)
+    else:
+        user = await db.get_user(user_id)
+        if user:
+            await db.update_user_district(user_id, district)
+            if user_id in online_stats:
+                online_stats.set_online(user_id, district)
+            answer.text = "✅ Район изменен"
+            await show_main_menu(callback.message, user_id)
+
+@user_callbacks.on("top_rating")
+async def top_rating(callback, state, answer):
+    top = await db.get_top_users(10)
+    if not top:
+        await safe_edit(callback, "🏆 Пока нет данных для рейтинга", kb.main_menu())
+        return
+    text = "🏆 <b>Топ 10 пользователей</b>\n\n"
+    for i, u in enumerate(top, 1):
+        medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
+        text += f"{medal} {u['nickname']} ({u['district']})\n"
+        text += f"   👍 {u['likes']} | 👎 {u['dislikes']} | Рейтинг: {u['rating']:.1f}%\n\n"
+    await safe_edit(callback, text, kb.main_menu())
+
+@user_callbacks.on(RateCallback)
+async def rate(callback, state, answer, callback_data: RateCallback):
+    user_id = callback.from_user.id
+    partner_id = callback_data.target
     
-    elif data == "search_menu":
-        await safe_edit("🔍 <b>Поиск собеседника</b>\n\nВыбери режим:", kb.search_menu_keyboard())
+    if await db.check_banned(user_id):
+        answer.text = "❌ Вы заблокированы"
+        answer.show_alert = True
+        return
     
-    elif data == "search_all":
-        user = db.get_user(user_id)
-        if not user:
-            await safe_edit("❌ Сначала нажми /start", kb.main_menu())
-        else:
-            await force_cleanup_user(user_id, db)
-            
-            partner_id = None
-            for uid in waiting_users:
-                if uid != user_id and not db.check_banned(uid) and not db.is_blocked(user_id, uid) and not db.is_blocked(uid, user_id):
-                    partner_id = uid
-                    break
-            
-            if partner_id:
-                waiting_users.remove(partner_id)
-                await create_chat(user_id, partner_id, db, bot)
-                await safe_edit("✅ Собеседник найден! Чат создан.")
-            else:
-                db.update_online_status(user_id, True)
-                if user_id not in waiting_users:
-                    waiting_users.append(user_id)
-                
-                await update_online_stats(db)
-                await safe_edit(
-                    f"⏳ <b>Поиск собеседника...</b>\n\nПозиция в очереди: {len(waiting_users)}",
-                    InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="❌ Отменить поиск", callback_data="cancel_search")]
-                    ])
-                )
-    
-    elif data == "search_district":
-        user = db.get_user(user_id)
-        if not user:
-            await safe_edit("❌ Сначала нажми /start", kb.main_menu())
-        else:
-            await force_cleanup_user(user_id, db)
-            
-            partner_id = None
-            for uid in waiting_users:
-                partner = db.get_user(uid)
-                if partner and uid != user_id and partner['district'] == user['district'] and not db.check_banned(uid) and not db.is_blocked(user_id, uid) and not db.is_blocked(uid, user_id):
-                    partner_id = uid
-                    break
-            
-            if partner_id:
-                waiting_users.remove(partner_id)
-                await create_chat(user_id, partner_id, db, bot)
-                await safe_edit("✅ Собеседник найден! Чат создан.")
-            else:
-                db.update_online_status(user_id, True)
-                if user_id not in waiting_users:
-                    waiting_users.append(user_id)
-                
-                await update_online_stats(db)
-                await safe_edit(
-                    f"⏳ <b>Поиск собеседника в районе {user['district']}...</b>\n\nПозиция в очереди: {len(waiting_users)}",
-                    InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="❌ Отменить поиск", callback_data="cancel_search")]
-                    ])
-                )
-    
-    elif data == "cancel_search":
-        if user_id in waiting_users:
-            waiting_users.remove(user_id)
-            db.update_online_status(user_id, False)
-            await update_online_stats(db)
-        await safe_edit("❌ Поиск отменен", kb.main_menu())
-        await state.clear()
+    partner = await db.get_user(partner_id)
+    if not partner:
+        answer.text = "❌ Собеседник не найден"
+        answer.show_alert = True
+        return
     
-    elif data == "districts_menu":
-        stats = db.get_district_stats()
-        text = "🗺️ <b>Районы Тюмени</b>\n\n"
-        for s in stats:
-            text += f"{s['district']}\n   👥 {s['user_count']} | 🟢 {s['online_now']}\n\n"
-        await safe_edit(text, kb.districts_keyboard())
-    
-    elif data.startswith("district_"):
-        idx = int(data.split("_")[1]) - 1
-        district = TYUMEN_DISTRICTS[idx]
-        st = await state.get_data()
-        
-        if st.get('new_user'):
-            db.add_user(user_id, st['nickname'], district)
-            await state.clear()
-            await show_main_menu(callback.message, user_id)
-        else:
-            user = db.get_user(user_id)
-            if user:
-                db.update_user_district(user_id, district)
-                await callback.answer("✅ Район изменен")
-                await show_main_menu(callback.message, user_id)
-    
-    elif data == "top_rating":
-        top = db.get_top_users(10)
-        if not top:
-            await safe_edit("🏆 Пока нет данных для рейтинга", kb.main_menu())
-        else:
-            text = "🏆 <b>Топ 10 пользователей</b>\n\n"
-            for i, u in enumerate(top, 1):
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-                text += f"{medal} {u['nickname']} ({u['district']})\n"
-                text += f"   👍 {u['likes']} | 👎 {u['dislikes']} | Рейтинг: {u['rating']:.1f}%\n\n"
-            await safe_edit(text, kb.main_menu())
-    
-    elif data == "settings":
-        user = db.get_user(user_id)
-        if user:
-            anon = "🕵️ Вкл" if user['anon_mode'] else "👁️ Выкл"
-            text = f"⚙️ <b>Настройки</b>\n\n👤 {user['nickname']}\n🏘️ {user['district']}\n{anon}"
-            await safe_edit(text, kb.settings_menu())
-    
-    elif data == "change_nick":
-        await safe_edit("✏️ Введи новый ник (до 20 символов):", kb.cancel_keyboard())
-        await state.set_state(States.changing_nick)
-    
-    elif data == "change_district":
-        await safe_edit("🏘️ Выбери новый район:", kb.change_district_keyboard())
-    
-    elif data.startswith("change_district_"):
-        idx = int(data.split("_")[2]) - 1
-        district = TYUMEN_DISTRICTS[idx]
-        db.update_user_district(user_id, district)
-        await callback.answer("✅ Район изменен")
-        user = db.get_user(user_id)
-        anon = "🕵️ Вкл" if user['anon_mode'] else "👁️ Выкл"
-        text = f"⚙️ <b>Настройки</b>\n\n👤 {user['nickname']}\n🏘️ {user['district']}\n{anon}"
-        await safe_edit(text, kb.settings_menu())
-    
-    elif data == "toggle_anon":
-        db.toggle_anon_mode(user_id)
-        user = db.get_user(user_id)
-        anon = "🕵️ Вкл" if user['anon_mode'] else "👁️ Выкл"
-        text = f"⚙️ <b>Настройки</b>\n\n👤 {user['nickname']}\n🏘️ {user['district']}\n{anon}"
-        await safe_edit(text, kb.settings_menu())
-    
-    elif data == "blacklist":
-        bl = db.get_blacklist(user_id)
-        text = f"🚫 <b>Черный список</b>\n\nВсего заблокировано: {len(bl)}"
-        await safe_edit(text, kb.blacklist_menu())
-    
-    elif data == "show_blacklist":
-        bl = db.get_blacklist(user_id)
-        if not bl:
-            await safe_edit("📋 Твой черный список пуст", kb.blacklist_menu())
-        else:
-            keyboard = []
-            for b in bl:
-                keyboard.append([InlineKeyboardButton(
-                    text=f"❌ {b['nickname']}",
-                    callback_data=f"blacklist_remove_{b['blocked_id']}"
-                )])
-            keyboard.append([InlineKeyboardButton(text="◀️ Назад", callback_data="blacklist")])
-            await safe_edit(
-                "🚫 <b>Черный список:</b>\n\nНажми на пользователя, чтобы удалить:",
-                InlineKeyboardMarkup(inline_keyboard=keyboard)
-            )
+    user = await db.get_user(user_id)
+    if not user:
+        answer.text = "❌ Ошибка"
+        answer.show_alert = True
+        return
     
-    elif data.startswith("blacklist_remove_"):
-        tid = int(data.replace("blacklist_remove_", ""))
-        db.remove_from_blacklist(user_id, tid)
-        await callback.answer("✅ Пользователь удален из ЧС")
-        bl = db.get_blacklist(user_id)
-        if not bl:
-            await safe_edit("📋 Черный список пуст", kb.blacklist_menu())
-        else:
-            keyboard = []
-            for b in bl:
-                keyboard.append([InlineKeyboardButton(
-                    text=f"❌ {b['nickname']}",
-                    callback_data=f"blacklist_remove_{b['blocked_id']}"
-                )])
-            keyboard.append([InlineKeyboardButton(text="◀️ Назад", callback_data="blacklist")])
-            await safe_edit(
-                "🚫 <b>Черный список:</b>\n\nНажми на пользователя, чтобы удалить:",
-                InlineKeyboardMarkup(inline_keyboard=keyboard)
-            )
+    is_like = callback_data.like
+    if not await db.cast_vote(callback_data.chat, user_id, partner_id, is_like):
+        answer.text = "✅ Ты уже оценил этот чат"
+        return
     
-    elif data.startswith("blacklist_add_"):
-        tid = int(data.replace("blacklist_add_", ""))
-        if user_id == tid:
-            await callback.answer("❌ Нельзя добавить себя в ЧС", show_alert=True)
-        else:
-            db.add_to_blacklist(user_id, tid)
-            await callback.answer("✅ Пользователь добавлен в ЧС")
-            await safe_edit("✅ Пользователь добавлен в черный список", kb.main_menu())
-    
-    elif data == "stop":
-        if user_id in active_chats:
-            partner_id = active_chats[user_id]
-            await stop_chat(user_id, db, bot)
-            await safe_edit("✅ Чат завершен", kb.main_menu())
-        elif user_id in waiting_users:
-            waiting_users.remove(user_id)
-            db.update_online_status(user_id, False)
-            await update_online_stats(db)
-            await safe_edit("✅ Ты удален из очереди поиска", kb.main_menu())
-        else:
-            await callback.answer("❌ Ты не в чате", show_alert=True)
+    # Рейтинг в БД обновится при ближайшем flush_votes, показываем с учетом этой оценки
+    likes = (partner['likes'] or 0) + is_like
+    total = (partner['likes'] or 0) + (partner['dislikes'] or 0) + 1
+    new_rating = likes * 100.0 / total
     
-    # ЛАЙКИ И ДИЗЛАЙКИ
-    elif data.startswith('like_') or data.startswith('dislike_'):
-        parts = data.split('_')
-        action = parts[0]
-        partner_id = int(parts[1])
-        
-        print(f"👍👎 Получена оценка: {action} для пользователя {partner_id}")
-        
-        if db.check_banned(user_id):
-            await callback.answer("❌ Вы заблокированы", show_alert=True)
-            return
-        
-        partner = db.get_user(partner_id)
-        if not partner:
-            await callback.answer("❌ Собеседник не найден", show_alert=True)
-            return
+    if is_like:
+        text = f"👍 Ты поставил лайк пользователю {partner['nickname']}!\n\n"
+        text += f"Теперь его рейтинг: {new_rating:.1f}%"
         
-        user = db.get_user(user_id)
-        if not user:
-            await callback.answer("❌ Ошибка", show_alert=True)
-            return
-        
-        is_like = (action == "like")
-        db.update_rating(partner_id, is_like)
-        
-        updated_partner = db.get_user(partner_id)
-        new_rating = updated_partner['rating'] if updated_partner else 50.0
-        
-        if is_like:
-            text = f"👍 Ты поставил лайк пользователю {partner['nickname']}!\n\n"
-            text += f"Теперь его рейтинг: {new_rating:.1f}%"
-            
-            try:
-                await bot.send_message(
-                    partner_id,
-                    f"👍 {user['nickname']} оценил(а) тебя положительно!\n"
-                    f"Твой текущий рейтинг: {new_rating:.1f}%"
-                )
-            except:
-                pass
-        else:
-            text = f"👎 Ты поставил дизлайк пользователю {partner['nickname']}.\n\n"
-            text += f"Теперь его рейтинг: {new_rating:.1f}%"
-        
-        await safe_edit(text, kb.main_menu())
-        
-        if db.check_banned(partner_id):
-            try:
-                await bot.send_message(
-                    partner_id,
-                    "🚫 Вы были заблокированы из-за большого количества дизлайков.\n"
-                    "Обратитесь к администратору для разблокировки."
-                )
-            except:
-                pass
-        
-        await callback.answer()
+        try:
+            await bot.send_message(
+                partner_id,
+                f"👍 {user['nickname']} оценил(а) тебя положительно!\n"
+                f"Твой текущий рейтинг: {new_rating:.1f}%"
+            )
+        except:
+            pass
+    else:
+        text = f"👎 Ты поставил дизлайк пользователю {partner['nickname']}.\n\n"
+        text += f"Теперь его рейтинг: {new_rating:.1f}%"
     
-    elif data == "cancel":
-        await state.clear()
-        await show_main_menu(callback.message, user_id)
+    await safe_edit(callback, text, kb.main_menu())
+
+# ===== НАСТРОЙКИ =====
+@user_callbacks.on("settings")
+async def settings(callback, state, answer):
+    user = await db.get_user(callback.from_user.id)
+    if user:
+        await safe_edit(callback, settings_text(user), kb.settings_menu())
+
+@user_callbacks.on("change_nick")
+async def change_nick(callback, state, answer):
+    await safe_edit(callback, "✏️ Введи новый ник (до 20 символов):", kb.cancel_keyboard())
+    await state.set_state(States.changing_nick)
+
+@user_callbacks.on("change_district")
+async def change_district(callback, state, answer):
+    await safe_edit(callback, "🏘️ Выбери новый район:", kb.change_district_keyboard())
+
+@user_callbacks.on(ChangeDistrictCallback)
+async def change_district_to(callback, state, answer, callback_data: ChangeDistrictCallback):
+    user_id = callback.from_user.id
+    district = TYUMEN_DISTRICTS[callback_data.index - 1]
+    await db.update_user_district(user_id, district)
+    if user_id in online_stats:
+        online_stats.set_online(user_id, district)
+    answer.text = "✅ Район изменен"
+    user = await db.get_user(user_id)
+    await safe_edit(callback, settings_text(user), kb.settings_menu())
+
+@user_callbacks.on("toggle_anon")
+async def toggle_anon(callback, state, answer):
+    await db.toggle_anon_mode(callback.from_user.id)
+    user = await db.get_user(callback.from_user.id)
+    await safe_edit(callback, settings_text(user), kb.settings_menu())
+
+# ===== ЧЕРНЫЙ СПИСОК =====
+@user_callbacks.on("blacklist")
+async def blacklist(callback, state, answer):
+    bl = await db.get_blacklist(callback.from_user.id)
+    text = f"🚫 <b>Черный список</b>\n\nВсего заблокировано: {len(bl)}"
+    await safe_edit(callback, text, kb.blacklist_menu())
+
+@user_callbacks.on("show_blacklist")
+async def show_blacklist(callback, state, answer):
+    bl = await db.get_blacklist(callback.from_user.id)
+    if not bl:
+        await safe_edit(callback, "📋 Твой черный список пуст", kb.blacklist_menu())
+    else:
+        await safe_edit(callback, "🚫 <b>Черный список:</b>\n\nНажми на пользователя, чтобы удалить:", blacklist_markup(bl))
+
+@user_callbacks.on(BlacklistCallback)
+async def blacklist_action(callback, state, answer, callback_data: BlacklistCallback):
+    user_id = callback.from_user.id
+    tid = callback_data.user_id
     
-    await callback.answer()
+    if callback_data.action == "remove":
+        await db.remove_from_blacklist(user_id, tid)
+        answer.text = "✅ Пользователь удален из ЧС"
+        bl = await db.get_blacklist(user_id)
+        if not bl:
+            await safe_edit(callback, "📋 Черный список пуст", kb.blacklist_menu())
+        else:
+            await safe_edit(callback, "🚫 <b>Черный список:</b>\n\nНажми на пользователя, чтобы удалить:", blacklist_markup(bl))
+    
+    elif user_id == tid:
+        answer.text = "❌ Нельзя добавить себя в ЧС"
+        answer.show_alert = True
+    else:
+        await db.add_to_blacklist(user_id, tid)
+        answer.text = "✅ Пользователь добавлен в ЧС"
+        await safe_edit(callback, "✅ Пользователь добавлен в черный список", kb.main_menu())
 
 # ========== ОБРАБОТЧИКИ СОСТОЯНИЙ АДМИН-ПАНЕЛИ ==========
 @dp.message(States.admin_search_district)
@@ -755,7 +831,7 @@ async def process_admin_search_district(message: types.Message, state: FSMContex
     
     # Один район - ищем пользователей
     district = matching_districts[0]
-    users = db.get_users_by_district(district)
+    users = await db.get_users_by_district(district)
     
     if not users:
         await message.answer(
@@ -766,7 +842,7 @@ async def process_admin_search_district(message: types.Message, state: FSMContex
         return
     
     # Считаем статистику по району
-    online_users = set(active_chats.keys()) | set(waiting_users)
+    online_users = online_stats
     
     text = f"🏘️ <b>Район: {district}</b>\n\n"
     text += f"👥 Всего пользователей: {len(users)}\n"
@@ -811,7 +887,7 @@ async def process_admin_search_messages(message: types.Message, state: FSMContex
     status_msg = await message.answer("🔍 Ищу сообщения...")
     
     # Выполняем поиск
-    messages = db.search_messages(search_text, limit=30)
+    messages = await db.search_messages(search_text, limit=30, include_archive=True)
     
     await status_msg.delete()
     
@@ -870,21 +946,13 @@ async def process_admin_get_user(message: types.Message, state: FSMContext):
     # Пробуем найти по ID
     try:
         target_id = int(search_text)
-        user = db.get_user_details(target_id)
+        user = await db.get_user_details(target_id)
         users = [user] if user else []
     except ValueError:
         # Ищем по нику
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT u.*, r.likes, r.dislikes, r.rating, r.banned, r.ban_reason
-            FROM users u
-            LEFT JOIN ratings r ON u.user_id = r.user_id
-            WHERE u.nickname LIKE ?
-            ORDER BY u.last_activity DESC
-        ''', (f'%{search_text}%',))
-        users = cursor.fetchall()
-        conn.close()
+        users = await db.find_users_by_nickname(search_text)
+        if len(users) == 1:
+            users = [await db.get_user_details(users[0]['user_id'])]
     
     if not users:
         await message.answer(f"❌ Пользователь '{search_text}' не найден")
@@ -909,26 +977,22 @@ async def process_admin_get_user(message: types.Message, state: FSMContext):
     # Если один результат - показываем детали
     user = users[0]
     
-    # Получаем черный список
-    blacklist = db.get_blacklist(user['user_id'])
+    # Черный список и последние чаты уже есть в карточке
     blacklist_text = ""
-    if blacklist:
+    if user['blacklist']:
         blacklist_text = "\n🚫 <b>В ЧС у пользователя:</b>\n"
-        for blocked in blacklist[:5]:
+        for blocked in user['blacklist']:
             blacklist_text += f"  • {blocked['nickname']}\n"
     
-    # Получаем последние чаты
-    recent_chats = db.get_user_chats(user['user_id'], 5)
     chats_text = ""
-    if recent_chats:
+    if user['recent_chats']:
         chats_text = "\n📋 <b>Последние чаты:</b>\n"
-        for chat in recent_chats[:3]:
-            partner_nick = chat['user2_nick'] if chat['user1_id'] == user['user_id'] else chat['user1_nick']
+        for chat in user['recent_chats'][:3]:
             chat_time = chat['start_time'][:16]
             msg_count = chat['message_count']
-            chats_text += f"  • С {partner_nick} | {chat_time} | {msg_count} сообщ.\n"
+            chats_text += f"  • С {chat['partner_nick']} | {chat_time} | {msg_count} сообщ.\n"
     
-    online_status = "🟢 Онлайн" if user['user_id'] in set(active_chats.keys()) | set(waiting_users) else "⚫ Офлайн"
+    online_status = "🟢 Онлайн" if user['user_id'] in online_stats else "⚫ Офлайн"
     
     text = (
         f"👤 <b>Детали пользователя</b>\n\n"
@@ -955,8 +1019,8 @@ async def process_admin_get_user(message: types.Message, state: FSMContext):
     # Кнопки действий
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="🔨 Забанить", callback_data=f"admin_ban_{user['user_id']}"),
-            InlineKeyboardButton(text="✅ Разбанить", callback_data=f"admin_unban_{user['user_id']}")
+            InlineKeyboardButton(text="🔨 Забанить", callback_data=AdminUserCallback(action="ban", user_id=user['user_id']).pack()),
+            InlineKeyboardButton(text="✅ Разбанить", callback_data=AdminUserCallback(action="unban", user_id=user['user_id']).pack())
         ],
         [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_user_details")]
     ])
@@ -964,103 +1028,87 @@ async def process_admin_get_user(message: types.Message, state: FSMContext):
     await message.answer(text, reply_markup=keyboard)
     await state.clear()
 
-@dp.callback_query(lambda c: c.data.startswith("admin_ban_"))
-async def admin_ban_user(callback: types.CallbackQuery, state: FSMContext):
-    """Начало процесса бана пользователя"""
+@admin_callbacks.on(AdminUserCallback)
+async def admin_user_action(callback, state, answer, callback_data: AdminUserCallback):
+    """Бан (с запросом причины) и разбан из карточки пользователя"""
     admin_id = callback.from_user.id
+    target_id = callback_data.user_id
     
-    if admin_id not in ADMIN_IDS:
-        await callback.answer("❌ Нет доступа", show_alert=True)
+    if callback_data.action == "ban":
+        await callback.message.edit_text(
+            f"🔨 <b>Бан пользователя {target_id}</b>\n\n"
+            f"Введи причину бана:",
+            reply_markup=kb.cancel_keyboard()
+        )
+        await state.set_state(AdminStates.ban_reason)
+        await state.set_data({'ban_target': target_id})
         return
     
-    target_id = int(callback.data.replace("admin_ban_", ""))
+    # action == "unban": другие значения отбрасывает AdminUserCallback
+    await db.unban_user(target_id)
+    await db.log_admin_action(admin_id, "unban", target_id, "Разбанен администратором")
     
-    await callback.message.edit_text(
-        f"🔨 <b>Бан пользователя {target_id}</b>\n\n"
-        f"Введи причину бана:",
-        reply_markup=kb.cancel_keyboard()
-    )
-    await state.update_data(ban_target=target_id)
-    await state.set_state(States.admin_broadcast)
-    await callback.answer()
+    answer.text = f"✅ Пользователь {target_id} разбанен"
+    answer.show_alert = True
+    
+    # Возвращаемся в админ-меню
+    await callback.message.edit_text("✅ Готово", reply_markup=kb.admin_menu())
 
-@dp.callback_query(lambda c: c.data.startswith("admin_unban_"))
-async def admin_unban_user(callback: types.CallbackQuery):
-    """Разбан пользователя"""
-    admin_id = callback.from_user.id
+@dp.message(AdminStates.ban_reason)
+async def process_ban_reason(message: types.Message, state: FSMContext):
+    """Причина бана после кнопки «Забанить» в карточке пользователя"""
+    admin_id = message.from_user.id
+    target_id = (await state.get_data()).get('ban_target')
+    await state.clear()
     
-    if admin_id not in ADMIN_IDS:
-        await callback.answer("❌ Нет доступа", show_alert=True)
+    if admin_id not in ADMIN_IDS or target_id is None:
         return
     
-    target_id = int(callback.data.replace("admin_unban_", ""))
-    
-    db.unban_user(target_id)
-    db.log_admin_action(admin_id, "unban", target_id, "Разбанен администратором")
-    
-    await callback.answer(f"✅ Пользователь {target_id} разбанен", show_alert=True)
-    
-    # Возвращаемся в админ-меню
-    await callback.message.edit_text("✅ Готово", reply_markup=kb.admin_menu())
+    reason = message.text or "Нарушение правил"
+    await db.ban_user(target_id, reason)
+    await db.log_admin_action(admin_id, "ban", target_id, reason)
+    if await waiting_users.cancel(target_id):
+        online_stats.set_offline(target_id)
+    await message.answer(f"🔨 Пользователь {target_id} забанен\nПричина: {reason}", reply_markup=kb.admin_menu())
 
-# ========== ОБРАБОТЧИК РАССЫЛКИ ==========
-@dp.callback_query(lambda c: c.data == "broadcast_send")
-async def broadcast_send_handler(callback: types.CallbackQuery):
+# ===== РАССЫЛКА =====
+@admin_callbacks.on("broadcast_send")
+async def broadcast_send(callback, state, answer):
     admin_id = callback.from_user.id
-    text = broadcast_data.get(admin_id)
+    text = (await state.get_data()).get('broadcast_text')
     
     if not text:
-        await callback.answer("❌ Ошибка")
+        answer.text = "❌ Ошибка"
         return
     
-    await callback.message.edit_text("⏳ Отправка...")
-    
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM users')
-    users = cursor.fetchall()
-    conn.close()
-    
-    sent = 0
-    failed = 0
-    
-    for (uid,) in users:
-        if db.check_banned(uid):
-            failed += 1
-            continue
-        try:
-            await bot.send_message(uid, f"📢 <b>Рассылка</b>\n\n{text}")
-            sent += 1
-            await asyncio.sleep(0.05)
-        except:
-            failed += 1
-    
-    await callback.message.edit_text(
-        f"✅ Отправлено: {sent}\n❌ Ошибок: {failed}",
-        reply_markup=kb.admin_menu()
-    )
-    
-    if admin_id in broadcast_data:
-        del broadcast_data[admin_id]
+    await state.clear()
     
-    db.log_admin_action(admin_id, "broadcast", details=f"Sent: {sent}, Failed: {failed}")
-    await callback.answer()
+    # Рассылка идет в фоне, прогресс обновляется в этом же сообщении
+    await callback.message.edit_text("⏳ Рассылка запускается...")
+    job = await broadcasts.start(admin_id, text, callback.message.chat.id, callback.message.message_id)
+    await job.report(force=True)
 
-@dp.callback_query(lambda c: c.data == "broadcast_cancel")
-async def broadcast_cancel_handler(callback: types.CallbackQuery):
-    admin_id = callback.from_user.id
-    if admin_id in broadcast_data:
-        del broadcast_data[admin_id]
+@admin_callbacks.on(BroadcastStopCallback)
+async def broadcast_stop(callback, state, answer, callback_data: BroadcastStopCallback):
+    if await broadcasts.stop(callback_data.broadcast_id):
+        answer.text = "⛔ Останавливаю рассылку..."
+    else:
+        answer.text = "❌ Рассылка уже завершена"
+        answer.show_alert = True
+
+@admin_callbacks.on("broadcast_cancel")
+async def broadcast_cancel(callback, state, answer):
+    await state.clear()
     await callback.message.edit_text("❌ Отменено", reply_markup=kb.admin_menu())
-    await callback.answer()
 
 # ========== ОБРАБОТЧИК ТЕКСТОВЫХ СООБЩЕНИЙ ==========
 @dp.message()
 async def handle_messages(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
+    current_state = await state.get_state()
     
     # Смена ника
-    if await state.get_state() == States.changing_nick:
+    if current_state == States.changing_nick:
         if not message.text:
             await message.answer("❌ Отправь текстовое сообщение")
             return
@@ -1070,18 +1118,19 @@ async def handle_messages(message: types.Message, state: FSMContext):
             await message.answer("❌ Ник должен быть 2-20 символов")
             return
         
-        db.update_nickname(user_id, new_nick)
+        await db.update_nickname(user_id, new_nick)
         await state.clear()
         await show_main_menu(message, user_id)
         return
     
-    # Рассылка
-    if user_id in broadcast_data and broadcast_data[user_id] == "waiting":
+    # Рассылка (текст хранится в FSM до подтверждения)
+    fsm_data = await state.get_data() if current_state == States.admin_broadcast else {}
+    if fsm_data.get('broadcast') == 'waiting':
         if not message.text:
             await message.answer("❌ Отправь текст для рассылки")
             return
         
-        broadcast_data[user_id] = message.text
+        await state.set_data({'broadcast': 'confirm', 'broadcast_text': message.text})
         confirm = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="✅ Отправить", callback_data="broadcast_send"),
              InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast_cancel")]
@@ -1089,89 +1138,27 @@ async def handle_messages(message: types.Message, state: FSMContext):
         await message.answer(f"📤 Подтверждение:\n\n{message.text}", reply_markup=confirm)
         return
     
-    # Проверка регистрации
-    user = db.get_user(user_id)
-    if not user:
-        return
-    
-    if db.check_banned(user_id):
-        return
-    
-    # Проверка чата
-    if user_id not in active_chats:
+    # Пользователь в чате, зарегистрирован и не забанен
+    relay = await get_relay(user_id)
+    if not relay:
         return
     
-    partner_id = active_chats[user_id]
-    if partner_id not in active_chats:
-        del active_chats[user_id]
-        return
-    
-    partner = db.get_user(partner_id)
-    if not partner:
-        return
-    
-    # Определяем имя
-    if user['anon_mode']:
-        sender = user['nickname']
-    else:
-        sender = message.from_user.full_name or "Пользователь"
-        if message.from_user.username:
-            sender += f" (@{message.from_user.username})"
-    
-    chat_uuid = active_chat_ids.get(user_id)
+    partner_id = relay.partner
+    partner_nick = relay.partner_nick
+    sender = relay.sender_name(message.from_user)
+    chat_uuid = relay.chat_uuid
     
     # Отправка сообщения
     try:
-        if message.text:
-            await bot.send_message(partner_id, f"<b>{sender}:</b> {message.text}")
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], message.text, "text")
-        
-        elif message.sticker:
-            await bot.send_sticker(partner_id, message.sticker.file_id)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], None, "sticker", message.sticker.file_id)
-        
-        elif message.photo:
-            photo = message.photo[-1]
-            caption = f"<b>{sender}:</b> {message.caption or '📸 Фото'}"
-            await bot.send_photo(partner_id, photo.file_id, caption=caption)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], message.caption, "photo", photo.file_id)
-        
-        elif message.video:
-            caption = f"<b>{sender}:</b> {message.caption or '🎥 Видео'}"
-            await bot.send_video(partner_id, message.video.file_id, caption=caption)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], message.caption, "video", message.video.file_id)
-        
-        elif message.voice:
-            await bot.send_voice(partner_id, message.voice.file_id)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], None, "voice", message.voice.file_id)
-        
-        elif message.animation:
-            caption = f"<b>{sender}:</b> {message.caption or '🎬 GIF'}"
-            await bot.send_animation(partner_id, message.animation.file_id, caption=caption)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], message.caption, "animation", message.animation.file_id)
-        
-        elif message.video_note:
-            await bot.send_video_note(partner_id, message.video_note.file_id)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], None, "video_note", message.video_note.file_id)
-        
-        elif message.audio:
-            caption = f"<b>{sender}:</b> {message.caption or '🎵 Аудио'}"
-            await bot.send_audio(partner_id, message.audio.file_id, caption=caption)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], message.caption, "audio", message.audio.file_id)
+        if message.media_group_id and message.content_type in ALBUM_MEDIA:
+            saved = await albums.add(user_id, partner_id, message, sender)
+        else:
+            # Недособранный альбом уходит раньше следующего сообщения
+            await albums.flush(user_id)
+            saved = await relay_message(bot, partner_id, message, sender)
         
-        elif message.document:
-            caption = f"<b>{sender}:</b> {message.caption or '📎 Документ'}"
-            await bot.send_document(partner_id, message.document.file_id, caption=caption)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], message.caption, "document", message.document.file_id)
+        if chat_uuid:
+            await db.save_message(chat_uuid, user_id, partner_id, sender, partner_nick, *saved)
     
     except Exception as e:
         logger.error(f"Error sending message: {e}")
@@ -1186,13 +1173,82 @@ async def main():
     print(f"🤖 ID бота: {bot.id}")
     print("=" * 50)
     
-    async def periodic_cleanup():
+    async def archive_old_messages():
+        while True:
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+            try:
+                await db.archive_messages()
+            except Exception as e:
+                logger.error(f"Error archiving messages: {e}")
+    
+    asyncio.create_task(archive_old_messages())
+    
+    async def persist_online_stats():
+        while True:
+            await asyncio.sleep(ONLINE_FLUSH_INTERVAL)
+            try:
+                if sessions.shared:
+                    # Каждый процесс видит только свои изменения, поэтому онлайн
+                    # пересобирается целиком из общего хранилища
+                    await rebuild_online_stats(db)
+                else:
+                    await online_stats.flush(db)
+            except Exception as e:
+                logger.error(f"Error saving online stats: {e}")
+    
+    asyncio.create_task(persist_online_stats())
+    
+    async def sync_shared_changes():
+        while True:
+            await asyncio.sleep(MODERATION_SYNC_INTERVAL)
+            try:
+                await db.sync_moderation()
+                # Сброшенные профили через слушателей сбрасывают и контексты пересылки
+                await db.sync_profiles()
+            except Exception as e:
+                logger.error(f"Error syncing moderation and profiles: {e}")
+    
+    if sessions.shared:
+        # Баны, ЧС и профили, измененные в других процессах бота
+        asyncio.create_task(sync_shared_changes())
+    
+    async def claim_broadcasts():
+        while True:
+            await asyncio.sleep(BROADCAST_CLAIM_INTERVAL)
+            try:
+                await broadcasts.resume_all()
+            except Exception as e:
+                logger.error(f"Error claiming broadcasts: {e}")
+    
+    # Рассылки процессов, которые упали или остановлены
+    asyncio.create_task(claim_broadcasts())
+    
+    async def apply_votes():
         while True:
-            await asyncio.sleep(60)
-            # Функция очистки
+            await asyncio.sleep(VOTE_FLUSH_INTERVAL)
+            try:
+                for banned_id in await db.flush_votes():
+                    await notify_auto_ban(banned_id)
+            except Exception as e:
+                logger.error(f"Error applying votes: {e}")
+    
+    asyncio.create_task(apply_votes())
     
-    asyncio.create_task(periodic_cleanup())
-    await dp.start_polling(bot)
+    if sessions.shared:
+        # Очередь и чаты пережили рестарт в общем хранилище
+        await rebuild_online_stats(db)
+    await broadcasts.resume_all()
+    try:
+        if WEBHOOK_URL:
+            await run_webhook(dp, bot, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await broadcasts.shutdown()
+        if not sessions.shared:
+            # После остановки в памяти никого нет, обнуляем онлайн в БД
+            await db.set_online_counts({})
+        await db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
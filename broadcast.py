@@ -0,0 +1,252 @@
+import os
+import socket
+import asyncio
+import time
+import logging
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from callbacks import BroadcastStopCallback
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит Telegram ~30 сообщений/сек, оставляем запас
+BROADCAST_RATE = 25
+BROADCAST_CONCURRENCY = 10
+BROADCAST_PAGE_SIZE = 500
+PROGRESS_INTERVAL = 5
+
+# Рассылку ведет один процесс бота - владелец аренды в БД. Он продлевает
+# аренду каждые BROADCAST_HEARTBEAT секунд; рассылку с истекшей арендой
+# (процесс упал или остановлен) забирает другой процесс при очередной проверке.
+BROADCAST_LEASE = 60
+BROADCAST_HEARTBEAT = 10
+BROADCAST_CLAIM_INTERVAL = 30
+
+def lease_owner() -> str:
+    """Идентификатор процесса-владельца рассылок"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class TokenBucket:
+    """Ограничитель частоты: не больше rate операций в секунду"""
+    
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (после RetryAfter от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        # Пополнение идет только с конца паузы, иначе после нее сразу уйдет вся пачка
+        self._updated = self._paused_until
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class BroadcastJob:
+    """Фоновая рассылка с сохранением прогресса в БД.
+    
+    Получатели берутся страницами по user_id, прогресс (последний
+    полностью обработанный user_id) пишется после каждой страницы,
+    поэтому после перезапуска рассылка продолжается с того же места.
+    """
+    
+    def __init__(self, bot, db, row, bucket: TokenBucket, concurrency: int = BROADCAST_CONCURRENCY, done_markup=None,
+                 owner: str = None):
+        self.bot = bot
+        self.db = db
+        self.owner = owner
+        self.id = row['id']
+        self.admin_id = row['admin_id']
+        self.text = row['text']
+        self.total = row['total']
+        self.sent = row['sent']
+        self.failed = row['failed']
+        self.last_user_id = row['last_user_id']
+        self.chat_id = row['chat_id']
+        self.message_id = row['message_id']
+        self.bucket = bucket
+        self.concurrency = concurrency
+        self.done_markup = done_markup
+        self.cancelled = False
+        # Аренду забрал другой процесс: рассылку продолжает он
+        self.lost = False
+        self.task = None
+        self._last_progress = 0.0
+    
+    def cancel(self):
+        self.cancelled = True
+    
+    async def save(self, status: str = 'running'):
+        """Пишет прогресс и продлевает аренду; учитывает остановку из другого процесса"""
+        stop_requested = await self.db.update_broadcast(
+            self.id, self.sent, self.failed, self.last_user_id, status,
+            self.owner, time.time() + BROADCAST_LEASE if status == 'running' else None
+        )
+        if stop_requested is None:
+            logger.warning(f"Broadcast {self.id} was taken over by another process")
+            self.lost = True
+        elif stop_requested:
+            self.cancel()
+    
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(BROADCAST_HEARTBEAT)
+            await self.save()
+    
+    def progress_text(self, status: str = None) -> str:
+        done = self.sent + self.failed
+        percent = done * 100 // self.total if self.total else 100
+        text = status or f"⏳ Рассылка #{self.id}: {percent}%"
+        return f"{text}\n\n📤 Отправлено: {self.sent}\n❌ Ошибок: {self.failed}\n👥 Всего: {self.total}"
+    
+    def cancel_keyboard(self):
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="⛔ Остановить", callback_data=BroadcastStopCallback(broadcast_id=self.id).pack())]
+        ])
+    
+    async def report(self, status: str = None, reply_markup=None, force: bool = False):
+        if not self.chat_id or not self.message_id:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_progress < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        try:
+            await self.bot.edit_message_text(
+                self.progress_text(status),
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                reply_markup=reply_markup if status else self.cancel_keyboard()
+            )
+        except TelegramBadRequest:
+            pass
+        except Exception as e:
+            logger.error(f"Error reporting broadcast {self.id} progress: {e}")
+    
+    async def send_one(self, user_id: int):
+        while True:
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(user_id, f"📢 <b>Рассылка</b>\n\n{self.text}")
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest):
+                self.failed += 1
+                return
+            except Exception as e:
+                logger.error(f"Broadcast {self.id} failed for {user_id}: {e}")
+                self.failed += 1
+                return
+    
+    async def run(self):
+        queue = asyncio.Queue()
+        
+        async def worker():
+            while True:
+                user_id = await queue.get()
+                try:
+                    if not self.cancelled:
+                        await self.send_one(user_id)
+                finally:
+                    queue.task_done()
+        
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        workers.append(asyncio.create_task(self.heartbeat()))
+        try:
+            while not self.cancelled and not self.lost:
+                page = await self.db.get_broadcast_recipients(self.last_user_id, BROADCAST_PAGE_SIZE)
+                if not page:
+                    break
+                for user_id in page:
+                    queue.put_nowait(user_id)
+                await queue.join()
+                self.last_user_id = page[-1]
+                await self.save()
+                await self.report()
+        finally:
+            for w in workers:
+                w.cancel()
+        
+        if self.lost:
+            return
+        status = 'cancelled' if self.cancelled else 'done'
+        await self.save(status)
+        await self.db.log_admin_action(self.admin_id, "broadcast", details=f"Sent: {self.sent}, Failed: {self.failed}")
+        title = "⛔ Рассылка остановлена" if self.cancelled else "✅ Рассылка завершена"
+        await self.report(title, reply_markup=self.done_markup, force=True)
+
+class BroadcastManager:
+    """Запускает, возобновляет и останавливает фоновые рассылки.
+    
+    Рассылки арендуются в БД (владелец - lease_owner()), поэтому при
+    нескольких процессах бота каждую ведет только один из них.
+    """
+    
+    def __init__(self, bot, db, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY, done_markup=None):
+        self.bot = bot
+        self.db = db
+        self.owner = lease_owner()
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.done_markup = done_markup
+        self.jobs = {}
+    
+    def _launch(self, row):
+        job = BroadcastJob(self.bot, self.db, row, self.bucket, self.concurrency, self.done_markup, self.owner)
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job))
+        return job
+    
+    async def _run(self, job):
+        try:
+            await job.run()
+        except Exception as e:
+            logger.error(f"Broadcast {job.id} crashed: {e}")
+        finally:
+            self.jobs.pop(job.id, None)
+    
+    async def start(self, admin_id: int, text: str, chat_id: int = None, message_id: int = None):
+        broadcast_id = await self.db.create_broadcast(
+            admin_id, text, chat_id, message_id, self.owner, time.time() + BROADCAST_LEASE
+        )
+        return self._launch(await self.db.get_broadcast(broadcast_id))
+    
+    async def resume_all(self):
+        """Продолжает рассылки без живого владельца (прерванные перезапуском бота)"""
+        now = time.time()
+        for row in await self.db.claim_broadcasts(self.owner, now + BROADCAST_LEASE, now):
+            if row['id'] not in self.jobs:
+                logger.info(f"Resuming broadcast {row['id']} after user {row['last_user_id']}")
+                self._launch(row)
+    
+    async def stop(self, broadcast_id: int) -> bool:
+        """Останавливает рассылку, в том числе идущую в другом процессе"""
+        job = self.jobs.get(broadcast_id)
+        if job:
+            job.cancel()
+            return True
+        return await self.db.request_broadcast_stop(broadcast_id)
+    
+    async def shutdown(self):
+        """Останавливает задачи без смены статуса и отдает аренду, чтобы продолжить после рестарта"""
+        for job in list(self.jobs.values()):
+            job.task.cancel()
+        await self.db.release_broadcasts(self.owner)
@@ -0,0 +1,92 @@
+import time
+import threading
+from collections import OrderedDict
+
+# Размер и время жизни кеша профилей по умолчанию
+DEFAULT_PROFILE_CACHE_SIZE = 10000
+DEFAULT_PROFILE_CACHE_TTL = 60.0
+
+# Сколько живет снимок статистики админ-панели (сек)
+DEFAULT_STATS_TTL = 5.0
+
+class ProfileCache:
+    """LRU-кеш профилей пользователей с TTL и счетчиками попаданий"""
+    
+    def __init__(self, maxsize: int = DEFAULT_PROFILE_CACHE_SIZE, ttl: float = DEFAULT_PROFILE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Вызываются с id пользователей при каждой инвалидации (из любого потока)
+        self.listeners = []
+    
+    def get(self, user_id: int):
+        """Возвращает профиль или None, если его нет или он устарел"""
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(user_id)
+                    self.hits += 1
+                    return value
+                del self._data[user_id]
+            self.misses += 1
+            return None
+    
+    def put(self, user_id: int, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[user_id] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def invalidate(self, *user_ids: int):
+        with self._lock:
+            for user_id in user_ids:
+                self._data.pop(user_id, None)
+        for listener in self.listeners:
+            listener(*user_ids)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+class Snapshot:
+    """Одно значение с TTL (например, сводка для админ-панели)"""
+    
+    def __init__(self, ttl: float = DEFAULT_STATS_TTL):
+        self.ttl = ttl
+        self._value = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+    
+    def get(self):
+        with self._lock:
+            if self._value is not None and self._expires > time.monotonic():
+                return self._value
+            return None
+    
+    def put(self, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._value = value
+            self._expires = time.monotonic() + self.ttl
+    
+    def invalidate(self):
+        with self._lock:
+            self._value = None
@@ -0,0 +1,99 @@
+from typing import Annotated, Literal
+from pydantic import Field
+from aiogram.filters.callback_data import CallbackData
+from config import TYUMEN_DISTRICTS
+
+# ===== ДАННЫЕ КНОПОК С ПАРАМЕТРАМИ =====
+# Кнопки без параметров остаются простыми строками ("menu", "admin_stats"...).
+# Значения проверяются при распаковке: подделанные данные (неизвестное
+# действие, номер района вне списка) не доходят до обработчика.
+
+# Номер района в TYUMEN_DISTRICTS, с 1
+DistrictIndex = Annotated[int, Field(ge=1, le=len(TYUMEN_DISTRICTS))]
+
+class DistrictCallback(CallbackData, prefix="district"):
+    """Выбор района при регистрации или из меню районов"""
+    index: DistrictIndex
+
+class ChangeDistrictCallback(CallbackData, prefix="change_district"):
+    """Смена района в настройках"""
+    index: DistrictIndex
+
+class BlacklistCallback(CallbackData, prefix="bl"):
+    action: Literal["add", "remove"]
+    user_id: int
+
+class RateCallback(CallbackData, prefix="rate"):
+    """Оценка собеседника после чата (chat - числовой id из chats)"""
+    target: int
+    chat: int
+    like: bool
+
+class AdminUserCallback(CallbackData, prefix="adm_user"):
+    action: Literal["ban", "unban"]
+    user_id: int
+
+class BroadcastStopCallback(CallbackData, prefix="bc_stop"):
+    broadcast_id: int
+
+# ===== ТАБЛИЦА ОБРАБОТЧИКОВ =====
+class CallbackTable:
+    """Находит обработчик кнопки за O(1), без перебора фильтров.
+    
+    Простые кнопки ищутся по точному совпадению строки, кнопки с
+    параметрами - по префиксу CallbackData (до первого разделителя).
+    Обработчик простой кнопки вызывается как handler(callback, state, answer),
+    кнопки с параметрами - handler(callback, state, answer, callback_data).
+    answer - CallbackAnswer из CallbackAnswerMiddleware.
+    """
+    
+    def __init__(self):
+        self._exact = {}        # callback_data -> обработчик
+        self._prefixed = {}     # префикс -> (класс CallbackData, обработчик)
+    
+    def __len__(self):
+        return len(self._exact) + len(self._prefixed)
+    
+    def __contains__(self, data):
+        return self.resolve(data) is not None
+    
+    def on(self, *keys):
+        """Регистрирует обработчик для строк и/или классов CallbackData"""
+        def register(handler):
+            for key in keys:
+                if isinstance(key, str):
+                    self._exact[key] = handler
+                else:
+                    self._prefixed[key.__prefix__] = (key, handler)
+            return handler
+        return register
+    
+    def resolve(self, data: str):
+        """Возвращает (обработчик, распакованные данные или None) или None"""
+        if not data:
+            return None
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, None
+        prefix, sep, _ = data.partition(":")
+        entry = self._prefixed.get(prefix) if sep else None
+        if entry is None:
+            return None
+        factory, handler = entry
+        try:
+            return handler, factory.unpack(data)
+        except (TypeError, ValueError):
+            # Кнопка от старой версии бота или подделанные данные
+            return None
+    
+    async def dispatch(self, callback, state, answer, resolved=None):
+        """Вызывает обработчик кнопки. False - кнопка неизвестна"""
+        resolved = resolved or self.resolve(callback.data)
+        if resolved is None:
+            return False
+        handler, callback_data = resolved
+        if callback_data is None:
+            await handler(callback, state, answer)
+        else:
+            await handler(callback, state, answer, callback_data)
+        return True
@@ -0,0 +1,41 @@
+# Дневная статистика (таблица stats) ведется инкрементально: каждое
+# событие прибавляет единицу к строке своего дня в той же транзакции,
+# что и само событие. День - DATE() от CURRENT_TIMESTAMP, как в
+# остальных таблицах.
+
+def bump(cursor, day: str = None, total_messages: int = 0, total_chats: int = 0,
+         new_users: int = 0, active_users: int = 0):
+    """Прибавляет значения к счетчикам дня (по умолчанию - сегодняшнего)"""
+    cursor.execute('''
+        INSERT INTO stats (date, total_messages, total_chats, new_users, active_users)
+        VALUES (COALESCE(?, DATE('now')), ?, ?, ?, ?)
+        ON CONFLICT(date) DO UPDATE SET
+            total_messages = total_messages + excluded.total_messages,
+            total_chats = total_chats + excluded.total_chats,
+            new_users = new_users + excluded.new_users,
+            active_users = active_users + excluded.active_users
+    ''', (day, total_messages, total_chats, new_users, active_users))
+
+def backfill(cursor):
+    """Пересобирает всю таблицу stats из исходных таблиц за один проход по каждой.
+    
+    Для активных пользователей известна только последняя активность,
+    поэтому за прошлые дни они считаются по ней.
+    """
+    cursor.execute('''
+        UPDATE stats SET total_messages = 0, total_chats = 0, new_users = 0, active_users = 0
+    ''')
+    for column, table, source in (
+        ('total_messages', 'messages', 'timestamp'),
+        ('total_chats', 'chats', 'start_time'),
+        ('new_users', 'users', 'join_date'),
+        ('active_users', 'users', 'last_activity'),
+    ):
+        # WHERE нужен, чтобы SQLite не принял ON CONFLICT за условие JOIN
+        cursor.execute(f'''
+            INSERT INTO stats (date, {column})
+            SELECT DATE({source}), COUNT(*) FROM {table}
+            WHERE {source} IS NOT NULL
+            GROUP BY 1
+            ON CONFLICT(date) DO UPDATE SET {column} = excluded.{column}
+        ''')
@@ -1,145 +1,188 @@
 import sqlite3
-import datetime
+import json
 import logging
+import queue
+import asyncio
+import functools
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from config import DB_NAME
+from migrations import apply_migrations
+from cache import ProfileCache, Snapshot, DEFAULT_PROFILE_CACHE_SIZE, DEFAULT_PROFILE_CACHE_TTL, DEFAULT_STATS_TTL
+import daily_stats
+import aggregates
+import votes
+import archive
+from archive import DEFAULT_RETENTION_DAYS, ARCHIVE_BATCH_SIZE, ARCHIVE_MAX_BATCHES, ARCHIVE_VACUUM_PAGES
+from message_journal import MessageJournal, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL
+from moderation import ModerationIndex
 
 logger = logging.getLogger(__name__)
 
+# Размер пула по умолчанию (0 - новое соединение на каждый вызов)
+DEFAULT_POOL_SIZE = 4
+
+# PRAGMA, применяемые к каждому новому соединению
+DEFAULT_PRAGMAS = {
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,
+    "mmap_size": 268435456,
+}
+
+# Сколько последних совпадений ранжируется при полнотекстовом поиске
+SEARCH_RANK_WINDOW = 2000
+
+def fts_query(text: str) -> str:
+    """Строит запрос FTS5 из ввода админа.
+    
+    Текст в кавычках ищется как фраза, иначе каждое слово - как префикс:
+    "привет мир" -> фраза, привет мир -> привет* AND мир*.
+    """
+    text = text.strip()
+    if len(text) > 1 and text.startswith('"') and text.endswith('"'):
+        phrase = text[1:-1].replace('"', '""').strip()
+        return f'"{phrase}"' if phrase else ''
+    words = [w.replace('"', '""') for w in text.split()]
+    return ' '.join(f'"{w}"*' for w in words if w.strip('"'))
+
+class PooledConnection:
+    """Соединение из пула: close() возвращает его в пул вместо закрытия"""
+    __slots__ = ("_conn", "_pool")
+    
+    def __init__(self, conn, pool):
+        self._conn = conn
+        self._pool = pool
+    
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a released connection.")
+        return getattr(self._conn, name)
+    
+    def __enter__(self):
+        return self._conn.__enter__()
+    
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+    
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+    
+    # Соединение, забытое из-за исключения, вернется в пул при сборке мусора
+    __del__ = close
+
+class ConnectionPool:
+    """Ограниченный пул долгоживущих соединений SQLite"""
+    
+    def __init__(self, db_name: str, size: int = DEFAULT_POOL_SIZE, pragmas: dict = None, timeout: float = 30.0):
+        self.db_name = db_name
+        self.size = size
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+    
+    def connect(self):
+        """Открывает новое соединение и применяет PRAGMA"""
+        conn = sqlite3.connect(self.db_name, timeout=self.timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+    
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            if len(self._all) < self.size:
+                conn = self.connect()
+                self._all.append(conn)
+                return conn
+        
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"Connection pool exhausted ({self.size} connections)")
+    
+    def release(self, conn):
+        # Незакоммиченные изменения не должны утечь следующему владельцу
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+    
+    def close_all(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+            self._idle = queue.LifoQueue()
+
 class Database:
-    def __init__(self, db_name=DB_NAME):
+    def __init__(self, db_name=DB_NAME, pool_size: int = DEFAULT_POOL_SIZE, pragmas: dict = None,
+                 message_batch_size: int = DEFAULT_BATCH_SIZE, message_flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 profile_cache_size: int = DEFAULT_PROFILE_CACHE_SIZE, profile_cache_ttl: float = DEFAULT_PROFILE_CACHE_TTL,
+                 stats_ttl: float = DEFAULT_STATS_TTL,
+                 message_retention_days: int = DEFAULT_RETENTION_DAYS, archive_batch_size: int = ARCHIVE_BATCH_SIZE):
         self.db_name = db_name
+        # Сообщения старше message_retention_days уходят в архив (0 - хранить все)
+        self.message_retention_days = message_retention_days
+        self.archive_batch_size = archive_batch_size
+        self.profiles = ProfileCache(profile_cache_size, profile_cache_ttl)
+        self.stats_snapshot = Snapshot(stats_ttl)
+        self.moderation = ModerationIndex()
+        self.pool = ConnectionPool(db_name, pool_size, pragmas) if pool_size > 0 else None
         self.init_db()
+        self.load_moderation()
+        self.profile_seq = self.get_profile_seq()
+        # batch_size <= 1 - каждое сообщение пишется сразу, как раньше
+        self.journal = None
+        if message_batch_size > 1:
+            self.journal = MessageJournal(self, message_batch_size, message_flush_interval)
     
     def get_connection(self):
-        """Создает соединение с БД"""
+        """Возвращает соединение с БД (из пула, если он включен)"""
+        if self.pool:
+            return PooledConnection(self.pool.acquire(), self.pool)
         conn = sqlite3.connect(self.db_name)
         conn.row_factory = sqlite3.Row
         return conn
     
+    def close(self):
+        """Сбрасывает буфер сообщений и закрывает все соединения пула"""
+        if self.journal:
+            self.journal.close()
+        if self.pool:
+            self.pool.close_all()
+    
+    def backup(self, path: str):
+        """Согласованная копия БД (с учетом WAL), не мешающая записи"""
+        conn = self.get_connection()
+        target = sqlite3.connect(path)
+        try:
+            conn.backup(target)
+        finally:
+            target.close()
+            conn.close()
+    
     def init_db(self):
-        """Создает таблицы если их нет"""
+        """Создает таблицы и применяет миграции схемы"""
         conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER UNIQUE NOT NULL,
-                nickname TEXT NOT NULL,
-                district TEXT DEFAULT '🏛️ Центральный',
-                anon_mode INTEGER DEFAULT 1,
-                join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                total_chats INTEGER DEFAULT 0,
-                total_messages INTEGER DEFAULT 0,
-                district_chats INTEGER DEFAULT 0
-            )
-        ''')
-        
-        # Таблица рейтинга
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS ratings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER UNIQUE NOT NULL,
-                likes INTEGER DEFAULT 0,
-                dislikes INTEGER DEFAULT 0,
-                rating REAL DEFAULT 50.0,
-                banned INTEGER DEFAULT 0,
-                ban_date TIMESTAMP,
-                ban_reason TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        # Таблица черного списка
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS blacklist (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                blocked_id INTEGER NOT NULL,
-                block_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(user_id, blocked_id),
-                FOREIGN KEY (user_id) REFERENCES users (user_id),
-                FOREIGN KEY (blocked_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        # Таблица чатов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id TEXT UNIQUE NOT NULL,
-                user1_id INTEGER NOT NULL,
-                user2_id INTEGER NOT NULL,
-                user1_nick TEXT NOT NULL,
-                user2_nick TEXT NOT NULL,
-                district TEXT,
-                start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                end_time TIMESTAMP,
-                message_count INTEGER DEFAULT 0,
-                FOREIGN KEY (user1_id) REFERENCES users (user_id),
-                FOREIGN KEY (user2_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        # Таблица сообщений
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id TEXT NOT NULL,
-                from_user INTEGER NOT NULL,
-                to_user INTEGER NOT NULL,
-                from_nick TEXT NOT NULL,
-                to_nick TEXT NOT NULL,
-                message_text TEXT,
-                message_type TEXT DEFAULT 'text',
-                file_id TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (chat_id) REFERENCES chats (chat_id),
-                FOREIGN KEY (from_user) REFERENCES users (user_id),
-                FOREIGN KEY (to_user) REFERENCES users (user_id)
-            )
-        ''')
-        
-        # Таблица статистики по дням
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date DATE UNIQUE NOT NULL,
-                total_messages INTEGER DEFAULT 0,
-                total_chats INTEGER DEFAULT 0,
-                new_users INTEGER DEFAULT 0,
-                active_users INTEGER DEFAULT 0
-            )
-        ''')
-        
-        # Таблица статистики по районам
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS district_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                district TEXT NOT NULL,
-                user_count INTEGER DEFAULT 0,
-                online_now INTEGER DEFAULT 0,
-                UNIQUE(district)
-            )
-        ''')
-        
-        # Таблица для логов действий админов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS admin_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                admin_id INTEGER NOT NULL,
-                action TEXT NOT NULL,
-                target_id INTEGER,
-                details TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-        logger.info("База данных инициализирована")
+        try:
+            version = apply_migrations(conn)
+            self.has_fts = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+            ).fetchone() is not None
+        finally:
+            conn.close()
+        logger.info(f"База данных инициализирована (схема v{version})")
     
     # ===== ПОЛЬЗОВАТЕЛИ =====
     def add_user(self, user_id: int, nickname: str, district: str = "🏛️ Центральный"):
@@ -150,6 +193,8 @@ class Database:
                 INSERT OR IGNORE INTO users (user_id, nickname, district, join_date, last_activity)
                 VALUES (?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
             ''', (user_id, nickname, district))
+            if cursor.rowcount == 1:
+                daily_stats.bump(cursor, new_users=1, active_users=1)
             
             cursor.execute('''
                 INSERT OR IGNORE INTO ratings (user_id, likes, dislikes, rating)
@@ -165,6 +210,7 @@ class Database:
             ''', (district,))
             
             conn.commit()
+            self.profiles.invalidate(user_id)
             return True
         except Exception as e:
             logger.error(f"Error adding user: {e}")
@@ -173,6 +219,11 @@ class Database:
             conn.close()
     
     def get_user(self, user_id: int):
+        """Профиль пользователя с рейтингом (через кеш профилей)"""
+        user = self.profiles.get(user_id)
+        if user is not None:
+            return user
+        
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
@@ -183,8 +234,33 @@ class Database:
         ''', (user_id,))
         user = cursor.fetchone()
         conn.close()
+        if user is not None:
+            self.profiles.put(user_id, user)
         return user
     
+    def find_users_by_nickname(self, text: str):
+        """Поиск пользователей по части ника"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.*, r.likes, r.dislikes, r.rating, r.banned, r.ban_reason
+            FROM users u
+            LEFT JOIN ratings r ON u.user_id = r.user_id
+            WHERE u.nickname LIKE ?
+            ORDER BY u.last_activity DESC
+        ''', (f'%{text}%',))
+        users = cursor.fetchall()
+        conn.close()
+        return users
+    
+    def get_all_user_ids(self):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id FROM users')
+        user_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return user_ids
+    
     def update_user_district(self, user_id: int, new_district: str):
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -215,16 +291,25 @@ class Database:
         ''', (new_district,))
         
         conn.commit()
+        self.profiles.invalidate(user_id)
         conn.close()
     
     def update_user_activity(self, user_id: int):
         conn = self.get_connection()
         cursor = conn.cursor()
+        # Первая активность за день попадает в дневную статистику
+        cursor.execute('''
+            SELECT last_activity >= DATE('now') FROM users WHERE user_id = ?
+        ''', (user_id,))
+        row = cursor.fetchone()
+        if row is not None and not row[0]:
+            daily_stats.bump(cursor, active_users=1)
         cursor.execute('''
             UPDATE users SET last_activity = CURRENT_TIMESTAMP
             WHERE user_id = ?
         ''', (user_id,))
         conn.commit()
+        self.profiles.invalidate(user_id)
         conn.close()
     
     def update_nickname(self, user_id: int, new_nick: str):
@@ -234,6 +319,7 @@ class Database:
             UPDATE users SET nickname = ? WHERE user_id = ?
         ''', (new_nick, user_id))
         conn.commit()
+        self.profiles.invalidate(user_id)
         conn.close()
     
     def toggle_anon_mode(self, user_id: int):
@@ -243,50 +329,42 @@ class Database:
             UPDATE users SET anon_mode = NOT anon_mode WHERE user_id = ?
         ''', (user_id,))
         conn.commit()
+        self.profiles.invalidate(user_id)
         conn.close()
     
     # ===== РЕЙТИНГ И БАНЫ =====
-    def update_rating(self, user_id: int, is_like: bool):
+    def cast_vote(self, chat_id: int, voter_id: int, target_id: int, is_like: bool) -> bool:
+        """Записывает оценку в журнал. False - оценка за этот чат уже есть.
+        
+        Рейтинг меняется не сразу, а при следующем flush_votes.
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
-        
-        if is_like:
-            cursor.execute('''
-                UPDATE ratings SET likes = likes + 1 WHERE user_id = ?
-            ''', (user_id,))
-        else:
-            cursor.execute('''
-                UPDATE ratings SET dislikes = dislikes + 1 WHERE user_id = ?
-            ''', (user_id,))
-        
-        cursor.execute('''
-            UPDATE ratings 
-            SET rating = (likes * 100.0 / (likes + dislikes))
-            WHERE user_id = ? AND (likes + dislikes) > 0
-        ''', (user_id,))
-        
-        cursor.execute('''
-            SELECT likes, dislikes, rating FROM ratings WHERE user_id = ?
-        ''', (user_id,))
-        data = cursor.fetchone()
-        
-        if data and data['dislikes'] >= 30 and data['rating'] < 50:
-            cursor.execute('''
-                UPDATE ratings SET banned = 1, ban_date = CURRENT_TIMESTAMP, ban_reason = 'Автоматический бан (30+ дизлайков)'
-                WHERE user_id = ?
-            ''', (user_id,))
-            logger.info(f"User {user_id} banned automatically")
-        
+        recorded = votes.record(cursor, chat_id, voter_id, target_id, is_like)
         conn.commit()
         conn.close()
+        return recorded
     
-    def check_banned(self, user_id: int) -> bool:
+    def flush_votes(self) -> list:
+        """Применяет накопленные оценки одной транзакцией, возвращает id новых автобанов"""
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT banned FROM ratings WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return bool(result and result['banned'] == 1)
+        try:
+            touched, banned = votes.aggregate(conn.cursor())
+            conn.commit()
+        finally:
+            conn.close()
+        for user_id in banned:
+            self.moderation.ban(user_id)
+            logger.info(f"User {user_id} banned automatically")
+        if touched:
+            self.profiles.invalidate(*touched)
+        if banned:
+            self.stats_snapshot.invalidate()
+        return banned
+    
+    def check_banned(self, user_id: int) -> bool:
+        # Баны синхронизируются в индексе модерации, БД не нужна
+        return self.moderation.is_banned(user_id)
     
     def ban_user(self, user_id: int, reason: str = "Нарушение правил"):
         conn = self.get_connection()
@@ -296,6 +374,9 @@ class Database:
             WHERE user_id = ?
         ''', (reason, user_id))
         conn.commit()
+        self.moderation.ban(user_id)
+        self.profiles.invalidate(user_id)
+        self.stats_snapshot.invalidate()
         conn.close()
     
     def unban_user(self, user_id: int):
@@ -303,7 +384,18 @@ class Database:
         cursor = conn.cursor()
         cursor.execute('UPDATE ratings SET banned = 0, ban_date = NULL, ban_reason = NULL WHERE user_id = ?', (user_id,))
         conn.commit()
+        self.moderation.unban(user_id)
+        self.profiles.invalidate(user_id)
+        self.stats_snapshot.invalidate()
+        conn.close()
+    
+    def get_banned_ids(self):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id FROM ratings WHERE banned = 1')
+        user_ids = [row[0] for row in cursor.fetchall()]
         conn.close()
+        return user_ids
     
     def get_banned_users(self):
         conn = self.get_connection()
@@ -343,6 +435,7 @@ class Database:
             VALUES (?, ?)
         ''', (user_id, blocked_id))
         conn.commit()
+        self.moderation.block(user_id, blocked_id)
         conn.close()
     
     def remove_from_blacklist(self, user_id: int, blocked_id: int):
@@ -352,6 +445,7 @@ class Database:
             DELETE FROM blacklist WHERE user_id = ? AND blocked_id = ?
         ''', (user_id, blocked_id))
         conn.commit()
+        self.moderation.unblock(user_id, blocked_id)
         conn.close()
     
     def get_blacklist(self, user_id: int):
@@ -368,15 +462,78 @@ class Database:
         conn.close()
         return blacklist
     
-    def is_blocked(self, user_id: int, target_id: int) -> bool:
+    def get_blacklist_pairs(self):
+        """Все пары (кто заблокировал, кого) из черных списков"""
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT 1 FROM blacklist WHERE user_id = ? AND blocked_id = ?
-        ''', (user_id, target_id))
-        result = cursor.fetchone()
+        cursor.execute('SELECT user_id, blocked_id FROM blacklist')
+        pairs = [tuple(row) for row in cursor.fetchall()]
         conn.close()
-        return bool(result)
+        return pairs
+    
+    def is_blocked(self, user_id: int, target_id: int) -> bool:
+        return self.moderation.is_blocked(user_id, target_id)
+    
+    def get_moderation_version(self) -> int:
+        """Счетчик изменений банов и ЧС (ведется триггерами)"""
+        conn = self.get_connection()
+        try:
+            return conn.execute('SELECT version FROM moderation_version WHERE id = 1').fetchone()[0]
+        finally:
+            conn.close()
+    
+    def load_moderation(self):
+        """Загружает баны и черные списки в индекс модерации"""
+        # Версия читается до данных: изменение между ними вызовет еще одну загрузку
+        self.moderation_version = self.get_moderation_version()
+        self.moderation.load(self.get_banned_ids(), self.get_blacklist_pairs())
+        logger.info(f"Индекс модерации: {len(self.moderation.banned)} банов, {len(self.moderation)} записей ЧС")
+    
+    def sync_moderation(self) -> bool:
+        """Перечитывает индекс модерации, если баны или ЧС изменил другой процесс.
+        
+        Нужен при общем состоянии нескольких процессов бота: у каждого
+        свой ModerationIndex. Профили тех, чей бан изменился, сбрасываются.
+        """
+        if self.get_moderation_version() == self.moderation_version:
+            return False
+        banned = set(self.moderation.banned)
+        self.load_moderation()
+        changed = banned ^ self.moderation.banned
+        if changed:
+            self.profiles.invalidate(*changed)
+            self.stats_snapshot.invalidate()
+        return True
+    
+    def get_profile_seq(self) -> int:
+        """Номер последней записи журнала изменений профилей (ведется триггером)"""
+        conn = self.get_connection()
+        try:
+            return conn.execute('SELECT MAX(seq) FROM profile_changes').fetchone()[0] or 0
+        finally:
+            conn.close()
+    
+    def sync_profiles(self) -> int:
+        """Сбрасывает профили, которые изменил другой процесс.
+        
+        Нужен при общем состоянии нескольких процессов бота: ник, район
+        и анонимность из кеша профилей попадают в контексты пересылки,
+        и без сброса собеседник видел бы старые данные. Возвращает число
+        сброшенных профилей.
+        """
+        conn = self.get_connection()
+        try:
+            rows = conn.execute(
+                'SELECT seq, user_id FROM profile_changes WHERE seq > ? ORDER BY seq', (self.profile_seq,)
+            ).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return 0
+        self.profile_seq = rows[-1][0]
+        changed = {row[1] for row in rows}
+        self.profiles.invalidate(*changed)
+        return len(changed)
     
     # ===== ЧАТЫ И СООБЩЕНИЯ =====
     def create_chat(self, chat_id: str, user1_id: int, user2_id: int, user1_nick: str, user2_nick: str, district: str = None):
@@ -386,6 +543,8 @@ class Database:
             INSERT INTO chats (chat_id, user1_id, user2_id, user1_nick, user2_nick, district, start_time)
             VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
         ''', (chat_id, user1_id, user2_id, user1_nick, user2_nick, district))
+        chat_id_db = cursor.lastrowid
+        daily_stats.bump(cursor, total_chats=1)
         
         cursor.execute('''
             UPDATE users SET total_chats = total_chats + 1
@@ -398,8 +557,8 @@ class Database:
                 WHERE user_id IN (?, ?) AND district = ?
             ''', (user1_id, user2_id, district))
         
-        chat_id_db = cursor.lastrowid
         conn.commit()
+        self.profiles.invalidate(user1_id, user2_id)
         conn.close()
         return chat_id_db
     
@@ -409,11 +568,19 @@ class Database:
         cursor.execute('''
             UPDATE chats SET end_time = CURRENT_TIMESTAMP
             WHERE chat_id = ? AND end_time IS NULL
+            RETURNING id
         ''', (chat_id,))
+        rows = cursor.fetchall()
         conn.commit()
         conn.close()
+        # Числовой id чата - для журнала оценок
+        return rows[0][0] if rows else None
     
     def save_message(self, chat_id: str, from_user: int, to_user: int, from_nick: str, to_nick: str, text: str = None, msg_type: str = "text", file_id: str = None):
+        if self.journal:
+            self.journal.append(chat_id, from_user, to_user, from_nick, to_nick, text, msg_type, file_id)
+            return
+        
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
@@ -433,42 +600,76 @@ class Database:
             WHERE user_id = ?
         ''', (from_user,))
         
+        daily_stats.bump(cursor, total_messages=1)
         conn.commit()
         conn.close()
     
-    def search_messages(self, search_text: str, limit: int = 50):
-        """Поиск сообщений по тексту"""
+    def flush_messages(self):
+        """Дописывает в БД сообщения из буфера перед чтением"""
+        if self.journal:
+            self.journal.flush()
+    
+    def search_messages(self, search_text: str, limit: int = 50, offset: int = 0, include_archive: bool = False):
+        """Поиск сообщений по тексту (FTS5 с ранжированием, иначе LIKE).
+        
+        С include_archive после основной таблицы просматриваются архивы
+        от новых месяцев к старым, пока не наберется offset + limit.
+        """
+        self.flush_messages()
         conn = self.get_connection()
         cursor = conn.cursor()
         try:
-            cursor.execute('''
-                SELECT m.*, c.user1_nick, c.user2_nick, c.start_time as chat_start
-                FROM messages m
-                JOIN chats c ON m.chat_id = c.chat_id
-                WHERE m.message_text LIKE ?
-                ORDER BY m.timestamp DESC
-                LIMIT ?
-            ''', (f'%{search_text}%', limit))
-            messages = cursor.fetchall()
-            return messages
+            wanted = offset + limit
+            messages = self._search_in(cursor, 'main', self.has_fts, search_text, wanted)
+            if include_archive:
+                for month in archive.months(cursor):
+                    if len(messages) >= wanted:
+                        break
+                    if not archive.attach(conn, archive.archive_path(self.db_name, month)):
+                        continue
+                    try:
+                        messages += self._search_in(cursor, archive.SCHEMA, archive.has_fts(conn),
+                                                    search_text, wanted - len(messages))
+                    finally:
+                        archive.detach(conn)
+            return messages[offset:wanted]
         except Exception as e:
             logger.error(f"Error searching messages: {e}")
             return []
         finally:
             conn.close()
     
-    def get_user_chats(self, user_id: int, limit: int = 20):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM chats 
-            WHERE user1_id = ? OR user2_id = ?
-            ORDER BY start_time DESC
-            LIMIT ?
-        ''', (user_id, user_id, limit))
-        chats = cursor.fetchall()
-        conn.close()
-        return chats
+    def _search_in(self, cursor, schema: str, fts: bool, search_text: str, limit: int):
+        """Поиск по таблице messages схемы schema (main или подключенный архив)"""
+        query = fts_query(search_text) if fts else None
+        if query:
+            # Ранжируем только последние совпадения, иначе частое слово
+            # заставит считать bm25 по всей истории
+            window = max(SEARCH_RANK_WINDOW, limit)
+            cursor.execute(f'''
+                WITH hits AS (
+                    SELECT rowid, rank FROM {schema}.messages_fts
+                    WHERE messages_fts MATCH ?
+                    ORDER BY rowid DESC
+                    LIMIT ?
+                )
+                SELECT m.*, c.user1_nick, c.user2_nick, c.start_time as chat_start
+                FROM hits h
+                JOIN {schema}.messages m ON m.id = h.rowid
+                JOIN main.chats c ON m.chat_id = c.chat_id
+                ORDER BY h.rank, m.timestamp DESC
+                LIMIT ?
+            ''', (query, window, limit))
+        else:
+            cursor.execute(f'''
+                SELECT m.*, c.user1_nick, c.user2_nick, c.start_time as chat_start
+                FROM {schema}.messages m
+                JOIN main.chats c ON m.chat_id = c.chat_id
+                WHERE m.message_text LIKE ?
+                ORDER BY m.timestamp DESC
+                LIMIT ?
+            ''', (f'%{search_text}%', limit))
+        return cursor.fetchall()
     
     # ===== РАЙОНЫ И СТАТИСТИКА =====
     def get_district_stats(self):
@@ -483,33 +684,14 @@ class Database:
         conn.close()
         return stats
     
-    def update_online_status(self, user_id: int, is_online: bool):
-        """Обновляет онлайн статус пользователя"""
+    def set_online_counts(self, online_by_district: dict):
+        """Перезаписывает онлайн-счетчики всех районов"""
         conn = self.get_connection()
         cursor = conn.cursor()
-        
-        # Получаем район пользователя
-        cursor.execute('SELECT district FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        
-        if not user:
-            conn.close()
-            return
-        
-        district = user[0]
-        
-        if is_online:
-            cursor.execute('''
-                UPDATE district_stats SET online_now = online_now + 1
-                WHERE district = ?
-            ''', (district,))
-        else:
-            cursor.execute('''
-                UPDATE district_stats SET online_now = 
-                    CASE WHEN online_now > 0 THEN online_now - 1 ELSE 0 END
-                WHERE district = ?
-            ''', (district,))
-        
+        cursor.execute('UPDATE district_stats SET online_now = 0')
+        cursor.executemany('''
+            UPDATE district_stats SET online_now = ? WHERE district = ?
+        ''', [(count, district) for district, count in online_by_district.items()])
         conn.commit()
         conn.close()
     
@@ -540,79 +722,70 @@ class Database:
     
     # ===== СТАТИСТИКА =====
     def update_daily_stats(self):
-        today = datetime.datetime.now().date()
+        """Счетчики за сегодня (ведутся инкрементально, см. daily_stats)"""
+        self.flush_messages()
         conn = self.get_connection()
         cursor = conn.cursor()
         
         cursor.execute('''
-            INSERT OR IGNORE INTO stats (date) VALUES (?)
-        ''', (today,))
-        
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM users 
-            WHERE DATE(join_date) = ?
-        ''', (today,))
-        new_users = cursor.fetchone()['count']
-        
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM users 
-            WHERE DATE(last_activity) = ?
-        ''', (today,))
-        active_users = cursor.fetchone()['count']
-        
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM messages 
-            WHERE DATE(timestamp) = ?
-        ''', (today,))
-        messages = cursor.fetchone()['count']
-        
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM chats 
-            WHERE DATE(start_time) = ?
-        ''', (today,))
-        chats = cursor.fetchone()['count']
-        
+            INSERT OR IGNORE INTO stats (date) VALUES (DATE('now'))
+        ''')
         cursor.execute('''
-            UPDATE stats SET 
-                total_messages = ?,
-                total_chats = ?,
-                new_users = ?,
-                active_users = ?
-            WHERE date = ?
-        ''', (messages, chats, new_users, active_users, today))
-        
+            SELECT date, total_messages, total_chats, new_users, active_users
+            FROM stats WHERE date = DATE('now')
+        ''')
+        row = cursor.fetchone()
         conn.commit()
         conn.close()
         
         return {
-            'date': today,
-            'messages': messages,
-            'chats': chats,
-            'new_users': new_users,
-            'active_users': active_users
+            'date': row['date'],
+            'messages': row['total_messages'],
+            'chats': row['total_chats'],
+            'new_users': row['new_users'],
+            'active_users': row['active_users']
         }
     
-    def get_all_stats(self):
+    def backfill_daily_stats(self):
+        """Пересчитывает таблицу stats по всем таблицам (ручное выравнивание)"""
+        self.flush_messages()
         conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) as count FROM users')
-        total_users = cursor.fetchone()['count']
-        
-        cursor.execute('SELECT COUNT(*) as count FROM users WHERE DATE(last_activity) = DATE("now")')
-        active_today = cursor.fetchone()['count']
+        try:
+            cursor = conn.cursor()
+            # Архивы читаются до транзакции: ATTACH внутри нее невозможен
+            archived = Counter()
+            for month in archive.months(cursor):
+                for day, count in archive.count_by_day(conn, archive.archive_path(self.db_name, month)):
+                    archived[day] += count
+            daily_stats.backfill(cursor)
+            for day, count in archived.items():
+                daily_stats.bump(cursor, day, total_messages=count)
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def get_all_stats(self):
+        """Сводка для админ-панели из счетчиков totals и таблицы stats.
         
-        cursor.execute('SELECT COUNT(*) as count FROM messages')
-        total_messages = cursor.fetchone()['count']
+        Результат живет stats_ttl секунд, чтобы частые нажатия в
+        админке не ходили в БД.
+        """
+        snapshot = self.stats_snapshot.get()
+        if snapshot is not None:
+            return snapshot
         
-        cursor.execute('SELECT COUNT(*) as count FROM chats')
-        total_chats = cursor.fetchone()['count']
+        self.flush_messages()
+        conn = self.get_connection()
+        cursor = conn.cursor()
         
-        cursor.execute('SELECT COUNT(*) as count FROM ratings WHERE banned = 1')
-        banned_users = cursor.fetchone()['count']
+        totals = aggregates.read(cursor)
+        archived = archive.archived_count(cursor)
         
-        cursor.execute('SELECT COUNT(*) as count FROM blacklist')
-        total_blacklists = cursor.fetchone()['count']
+        # Активные за сегодня уже посчитаны в дневной статистике
+        cursor.execute('''
+            SELECT active_users FROM stats WHERE date = DATE('now')
+        ''')
+        today = cursor.fetchone()
         
         cursor.execute('''
             SELECT * FROM stats ORDER BY date DESC LIMIT 7
@@ -621,71 +794,245 @@ class Database:
         
         conn.close()
         
-        return {
-            'total_users': total_users,
-            'active_today': active_today,
-            'total_messages': total_messages,
-            'total_chats': total_chats,
-            'banned_users': banned_users,
-            'total_blacklists': total_blacklists,
+        stats = {
+            'total_users': totals.get('users', 0),
+            'active_today': today['active_users'] if today else 0,
+            'total_messages': totals.get('messages', 0) + archived,
+            'total_chats': totals.get('chats', 0),
+            'banned_users': totals.get('banned', 0),
+            'total_blacklists': totals.get('blacklist', 0),
             'daily_stats': daily_stats
         }
+        self.stats_snapshot.put(stats)
+        return stats
+    
+    def check_totals(self, fix: bool = False) -> dict:
+        """Сверяет счетчики totals с исходными таблицами.
+        
+        Возвращает расхождения {счетчик: (сохранено, на самом деле)};
+        при fix=True расходящиеся счетчики пересчитываются.
+        """
+        self.flush_messages()
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            mismatches = aggregates.check(cursor)
+            if fix and mismatches:
+                aggregates.recount(cursor, mismatches)
+                conn.commit()
+                self.stats_snapshot.invalidate()
+                logger.warning(f"Счетчики totals пересчитаны: {mismatches}")
+            return mismatches
+        finally:
+            conn.close()
     
-    def get_user_details(self, user_id: int):
+    def get_user_details(self, user_id: int, chats_limit: int = 5, blacklist_limit: int = 5):
+        """Карточка пользователя для админки одним запросом.
+        
+        Число чатов и сообщений берется из счетчиков в users, остальное -
+        подзапросами по индексам. Последние чаты (с ником собеседника) и
+        черный список возвращаются списками словарей.
+        """
+        self.flush_messages()
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # Чаты выбираются двумя индексными поисками вместо OR по user1/user2
         cursor.execute('''
-            SELECT u.*, r.likes, r.dislikes, r.rating, r.banned, r.ban_date, r.ban_reason
+            SELECT u.*, r.likes, r.dislikes, r.rating, r.banned, r.ban_date, r.ban_reason,
+                (SELECT COUNT(*) FROM blacklist WHERE user_id = :uid) AS blacklist_count,
+                (SELECT COUNT(*) FROM blacklist WHERE blocked_id = :uid) AS blocked_by_count,
+                (SELECT json_group_array(json_object(
+                    'chat_id', chat_id, 'start_time', start_time,
+                    'message_count', message_count, 'partner_nick', partner_nick))
+                 FROM (
+                    SELECT * FROM (
+                        SELECT chat_id, start_time, message_count, user2_nick AS partner_nick
+                        FROM chats WHERE user1_id = :uid
+                        ORDER BY start_time DESC LIMIT :chats
+                    )
+                    UNION ALL
+                    SELECT * FROM (
+                        SELECT chat_id, start_time, message_count, user1_nick AS partner_nick
+                        FROM chats WHERE user2_id = :uid
+                        ORDER BY start_time DESC LIMIT :chats
+                    )
+                    ORDER BY start_time DESC LIMIT :chats
+                 )) AS recent_chats,
+                (SELECT json_group_array(json_object(
+                    'blocked_id', blocked_id, 'nickname', nickname,
+                    'district', district, 'rating', rating))
+                 FROM (
+                    SELECT b.blocked_id, bu.nickname, bu.district, br.rating
+                    FROM blacklist b
+                    JOIN users bu ON b.blocked_id = bu.user_id
+                    LEFT JOIN ratings br ON b.blocked_id = br.user_id
+                    WHERE b.user_id = :uid
+                    LIMIT :blacklist
+                 )) AS blacklist
             FROM users u
             LEFT JOIN ratings r ON u.user_id = r.user_id
-            WHERE u.user_id = ?
-        ''', (user_id,))
+            WHERE u.user_id = :uid
+        ''', {'uid': user_id, 'chats': chats_limit, 'blacklist': blacklist_limit})
         user = cursor.fetchone()
+        conn.close()
         
-        if user:
-            cursor.execute('''
-                SELECT COUNT(*) as count FROM chats 
-                WHERE user1_id = ? OR user2_id = ?
-            ''', (user_id, user_id))
-            chats_count = cursor.fetchone()['count']
-            
-            cursor.execute('''
-                SELECT COUNT(*) as count FROM messages 
-                WHERE from_user = ?
-            ''', (user_id,))
-            messages_count = cursor.fetchone()['count']
-            
-            cursor.execute('''
-                SELECT COUNT(*) as count FROM blacklist WHERE user_id = ?
-            ''', (user_id,))
-            blacklist_count = cursor.fetchone()['count']
-            
-            cursor.execute('''
-                SELECT COUNT(*) as count FROM blacklist WHERE blocked_id = ?
-            ''', (user_id,))
-            blocked_by_count = cursor.fetchone()['count']
-            
-            cursor.execute('''
-                SELECT chat_id, start_time, message_count FROM chats 
-                WHERE user1_id = ? OR user2_id = ?
-                ORDER BY start_time DESC
-                LIMIT 5
-            ''', (user_id, user_id))
-            recent_chats = cursor.fetchall()
-            
-            result = dict(user)
-            result['total_chats'] = chats_count
-            result['total_messages'] = messages_count
-            result['blacklist_count'] = blacklist_count
-            result['blocked_by_count'] = blocked_by_count
-            result['recent_chats'] = recent_chats
-            
+        if not user:
+            return None
+        
+        result = dict(user)
+        result['recent_chats'] = json.loads(user['recent_chats'])
+        result['blacklist'] = json.loads(user['blacklist'])
+        return result
+    
+    # ===== АРХИВ СООБЩЕНИЙ =====
+    def archive_messages(self, max_batches: int = ARCHIVE_MAX_BATCHES) -> int:
+        """Переносит сообщения старше message_retention_days в помесячные архивы.
+        
+        Каждая пачка из archive_batch_size сообщений - отдельная короткая
+        транзакция, запись остальных потоков ждет не дольше одной пачки.
+        После переноса часть освободившегося места возвращается ОС через
+        incremental_vacuum. Возвращает число перенесенных сообщений.
+        """
+        if self.message_retention_days <= 0:
+            return 0
+        conn = self.get_connection()
+        try:
+            cutoff = conn.execute(
+                "SELECT DATE('now', ?)", (f'-{self.message_retention_days} days',)
+            ).fetchone()[0]
+            moved = 0
+            for _ in range(max_batches):
+                count = archive.move_batch(conn, self.db_name, cutoff, self.archive_batch_size, self.has_fts)
+                if not count:
+                    break
+                moved += count
+            if moved:
+                freed = archive.reclaim(conn, ARCHIVE_VACUUM_PAGES)
+                self.stats_snapshot.invalidate()
+                logger.info(f"В архив перенесено {moved} сообщений старше {cutoff}, освобождено страниц: {freed}")
+            return moved
+        finally:
+            conn.close()
+    
+    def enable_incremental_vacuum(self) -> bool:
+        """Разовый перевод БД в auto_vacuum = INCREMENTAL (команда /vacuum).
+        
+        Нужен для возврата места после архивации. Режим у существующей
+        БД меняется только полным VACUUM: он переписывает файл целиком
+        и на это время блокирует запись. Возвращает False, если режим
+        уже включен.
+        """
+        conn = self.get_connection()
+        try:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == archive.INCREMENTAL:
+                return False
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+            logger.info("БД переведена в auto_vacuum = INCREMENTAL")
+            return True
+        finally:
             conn.close()
-            return result
+    
+    # ===== РАССЫЛКИ =====
+    def create_broadcast(self, admin_id: int, text: str, chat_id: int = None, message_id: int = None,
+                         owner: str = None, lease_until: float = None):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*) as count FROM users u
+            LEFT JOIN ratings r ON u.user_id = r.user_id
+            WHERE COALESCE(r.banned, 0) = 0
+        ''')
+        total = cursor.fetchone()['count']
+        cursor.execute('''
+            INSERT INTO broadcasts (admin_id, text, total, chat_id, message_id, owner, lease_until)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (admin_id, text, total, chat_id, message_id, owner, lease_until))
+        broadcast_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return broadcast_id
+    
+    def get_broadcast(self, broadcast_id: int):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
+        broadcast = cursor.fetchone()
+        conn.close()
+        return broadcast
+    
+    def claim_broadcasts(self, owner: str, lease_until: float, now: float):
+        """Забирает запущенные рассылки без живого владельца (аренда истекла).
+        
+        Свои рассылки владельца тоже возвращаются, с продленной арендой.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE broadcasts SET owner = ?, lease_until = ?
+            WHERE status = 'running' AND (owner IS ? OR COALESCE(lease_until, 0) < ?)
+            RETURNING *
+        ''', (owner, lease_until, owner, now))
+        broadcasts = sorted(cursor.fetchall(), key=lambda row: row['id'])
+        conn.commit()
+        conn.close()
+        return broadcasts
+    
+    def release_broadcasts(self, owner: str):
+        """Отдает аренду рассылок владельца (при остановке процесса)"""
+        conn = self.get_connection()
+        conn.execute('''
+            UPDATE broadcasts SET lease_until = NULL WHERE owner = ? AND status = 'running'
+        ''', (owner,))
+        conn.commit()
+        conn.close()
+    
+    def request_broadcast_stop(self, broadcast_id: int) -> bool:
+        """Просит владельца рассылки (в любом процессе) остановить ее"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE broadcasts SET stop_requested = 1 WHERE id = ? AND status = 'running'
+        ''', (broadcast_id,))
+        requested = cursor.rowcount > 0
+        conn.commit()
+        conn.close()
+        return requested
+    
+    def get_broadcast_recipients(self, after_user_id: int = 0, limit: int = 500):
+        """Следующая страница получателей рассылки (без забаненных)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.user_id FROM users u
+            LEFT JOIN ratings r ON u.user_id = r.user_id
+            WHERE u.user_id > ? AND COALESCE(r.banned, 0) = 0
+            ORDER BY u.user_id
+            LIMIT ?
+        ''', (after_user_id, limit))
+        user_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return user_ids
+    
+    def update_broadcast(self, broadcast_id: int, sent: int, failed: int, last_user_id: int, status: str = 'running',
+                         owner: str = None, lease_until: float = None):
+        """Сохраняет прогресс рассылки и продлевает аренду владельца.
         
+        Возвращает stop_requested или None, если рассылку уже забрал другой процесс.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE broadcasts SET sent = ?, failed = ?, last_user_id = ?, status = ?, lease_until = ?,
+                finished_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END
+            WHERE id = ? AND owner IS ?
+            RETURNING stop_requested
+        ''', (sent, failed, last_user_id, status, lease_until, status, broadcast_id, owner))
+        rows = cursor.fetchall()
+        conn.commit()
         conn.close()
-        return None
+        return bool(rows[0][0]) if rows else None
     
     # ===== ЛОГИ АДМИНОВ =====
     def log_admin_action(self, admin_id: int, action: str, target_id: int = None, details: str = None):
@@ -708,4 +1055,54 @@ class Database:
         ''', (limit,))
         logs = cursor.fetchall()
         conn.close()
-        return logs
\ No newline at end of file
+        return logs
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database.
+    
+    Те же методы, что у Database, но как корутины: запросы выполняются
+    в отдельном пуле потоков БД и не блокируют event loop.
+    """
+    
+    def __init__(self, database: Database, workers: int = None):
+        self.sync = database
+        if workers is None:
+            workers = database.pool.size if database.pool else 1
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="db")
+    
+    def __getattr__(self, name):
+        attr = getattr(self.sync, name)
+        if not callable(attr):
+            return attr
+        
+        async def method(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(attr, *args, **kwargs))
+        
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        setattr(self, name, method)
+        return method
+    
+    async def check_banned(self, user_id: int) -> bool:
+        # Ответ из индекса в памяти - пул потоков не нужен
+        return self.sync.check_banned(user_id)
+    
+    async def is_blocked(self, user_id: int, target_id: int) -> bool:
+        return self.sync.is_blocked(user_id, target_id)
+    
+    async def save_message(self, *args, **kwargs):
+        """С журналом сообщение только кладется в буфер - без пула потоков"""
+        if self.sync.journal:
+            return self.sync.save_message(*args, **kwargs)
+        return await self.run(self.sync.save_message, *args, **kwargs)
+    
+    async def run(self, func, *args, **kwargs):
+        """Выполняет произвольную функцию в потоке БД"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+    
+    async def close(self):
+        """Дожидается выполнения запросов и закрывает соединения"""
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+        self.sync.close()
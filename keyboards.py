@@ -1,15 +1,49 @@
+import functools
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from config import TYUMEN_DISTRICTS
+from callbacks import DistrictCallback, ChangeDistrictCallback, BlacklistCallback, RateCallback
 
+def static(build):
+    """Клавиатура без параметров строится один раз, дальше отдается тот же объект.
+    
+    build возвращает строки кнопок. Объект общий для всех сообщений,
+    менять его нельзя - для другой клавиатуры нужна своя функция.
+    """
+    markup = None
+    
+    @functools.wraps(build)
+    def keyboard():
+        nonlocal markup
+        if markup is None:
+            markup = InlineKeyboardMarkup(inline_keyboard=build())
+        return markup
+    
+    return keyboard
+
+def _district_rows(factory, back: str):
+    buttons = []
+    row = []
+    for i, district in enumerate(TYUMEN_DISTRICTS, 1):
+        row.append(InlineKeyboardButton(text=district, callback_data=factory(index=i).pack()))
+        if len(row) == 2:
+            buttons.append(row)
+            row = []
+    if row:
+        buttons.append(row)
+    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data=back)])
+    return buttons
+
+@static
 def search_menu_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
+    return [
         [InlineKeyboardButton(text="🌍 По всей Тюмени", callback_data="search_all")],
         [InlineKeyboardButton(text="🏘️ В моем районе", callback_data="search_district")],
         [InlineKeyboardButton(text="◀️ Назад", callback_data="menu")]
-    ])
+    ]
 
+@static
 def main_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
+    return [
         [InlineKeyboardButton(text="🔍 Найти собеседника", callback_data="search_menu")],
         [
             InlineKeyboardButton(text="🗺️ Районы Тюмени", callback_data="districts_menu"),
@@ -19,50 +53,35 @@ def main_menu():
             InlineKeyboardButton(text="⚙️ Настройки", callback_data="settings"),
             InlineKeyboardButton(text="🚫 Черный список", callback_data="blacklist")
         ]
-    ])
+    ]
 
+@static
 def districts_keyboard():
-    buttons = []
-    row = []
-    for i, district in enumerate(TYUMEN_DISTRICTS, 1):
-        row.append(InlineKeyboardButton(text=district, callback_data=f"district_{i}"))
-        if len(row) == 2:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="menu")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return _district_rows(DistrictCallback, "menu")
 
+@static
 def settings_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
+    return [
         [InlineKeyboardButton(text="👤 Сменить ник", callback_data="change_nick")],
         [InlineKeyboardButton(text="🏘️ Сменить район", callback_data="change_district")],
         [InlineKeyboardButton(text="🕵️ Анонимный режим", callback_data="toggle_anon")],
         [InlineKeyboardButton(text="◀️ Назад", callback_data="menu")]
-    ])
+    ]
 
+@static
 def change_district_keyboard():
-    buttons = []
-    row = []
-    for i, district in enumerate(TYUMEN_DISTRICTS, 1):
-        row.append(InlineKeyboardButton(text=district, callback_data=f"change_district_{i}"))
-        if len(row) == 2:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="settings")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return _district_rows(ChangeDistrictCallback, "settings")
 
+@static
 def blacklist_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
+    return [
         [InlineKeyboardButton(text="📋 Показать черный список", callback_data="show_blacklist")],
         [InlineKeyboardButton(text="◀️ Назад", callback_data="menu")]
-    ])
+    ]
 
+@static
 def admin_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
+    return [
         [InlineKeyboardButton(text="📊 Полная статистика", callback_data="admin_stats")],
         [InlineKeyboardButton(text="👥 Онлайн пользователи", callback_data="admin_online")],
         [InlineKeyboardButton(text="🗺️ Статистика районов", callback_data="admin_districts")],
@@ -75,27 +94,39 @@ def admin_menu():
         [InlineKeyboardButton(text="📥 Скачать БД", callback_data="admin_getdb")],
         [InlineKeyboardButton(text="📋 Логи админов", callback_data="admin_logs")],
         [InlineKeyboardButton(text="◀️ Назад", callback_data="menu")]
-    ])
+    ]
 
+@static
 def cancel_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
+    return [
         [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")]
-    ])
+    ]
+
+@static
+def cancel_search_keyboard():
+    return [
+        [InlineKeyboardButton(text="❌ Отменить поиск", callback_data="cancel_search")]
+    ]
 
+@static
 def chat_actions():
-    return InlineKeyboardMarkup(inline_keyboard=[
+    return [
         [InlineKeyboardButton(text="🚫 Завершить чат", callback_data="stop")]
-    ])
+    ]
 
-def rating_keyboard(partner_id: int):
-    """Клавиатура для оценки после чата"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="👍 Лайк", callback_data=f"like_{partner_id}"),
-            InlineKeyboardButton(text="👎 Дизлайк", callback_data=f"dislike_{partner_id}")
-        ],
-        [
-            InlineKeyboardButton(text="🚫 В ЧС", callback_data=f"blacklist_add_{partner_id}"),
-            InlineKeyboardButton(text="🔍 Новый поиск", callback_data="search_menu")
-        ]
-    ])
\ No newline at end of file
+# Общая кнопка для всех клавиатур оценки
+_NEW_SEARCH = InlineKeyboardButton(text="🔍 Новый поиск", callback_data="search_menu")
+
+def rating_keyboard(partner_id: int, chat_row: int = None):
+    """Клавиатура для оценки после чата (без оценки, если id чата неизвестен)"""
+    rows = []
+    if chat_row is not None:
+        rows.append([
+            InlineKeyboardButton(text="👍", callback_data=RateCallback(target=partner_id, chat=chat_row, like=True).pack()),
+            InlineKeyboardButton(text="👎", callback_data=RateCallback(target=partner_id, chat=chat_row, like=False).pack())
+        ])
+    rows.append([
+        InlineKeyboardButton(text="🚫 В ЧС", callback_data=BlacklistCallback(action="add", user_id=partner_id).pack()),
+        _NEW_SEARCH
+    ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from moderation import ModerationIndex
+
+class MatchQueue:
+    """Очередь поиска собеседника с разбиением по районам.
+    
+    Постановка в очередь, отмена и выбор пары - O(1) (плюс пропуск
+    неподходящих кандидатов). Баны и черные списки проверяются по
+    ModerationIndex, поэтому подбор пары не обращается к БД.
+    """
+    
+    def __init__(self, moderation: ModerationIndex = None):
+        self._queue = OrderedDict()      # user_id -> район, общий порядок ожидания
+        self._by_district = {}           # район -> OrderedDict(user_id -> None)
+        self.moderation = moderation if moderation is not None else ModerationIndex()
+    
+    def __len__(self):
+        return len(self._queue)
+    
+    def __contains__(self, user_id):
+        return user_id in self._queue
+    
+    def __iter__(self):
+        return iter(list(self._queue))
+    
+    # ===== ОЧЕРЕДЬ =====
+    def enqueue(self, user_id: int, district: str):
+        if user_id in self._queue:
+            return
+        self._queue[user_id] = district
+        self._by_district.setdefault(district, OrderedDict())[user_id] = None
+    
+    def cancel(self, user_id: int) -> bool:
+        """Убирает пользователя из очереди, возвращает True если он там был"""
+        if user_id not in self._queue:
+            return False
+        district = self._queue.pop(user_id)
+        bucket = self._by_district[district]
+        del bucket[user_id]
+        if not bucket:
+            del self._by_district[district]
+        return True
+    
+    def find_partner(self, user_id: int, district: str = None):
+        """Находит первого подходящего собеседника и забирает его из очереди.
+        
+        Если указан район - ищет только среди ожидающих из этого района.
+        """
+        candidates = self._queue if district is None else self._by_district.get(district, ())
+        for uid in candidates:
+            if self.can_match(user_id, uid):
+                self.cancel(uid)
+                return uid
+        return None
+    
+    def match_or_enqueue(self, user_id: int, district: str, same_district: bool = False):
+        """Забирает собеседника из очереди, а если его нет - ставит в очередь.
+        
+        Возвращает id собеседника или None, если пользователь встал в очередь.
+        """
+        partner_id = self.find_partner(user_id, district if same_district else None)
+        if partner_id is None:
+            self.enqueue(user_id, district)
+        return partner_id
+    
+    def can_match(self, user_id: int, candidate_id: int) -> bool:
+        return self.moderation.can_match(user_id, candidate_id)
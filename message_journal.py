@@ -0,0 +1,131 @@
+import threading
+import datetime
+import logging
+from collections import Counter
+import daily_stats
+
+logger = logging.getLogger(__name__)
+
+# Сколько сообщений копится до записи и как долго они могут ждать (сек).
+# Это же граница потерь при аварийном завершении процесса.
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_FLUSH_INTERVAL = 0.5
+
+# Сколько раз подряд повторять запись пачки, прежде чем писать ее по одному
+# сообщению (сообщения, которые не пишутся и так, логируются и отбрасываются)
+MAX_FLUSH_RETRIES = 3
+
+class MessageJournal:
+    """Буфер сообщений с отложенной пакетной записью в БД.
+    
+    Сообщения копятся в памяти и пишутся одной транзакцией, когда их
+    набирается batch_size или проходит flush_interval секунд. Счетчики
+    чатов и пользователей обновляются одним UPDATE на чат/пользователя.
+    При аварийном завершении теряется не больше batch_size сообщений
+    за последние flush_interval секунд. Неудачная пачка повторяется
+    не больше MAX_FLUSH_RETRIES раз, поэтому буфер не растет без предела.
+    """
+    
+    def __init__(self, db, batch_size: int = DEFAULT_BATCH_SIZE, flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._failures = 0      # неудачных записей подряд
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="message-journal", daemon=True)
+        self._thread.start()
+    
+    def append(self, chat_id: str, from_user: int, to_user: int, from_nick: str, to_nick: str,
+               text: str = None, msg_type: str = "text", file_id: str = None):
+        # Время фиксируем в момент отправки, а не записи в БД
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            self._buffer.append((chat_id, from_user, to_user, from_nick, to_nick, text, msg_type, file_id, timestamp))
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            # Пишет фоновый поток, append никогда не блокируется на БД
+            self._wake.set()
+    
+    def pending(self) -> int:
+        return len(self._buffer)
+    
+    def flush(self) -> int:
+        """Записывает накопленные сообщения одной транзакцией, возвращает сколько записано"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return 0
+            
+            try:
+                self._write(batch)
+            except Exception as e:
+                self._failures += 1
+                logger.error(f"Error flushing {len(batch)} messages (attempt {self._failures}): {e}")
+                if self._failures < MAX_FLUSH_RETRIES:
+                    # Возвращаем пачку в начало буфера, чтобы повторить позже
+                    with self._lock:
+                        self._buffer[:0] = batch
+                    return 0
+                # Пачка не пишется несколько раз подряд - скорее всего, из-за
+                # одной плохой строки. Пишем по одной, чтобы она не держала остальные
+                return self._write_each(batch)
+            
+            self._failures = 0
+            return len(batch)
+    
+    def _write_each(self, batch: list) -> int:
+        written = 0
+        for row in batch:
+            try:
+                self._write([row])
+                written += 1
+            except Exception as e:
+                self.dropped += 1
+                logger.error(f"Message dropped after {MAX_FLUSH_RETRIES} failed flushes: {e}; row={row!r}")
+        self._failures = 0
+        return written
+    
+    def _write(self, batch: list):
+        chat_counts = Counter(row[0] for row in batch)
+        user_counts = Counter(row[1] for row in batch)
+        day_counts = Counter(row[8][:10] for row in batch)
+        
+        conn = self.db.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO messages (chat_id, from_user, to_user, from_nick, to_nick, message_text, message_type, file_id, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+            cursor.executemany('''
+                UPDATE chats SET message_count = message_count + ?
+                WHERE chat_id = ?
+            ''', [(count, chat_id) for chat_id, count in chat_counts.items()])
+            cursor.executemany('''
+                UPDATE users SET total_messages = total_messages + ?
+                WHERE user_id = ?
+            ''', [(count, user_id) for user_id, count in user_counts.items()])
+            for day, count in day_counts.items():
+                daily_stats.bump(cursor, day, total_messages=count)
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+    
+    def close(self):
+        """Останавливает фоновую запись и сбрасывает остаток буфера"""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self.flush()
@@ -0,0 +1,377 @@
+import time
+import sqlite3
+import logging
+import daily_stats
+import aggregates
+
+logger = logging.getLogger(__name__)
+
+# Зарегистрированные миграции: (версия, описание, функция, в транзакции)
+MIGRATIONS = []
+
+def migration(version: int, description: str, transactional: bool = True):
+    """Регистрирует шаг миграции схемы"""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func, transactional))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+def add_column(cursor, table: str, column: str, definition: str):
+    """Добавляет колонку, если ее еще нет (для старых баз)"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def get_schema_version(conn) -> int:
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+def apply_migrations(conn) -> int:
+    """Применяет все непримененные миграции по порядку, возвращает версию схемы"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    
+    current = get_schema_version(conn)
+    for version, description, func, transactional in MIGRATIONS:
+        if version <= current:
+            continue
+        
+        cursor = conn.cursor()
+        try:
+            if transactional:
+                # Несколько процессов бота стартуют одновременно: шаг
+                # применяет тот, кто первым взял блокировку на запись,
+                # остальные после нее видят новую версию и пропускают шаг
+                cursor.execute('BEGIN IMMEDIATE')
+                if get_schema_version(conn) >= version:
+                    conn.rollback()
+                    current = version
+                    continue
+            elif get_schema_version(conn) >= version:
+                current = version
+                continue
+            # Шаги вне транзакции (PRAGMA) повторять безопасно
+            func(cursor)
+            cursor.execute('''
+                INSERT OR IGNORE INTO schema_version (version, description) VALUES (?, ?)
+            ''', (version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.exception(f"Migration {version} ({description}) failed")
+            raise
+        
+        logger.info(f"Применена миграция {version}: {description}")
+        current = version
+    
+    return current
+
+# ===== МИГРАЦИИ =====
+@migration(1, "Базовая схема")
+def _initial_schema(cursor):
+    # Таблица пользователей
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE NOT NULL,
+            nickname TEXT NOT NULL,
+            district TEXT DEFAULT '🏛️ Центральный',
+            anon_mode INTEGER DEFAULT 1,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            total_chats INTEGER DEFAULT 0,
+            total_messages INTEGER DEFAULT 0,
+            district_chats INTEGER DEFAULT 0
+        )
+    ''')
+    
+    # Таблица рейтинга
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ratings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE NOT NULL,
+            likes INTEGER DEFAULT 0,
+            dislikes INTEGER DEFAULT 0,
+            rating REAL DEFAULT 50.0,
+            banned INTEGER DEFAULT 0,
+            ban_date TIMESTAMP,
+            ban_reason TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+    
+    # Таблица черного списка
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blacklist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            blocked_id INTEGER NOT NULL,
+            block_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id, blocked_id),
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (blocked_id) REFERENCES users (user_id)
+        )
+    ''')
+    
+    # Таблица чатов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT UNIQUE NOT NULL,
+            user1_id INTEGER NOT NULL,
+            user2_id INTEGER NOT NULL,
+            user1_nick TEXT NOT NULL,
+            user2_nick TEXT NOT NULL,
+            district TEXT,
+            start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            end_time TIMESTAMP,
+            message_count INTEGER DEFAULT 0,
+            FOREIGN KEY (user1_id) REFERENCES users (user_id),
+            FOREIGN KEY (user2_id) REFERENCES users (user_id)
+        )
+    ''')
+    
+    # Таблица сообщений
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            from_user INTEGER NOT NULL,
+            to_user INTEGER NOT NULL,
+            from_nick TEXT NOT NULL,
+            to_nick TEXT NOT NULL,
+            message_text TEXT,
+            message_type TEXT DEFAULT 'text',
+            file_id TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES chats (chat_id),
+            FOREIGN KEY (from_user) REFERENCES users (user_id),
+            FOREIGN KEY (to_user) REFERENCES users (user_id)
+        )
+    ''')
+    
+    # Таблица статистики по дням
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date DATE UNIQUE NOT NULL,
+            total_messages INTEGER DEFAULT 0,
+            total_chats INTEGER DEFAULT 0,
+            new_users INTEGER DEFAULT 0,
+            active_users INTEGER DEFAULT 0
+        )
+    ''')
+    
+    # Таблица статистики по районам
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS district_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            district TEXT NOT NULL,
+            user_count INTEGER DEFAULT 0,
+            online_now INTEGER DEFAULT 0,
+            UNIQUE(district)
+        )
+    ''')
+    
+    # Таблица для логов действий админов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admin_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            target_id INTEGER,
+            details TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+@migration(2, "Журнал WAL", transactional=False)
+def _enable_wal(cursor):
+    # Режим журнала хранится в самом файле БД, поэтому достаточно одного раза.
+    # Читатели больше не блокируются записью save_message.
+    # Смена режима не ждет busy_timeout, а при одновременном старте
+    # нескольких процессов файл может быть занят - повторяем.
+    for _ in range(50):
+        try:
+            cursor.execute('PRAGMA journal_mode = WAL')
+            return
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            time.sleep(0.1)
+    cursor.execute('PRAGMA journal_mode = WAL')
+
+@migration(3, "Индексы для частых запросов")
+def _hot_path_indexes(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_from_user ON messages (from_user)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)')
+    # Оба направления чата, чтобы OR по user1_id/user2_id шел по индексам
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_user1 ON chats (user1_id, start_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_user2 ON chats (user2_id, start_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_start_time ON chats (start_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_district ON users (district, last_activity)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users (last_activity)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_join_date ON users (join_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_blacklist_blocked ON blacklist (blocked_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ratings_banned ON ratings (banned, ban_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_admin_logs_timestamp ON admin_logs (timestamp)')
+    cursor.execute('ANALYZE')
+
+@migration(4, "Фоновые рассылки")
+def _broadcasts(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            last_user_id INTEGER DEFAULT 0,
+            chat_id INTEGER,
+            message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)')
+
+@migration(5, "Полнотекстовый поиск по сообщениям")
+def _messages_fts(cursor):
+    # unicode61 ищет без учета регистра, в том числе для кириллицы
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                message_text,
+                content='messages',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite собран без FTS5 - поиск останется на LIKE
+        logger.warning(f"FTS5 недоступен, пропускаем индекс сообщений: {e}")
+        return
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message_text) VALUES (new.id, new.message_text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text) VALUES ('delete', old.id, old.message_text);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message_text ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text) VALUES ('delete', old.id, old.message_text);
+            INSERT INTO messages_fts (rowid, message_text) VALUES (new.id, new.message_text);
+        END
+    ''')
+    # Индексируем уже накопленные сообщения
+    cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+@migration(6, "Инкрементальная дневная статистика")
+def _daily_stats_backfill(cursor):
+    # Дальше счетчики ведутся при записи, здесь только выравниваем историю
+    daily_stats.backfill(cursor)
+
+@migration(7, "Итоговые счетчики для админ-панели")
+def _totals(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS totals (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    aggregates.create_triggers(cursor)
+    aggregates.recount(cursor)
+
+@migration(8, "Журнал оценок")
+def _votes(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS votes (
+            chat_id INTEGER NOT NULL,
+            voter INTEGER NOT NULL,
+            target INTEGER NOT NULL,
+            is_like INTEGER NOT NULL,
+            applied INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, voter, target)
+        ) WITHOUT ROWID
+    ''')
+    # Агрегатор выбирает только неучтенные оценки
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_votes_pending ON votes (applied) WHERE applied = 0')
+
+@migration(9, "Архив сообщений")
+def _message_archives(cursor):
+    # Сколько сообщений каждого месяца перенесено в архивные файлы
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_archives (
+            month TEXT PRIMARY KEY,
+            messages INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # auto_vacuum у существующей БД меняется только полным VACUUM, который
+    # надолго блокирует базу, поэтому это не миграция, а команда /vacuum
+
+@migration(10, "Аренда рассылок и версия модерации для нескольких процессов")
+def _shared_workers(cursor):
+    # Рассылку ведет процесс-владелец, пока продлевает аренду (lease_until, unix-время);
+    # остановку из другого процесса он видит по stop_requested
+    add_column(cursor, 'broadcasts', 'owner', 'TEXT')
+    add_column(cursor, 'broadcasts', 'lease_until', 'REAL')
+    add_column(cursor, 'broadcasts', 'stop_requested', 'INTEGER NOT NULL DEFAULT 0')
+    
+    # Любое изменение банов и черных списков увеличивает версию,
+    # по ней процессы перечитывают свой ModerationIndex
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS moderation_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO moderation_version (id, version) VALUES (1, 0)')
+    for name, event in (
+        ('blacklist_insert', 'AFTER INSERT ON blacklist'),
+        ('blacklist_delete', 'AFTER DELETE ON blacklist'),
+        ('ratings_ban', 'AFTER UPDATE OF banned ON ratings WHEN (NEW.banned = 1) != (OLD.banned = 1)'),
+    ):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS moderation_{name} {event} BEGIN
+                UPDATE moderation_version SET version = version + 1 WHERE id = 1;
+            END
+        ''')
+
+@migration(11, "Журнал изменений профилей для нескольких процессов")
+def _profile_changes(cursor):
+    # Ник, район и анонимность, измененные одним процессом, другие узнают
+    # по новым записям журнала и сбрасывают свои кеши профилей.
+    # Хранятся последние 10000 записей: процессы читают журнал раз в пару секунд
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS profile_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS profile_changes_users
+        AFTER UPDATE OF nickname, district, anon_mode ON users
+        WHEN NEW.nickname IS NOT OLD.nickname OR NEW.district IS NOT OLD.district
+            OR NEW.anon_mode IS NOT OLD.anon_mode
+        BEGIN
+            INSERT INTO profile_changes (user_id) VALUES (NEW.user_id);
+            DELETE FROM profile_changes WHERE seq <= last_insert_rowid() - 10000;
+        END
+    ''')
@@ -0,0 +1,81 @@
+import threading
+
+# Как часто процесс с общим состоянием (STATE_BACKEND=sqlite) проверяет
+# баны и ЧС, измененные другими процессами бота (сек)
+MODERATION_SYNC_INTERVAL = 2
+
+class ModerationIndex:
+    """Баны и черные списки в памяти для проверок без обращений к БД.
+    
+    Загружается из БД при старте (Database.load_moderation) и
+    обновляется методами Database, которые меняют баны и черные списки.
+    Изменения, сделанные другим процессом, подхватывает
+    Database.sync_moderation по счетчику версий в БД.
+    """
+    
+    def __init__(self):
+        self.banned = set()
+        self._pairs = set()          # (кто заблокировал, кого)
+        self._conflicts = {}         # user_id -> с кем нельзя соединять (в обе стороны)
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._pairs)
+    
+    def load(self, banned_ids, blacklist_pairs):
+        """Полностью заменяет содержимое индекса"""
+        with self._lock:
+            self.banned = set(banned_ids)
+            self._pairs = set()
+            self._conflicts = {}
+            for user_id, blocked_id in blacklist_pairs:
+                self._add_pair(user_id, blocked_id)
+    
+    # ===== БАНЫ =====
+    def ban(self, user_id: int):
+        self.banned.add(user_id)
+    
+    def unban(self, user_id: int):
+        self.banned.discard(user_id)
+    
+    def is_banned(self, user_id: int) -> bool:
+        return user_id in self.banned
+    
+    # ===== ЧЕРНЫЙ СПИСОК =====
+    def block(self, user_id: int, blocked_id: int):
+        with self._lock:
+            self._add_pair(user_id, blocked_id)
+    
+    def unblock(self, user_id: int, blocked_id: int):
+        with self._lock:
+            if (user_id, blocked_id) not in self._pairs:
+                return
+            self._pairs.discard((user_id, blocked_id))
+            # Связь остается, если второй тоже заблокировал первого
+            if (blocked_id, user_id) not in self._pairs:
+                self._drop_conflict(user_id, blocked_id)
+                self._drop_conflict(blocked_id, user_id)
+    
+    def is_blocked(self, user_id: int, target_id: int) -> bool:
+        return (user_id, target_id) in self._pairs
+    
+    def can_match(self, user_id: int, candidate_id: int) -> bool:
+        """Можно ли соединить двух пользователей в чат"""
+        return (
+            candidate_id != user_id
+            and candidate_id not in self.banned
+            and user_id not in self.banned
+            and candidate_id not in self._conflicts.get(user_id, ())
+        )
+    
+    def _add_pair(self, user_id: int, blocked_id: int):
+        self._pairs.add((user_id, blocked_id))
+        self._conflicts.setdefault(user_id, set()).add(blocked_id)
+        self._conflicts.setdefault(blocked_id, set()).add(user_id)
+    
+    def _drop_conflict(self, user_id: int, other_id: int):
+        others = self._conflicts.get(user_id)
+        if others:
+            others.discard(other_id)
+            if not others:
+                del self._conflicts[user_id]
@@ -0,0 +1,64 @@
+from collections import Counter
+
+# Как часто счетчики онлайна сбрасываются в district_stats (сек)
+ONLINE_FLUSH_INTERVAL = 10
+
+class OnlineStats:
+    """Онлайн по районам, поддерживаемый инкрементально.
+    
+    Обновляется при постановке в очередь, создании и завершении чата,
+    а в БД пишется пачкой раз в ONLINE_FLUSH_INTERVAL секунд.
+    """
+    
+    def __init__(self):
+        self._district = {}         # user_id -> район
+        self._counts = Counter()    # район -> онлайн
+        self.dirty = False
+    
+    def __len__(self):
+        return len(self._district)
+    
+    def __contains__(self, user_id):
+        return user_id in self._district
+    
+    def __iter__(self):
+        return iter(list(self._district))
+    
+    def set_online(self, user_id: int, district: str):
+        if user_id in self._district:
+            if self._district[user_id] == district:
+                return
+            self._decrement(self._district[user_id])
+        self._district[user_id] = district
+        self._counts[district] += 1
+        self.dirty = True
+    
+    def set_offline(self, user_id: int):
+        if user_id not in self._district:
+            return
+        self._decrement(self._district.pop(user_id))
+        self.dirty = True
+    
+    def _decrement(self, district):
+        self._counts[district] -= 1
+        if self._counts[district] <= 0:
+            del self._counts[district]
+    
+    def count(self, district: str) -> int:
+        return self._counts.get(district, 0)
+    
+    def by_district(self) -> dict:
+        return dict(self._counts)
+    
+    def reset(self, users: dict):
+        """Пересобирает счетчики из словаря user_id -> район"""
+        self._district = dict(users)
+        self._counts = Counter(self._district.values())
+        self.dirty = True
+    
+    async def flush(self, db):
+        """Сохраняет счетчики в district_stats, если они изменились"""
+        if not self.dirty:
+            return
+        self.dirty = False
+        await db.set_online_counts(self.by_district())
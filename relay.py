@@ -0,0 +1,134 @@
+import html
+import asyncio
+import logging
+from aiogram.types import InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
+
+logger = logging.getLogger(__name__)
+
+# Типы, у которых Telegram допускает подпись: заголовок с отправителем
+# идет в нее. Остальное (стикеры, кружки, геопозиции, контакты, опросы,
+# кубики...) копируется как есть - собеседник и так знает, с кем говорит.
+CAPTION_TYPES = {'photo', 'video', 'animation', 'audio', 'document', 'voice'}
+
+# Типы, которые Telegram группирует в альбомы
+ALBUM_MEDIA = {
+    'photo': InputMediaPhoto,
+    'video': InputMediaVideo,
+    'document': InputMediaDocument,
+    'audio': InputMediaAudio,
+}
+
+# Сколько ждать остальные сообщения альбома (сек)
+MEDIA_GROUP_DELAY = 0.5
+
+def media_file_id(message, content_type: str = None):
+    """file_id вложения или None для типов без файла (текст, геопозиция...)"""
+    media = getattr(message, content_type or message.content_type, None)
+    # Фото приходит списком размеров, берем самый большой
+    if isinstance(media, list):
+        return media[-1].file_id
+    return getattr(media, 'file_id', None)
+
+def relay_header(sender: str, message) -> str:
+    """Заголовок с отправителем + текст/подпись с сохранением форматирования.
+    
+    sender берется из RelayContext.sender_name: в анонимном режиме это
+    ник, иначе имя в Telegram; в HTML он экранируется.
+    """
+    sender = html.escape(sender)
+    if message.text or message.caption:
+        return f"<b>{sender}:</b> {message.html_text}"
+    return f"<b>{sender}:</b>"
+
+async def relay_message(bot, partner_id: int, message, sender: str):
+    """Пересылает сообщение собеседнику одним запросом.
+    
+    Текст отправляется с заголовком, все остальное - через copy_message:
+    файл не перезагружается, типы не перечисляются, а автор оригинала
+    не раскрывается (в отличие от forward_message).
+    Возвращает (текст/подпись, тип, file_id) для сохранения в БД.
+    """
+    content_type = message.content_type
+    if content_type == 'text':
+        await bot.send_message(partner_id, relay_header(sender, message))
+        return message.text, content_type, None
+    
+    if content_type in CAPTION_TYPES:
+        await bot.copy_message(partner_id, message.chat.id, message.message_id,
+                               caption=relay_header(sender, message))
+    else:
+        await bot.copy_message(partner_id, message.chat.id, message.message_id)
+    return message.caption, content_type, media_file_id(message, content_type)
+
+class _Album:
+    __slots__ = ('group_id', 'partner_id', 'media', 'timer')
+    
+    def __init__(self, group_id: str, partner_id: int):
+        self.group_id = group_id
+        self.partner_id = partner_id
+        self.media = []
+        self.timer = None
+
+class MediaGroupBuffer:
+    """Собирает сообщения одного альбома и пересылает их одним send_media_group.
+    
+    Telegram присылает альбом отдельными сообщениями с общим
+    media_group_id; буфер ждет MEDIA_GROUP_DELAY после первого из них.
+    У пользователя одновременно копится не больше одного альбома.
+    flush() дожидается и уже начатой отправки, поэтому следующее
+    сообщение пользователя не обгоняет его альбом.
+    """
+    
+    def __init__(self, bot, delay: float = MEDIA_GROUP_DELAY):
+        self.bot = bot
+        self.delay = delay
+        self._albums = {}       # user_id -> _Album
+        self._sending = {}      # user_id -> задача отправки альбома
+    
+    async def add(self, user_id: int, partner_id: int, message, sender: str):
+        """Добавляет сообщение альбома, возвращает (подпись, тип, file_id) для БД"""
+        album = self._albums.get(user_id)
+        if album is not None and album.group_id != message.media_group_id:
+            await self.flush(user_id)
+            album = None
+        if album is None:
+            album = self._albums[user_id] = _Album(message.media_group_id, partner_id)
+            album.timer = asyncio.create_task(self._flush_later(user_id, album))
+        
+        content_type = message.content_type
+        file_id = media_file_id(message, content_type)
+        # Подпись с отправителем - у первого элемента и у подписанных
+        caption = None
+        if message.caption or not album.media:
+            caption = relay_header(sender, message)
+        album.media.append(ALBUM_MEDIA[content_type](media=file_id, caption=caption))
+        return message.caption, content_type, file_id
+    
+    async def _flush_later(self, user_id: int, album: _Album):
+        await asyncio.sleep(self.delay)
+        if self._albums.get(user_id) is album:
+            await self.flush(user_id)
+    
+    async def flush(self, user_id: int):
+        """Отправляет накопленный альбом пользователя и ждет конца его отправки"""
+        album = self._albums.pop(user_id, None)
+        if album is not None:
+            if album.timer is not asyncio.current_task():
+                album.timer.cancel()
+            previous = self._sending.get(user_id)
+            self._sending[user_id] = asyncio.create_task(self._send(user_id, album, previous))
+        sending = self._sending.get(user_id)
+        if sending is not None:
+            # shield: отмена ожидающего не должна обрывать отправку альбома
+            await asyncio.shield(sending)
+    
+    async def _send(self, user_id: int, album: _Album, previous):
+        try:
+            if previous is not None:
+                await previous
+            await self.bot.send_media_group(album.partner_id, album.media)
+        except Exception as e:
+            logger.error(f"Error sending media group {album.group_id}: {e}")
+        finally:
+            if self._sending.get(user_id) is asyncio.current_task():
+                del self._sending[user_id]
@@ -0,0 +1,133 @@
+import time
+import threading
+from matchmaking import MatchQueue
+
+class RelayContext:
+    """Все, что нужно для пересылки сообщения собеседнику, без обращений к БД"""
+    
+    __slots__ = ('partner', 'chat_uuid', 'nickname', 'anon', 'partner_nick', 'sender')
+    
+    def __init__(self, partner: int, chat_uuid: str, nickname: str, anon: bool, partner_nick: str):
+        self.partner = partner
+        self.chat_uuid = chat_uuid
+        self.nickname = nickname
+        self.anon = anon
+        self.partner_nick = partner_nick
+        self.sender = nickname if anon else None
+    
+    def sender_name(self, from_user) -> str:
+        """Подпись отправителя: ник в анонимном режиме, иначе имя в Telegram"""
+        if self.sender is None:
+            sender = from_user.full_name or "Пользователь"
+            if from_user.username:
+                sender += f" (@{from_user.username})"
+            self.sender = sender
+        return self.sender
+
+class RelayCache:
+    """Контексты пересылки по (user_id, chat_uuid) в памяти процесса.
+    
+    Живут отдельно от реестра чатов: SqliteSessionRegistry каждый раз
+    читает Session из общей БД, и контекст в ней не сохранялся бы.
+    Контекст другого (уже завершенного) чата не возвращается.
+    """
+    
+    def __init__(self):
+        self._relays = {}       # user_id -> RelayContext
+        self._watchers = {}     # user_id -> чей контекст содержит его ник
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._relays)
+    
+    def get(self, user_id: int, chat_uuid: str):
+        relay = self._relays.get(user_id)
+        if relay is not None and relay.chat_uuid == chat_uuid:
+            return relay
+        return None
+    
+    def put(self, user_id: int, relay: RelayContext):
+        with self._lock:
+            self._relays[user_id] = relay
+            self._watchers[relay.partner] = user_id
+    
+    def invalidate(self, *user_ids: int):
+        """Сбрасывает контексты пользователей и их собеседников.
+        
+        Вызывается при изменении профиля (ник, анонимность, бан), в том
+        числе из потоков БД, и при завершении чата.
+        """
+        with self._lock:
+            for user_id in user_ids:
+                relay = self._relays.pop(user_id, None)
+                if relay is not None and self._watchers.get(relay.partner) == user_id:
+                    del self._watchers[relay.partner]
+                watcher = self._watchers.pop(user_id, None)
+                if watcher is not None:
+                    self._relays.pop(watcher, None)
+
+class Session:
+    """Состояние одного участника чата"""
+    
+    __slots__ = ('partner', 'chat_uuid', 'started_at', 'district')
+    
+    def __init__(self, partner: int, chat_uuid: str, district: str = None, started_at: float = None):
+        self.partner = partner
+        self.chat_uuid = chat_uuid
+        self.started_at = started_at or time.time()
+        self.district = district
+
+class SessionRegistry:
+    """Активные чаты и очередь поиска в одном месте.
+    
+    Каждый участник чата имеет свою запись Session, записи пары
+    создаются и удаляются вместе, поэтому «половинчатых» чатов не
+    бывает. Очередь поиска - MatchQueue; пользователь находится либо
+    в очереди, либо в чате, и онлайн считается без построения множеств.
+    """
+    
+    # Общее ли состояние для нескольких процессов бота
+    shared = False
+    
+    def __init__(self, queue: MatchQueue = None):
+        self.queue = queue if queue is not None else MatchQueue()
+        self._sessions = {}     # user_id -> Session
+    
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+    
+    def __iter__(self):
+        return iter(list(self._sessions))
+    
+    def get(self, user_id: int):
+        return self._sessions.get(user_id)
+    
+    # ===== ЧАТЫ =====
+    def start(self, user1_id: int, user2_id: int, chat_uuid: str, district: str = None):
+        """Регистрирует чат пары (оба пользователя покидают очередь)"""
+        for user_id in (user1_id, user2_id):
+            self.end(user_id)
+            self.queue.cancel(user_id)
+        self._sessions[user1_id] = Session(user2_id, chat_uuid, district)
+        self._sessions[user2_id] = Session(user1_id, chat_uuid, district)
+    
+    def end(self, user_id: int):
+        """Завершает чат пользователя и его собеседника.
+        
+        Возвращает запись Session пользователя или None, если он не в чате.
+        """
+        session = self._sessions.pop(user_id, None)
+        if session is None:
+            return None
+        partner = self._sessions.get(session.partner)
+        if partner is not None and partner.partner == user_id:
+            del self._sessions[session.partner]
+        return session
+    
+    def chat_count(self) -> int:
+        return len(self._sessions) // 2
+    
+    # ===== ОНЛАЙН =====
+    def online_ids(self):
+        """Все пользователи в чатах и в очереди"""
+        return list(self._sessions) + list(self.queue)
@@ -0,0 +1,293 @@
+import json
+import sqlite3
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from matchmaking import MatchQueue
+from sessions import Session, SessionRegistry
+
+logger = logging.getLogger(__name__)
+
+# Хранилище состояния бота: очередь поиска, активные чаты и FSM.
+# memory - все в памяти процесса (один процесс бота);
+# sqlite - общий файл БД, с которым могут работать несколько процессов.
+STATE_BACKENDS = ("memory", "sqlite")
+
+# Сколько ждать блокировку общего файла другим процессом (мс). Ожидание идет
+# в потоке состояния (см. AsyncState), event loop в это время работает.
+STATE_BUSY_TIMEOUT = 30000
+
+def connect(path: str) -> sqlite3.Connection:
+    """Открывает файл общего состояния и создает таблицы"""
+    # Соединением пользуется только поток состояния, транзакции - явные
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {STATE_BUSY_TIMEOUT}")
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS match_queue (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE NOT NULL,
+            district TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_match_queue_district ON match_queue(district, seq);
+        
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            user_id INTEGER PRIMARY KEY,
+            partner INTEGER NOT NULL,
+            chat_uuid TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            district TEXT
+        );
+        
+        CREATE TABLE IF NOT EXISTS fsm (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT
+        );
+    ''')
+    return conn
+
+@contextmanager
+def transaction(conn: sqlite3.Connection):
+    """Транзакция с блокировкой на запись с самого начала.
+    
+    BEGIN IMMEDIATE не дает двум процессам одновременно прочитать
+    очередь и забрать одного и того же собеседника.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+class SqliteMatchQueue(MatchQueue):
+    """Очередь поиска в общей БД.
+    
+    Порядок ожидания - по seq. Баны и черные списки проверяются по
+    ModerationIndex в памяти процесса (изменения других процессов
+    подтягивает Database.sync_moderation).
+    """
+    
+    def __init__(self, conn: sqlite3.Connection):
+        super().__init__()
+        self.conn = conn
+    
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM match_queue").fetchone()[0]
+    
+    def __contains__(self, user_id):
+        return self.conn.execute(
+            "SELECT 1 FROM match_queue WHERE user_id = ?", (user_id,)
+        ).fetchone() is not None
+    
+    def __iter__(self):
+        rows = self.conn.execute("SELECT user_id FROM match_queue ORDER BY seq").fetchall()
+        return iter([row[0] for row in rows])
+    
+    def enqueue(self, user_id: int, district: str):
+        self.conn.execute(
+            "INSERT OR IGNORE INTO match_queue (user_id, district) VALUES (?, ?)", (user_id, district)
+        )
+    
+    def cancel(self, user_id: int) -> bool:
+        return self.conn.execute("DELETE FROM match_queue WHERE user_id = ?", (user_id,)).rowcount > 0
+    
+    def _take_partner(self, user_id: int, district: str = None):
+        if district is None:
+            rows = self.conn.execute("SELECT user_id FROM match_queue ORDER BY seq")
+        else:
+            rows = self.conn.execute(
+                "SELECT user_id FROM match_queue WHERE district = ? ORDER BY seq", (district,)
+            )
+        for (uid,) in rows:
+            if self.can_match(user_id, uid):
+                self.conn.execute("DELETE FROM match_queue WHERE user_id = ?", (uid,))
+                return uid
+        return None
+    
+    def find_partner(self, user_id: int, district: str = None):
+        with transaction(self.conn):
+            return self._take_partner(user_id, district)
+    
+    def match_or_enqueue(self, user_id: int, district: str, same_district: bool = False):
+        # Поиск и постановка в очередь - одна транзакция, иначе два процесса
+        # могут одновременно не найти друг друга и оба встать в очередь
+        with transaction(self.conn):
+            partner_id = self._take_partner(user_id, district if same_district else None)
+            if partner_id is None:
+                self.enqueue(user_id, district)
+            return partner_id
+
+class SqliteSessionRegistry(SessionRegistry):
+    """Активные чаты в общей БД (записи пары пишутся одной транзакцией)"""
+    
+    shared = True
+    
+    def __init__(self, conn: sqlite3.Connection):
+        super().__init__(SqliteMatchQueue(conn))
+        self.conn = conn
+    
+    def __contains__(self, user_id):
+        return self.conn.execute(
+            "SELECT 1 FROM chat_sessions WHERE user_id = ?", (user_id,)
+        ).fetchone() is not None
+    
+    def __iter__(self):
+        rows = self.conn.execute("SELECT user_id FROM chat_sessions").fetchall()
+        return iter([row[0] for row in rows])
+    
+    def get(self, user_id: int):
+        row = self.conn.execute(
+            "SELECT partner, chat_uuid, district, started_at FROM chat_sessions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return Session(*row) if row else None
+    
+    def start(self, user1_id: int, user2_id: int, chat_uuid: str, district: str = None):
+        session = Session(user2_id, chat_uuid, district)
+        with transaction(self.conn):
+            for user_id in (user1_id, user2_id):
+                self._end(user_id)
+                self.queue.cancel(user_id)
+            self.conn.executemany('''
+                INSERT INTO chat_sessions (user_id, partner, chat_uuid, started_at, district)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [
+                (user1_id, user2_id, chat_uuid, session.started_at, district),
+                (user2_id, user1_id, chat_uuid, session.started_at, district),
+            ])
+    
+    def _end(self, user_id: int):
+        row = self.conn.execute('''
+            DELETE FROM chat_sessions WHERE user_id = ?
+            RETURNING partner, chat_uuid, district, started_at
+        ''', (user_id,)).fetchall()
+        if not row:
+            return None
+        row = row[0]
+        self.conn.execute(
+            "DELETE FROM chat_sessions WHERE user_id = ? AND partner = ?", (row[0], user_id)
+        )
+        return Session(*row)
+    
+    def end(self, user_id: int):
+        with transaction(self.conn):
+            return self._end(user_id)
+    
+    def chat_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM chat_sessions").fetchone()[0] // 2
+    
+    def online_ids(self):
+        return list(self) + list(self.queue)
+
+class SqliteStorage(BaseStorage):
+    """FSM-хранилище aiogram в общей БД (запросы - в потоке состояния)"""
+    
+    def __init__(self, conn: sqlite3.Connection, executor: ThreadPoolExecutor):
+        self.conn = conn
+        self._executor = executor
+    
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+    
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+    
+    def _set_state(self, key: str, state):
+        self.conn.execute('''
+            INSERT INTO fsm (key, state) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET state = excluded.state
+        ''', (key, state))
+    
+    def _get_state(self, key: str):
+        row = self.conn.execute("SELECT state FROM fsm WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def _set_data(self, key: str, data: str):
+        self.conn.execute('''
+            INSERT INTO fsm (key, data) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET data = excluded.data
+        ''', (key, data))
+    
+    def _get_data(self, key: str) -> dict:
+        row = self.conn.execute("SELECT data FROM fsm WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+    
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await self._run(self._set_state, self._key(key), state)
+    
+    async def get_state(self, key: StorageKey):
+        return await self._run(self._get_state, self._key(key))
+    
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        await self._run(self._set_data, self._key(key), json.dumps(data, ensure_ascii=False))
+    
+    async def get_data(self, key: StorageKey) -> dict:
+        return await self._run(self._get_data, self._key(key))
+    
+    async def close(self) -> None:
+        await self._run(self.conn.close)
+        self._executor.shutdown(wait=False)
+
+class AsyncState:
+    """Асинхронный фасад над реестром чатов или очередью поиска.
+    
+    Как AsyncDatabase: методы те же, но корутины. У общего SQLite-хранилища
+    они выполняются в потоке состояния (ожидание BEGIN IMMEDIATE не
+    останавливает event loop), у хранилища в памяти - сразу, без потока.
+    len() и in заменяют size() и contains().
+    """
+    
+    def __init__(self, target, executor: ThreadPoolExecutor = None):
+        self.sync = target
+        self._executor = executor
+        queue = getattr(target, 'queue', None)
+        if queue is not None:
+            self.queue = AsyncState(queue, executor)
+    
+    async def _call(self, func, *args, **kwargs):
+        if self._executor is None:
+            return func(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+    
+    def __getattr__(self, name):
+        attr = getattr(self.sync, name)
+        if not callable(attr):
+            return attr
+        
+        async def method(*args, **kwargs):
+            return await self._call(attr, *args, **kwargs)
+        
+        method.__name__ = name
+        method.__doc__ = attr.__doc__
+        setattr(self, name, method)
+        return method
+    
+    async def size(self) -> int:
+        return await self._call(len, self.sync)
+    
+    async def contains(self, user_id: int) -> bool:
+        return await self._call(self.sync.__contains__, user_id)
+
+def create_state(backend: str = "memory", path: str = None):
+    """Создает реестр чатов (с очередью, в AsyncState) и FSM-хранилище выбранного типа"""
+    if backend not in STATE_BACKENDS:
+        raise ValueError(f"Unknown state backend: {backend}")
+    if backend == "memory":
+        return AsyncState(SessionRegistry()), MemoryStorage()
+    # Один поток владеет соединением, запросы процесса к общему файлу идут по очереди
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+    conn = executor.submit(connect, path).result()
+    logger.info(f"Общее состояние бота: {path}")
+    return AsyncState(SqliteSessionRegistry(conn), executor), SqliteStorage(conn, executor)
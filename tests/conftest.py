@@ -0,0 +1,19 @@
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import config
+except ImportError:
+    # config.py с токеном и ID админов у каждого свой и в репозиторий не
+    # попадает; тестам нужны только значения, которые читаются при импорте
+    config = types.ModuleType('config')
+    config.BOT_TOKEN = '123456:TEST'
+    config.ADMIN_IDS = [1]
+    config.DB_NAME = ':memory:'
+    config.DEBUG = False
+    config.TYUMEN_DISTRICTS = ["🏛️ Центральный", "🏭 Ленинский", "🌳 Калининский", "🏘️ Восточный"]
+    sys.modules['config'] = config
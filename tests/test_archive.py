@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import pytest
+import archive
+from database import Database
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(str(tmp_path / 'archive.db'), message_batch_size=1, message_retention_days=30)
+    for user_id in (1, 2):
+        database.add_user(user_id, f'u{user_id}')
+    database.create_chat('c1', 1, 2, 'u1', 'u2', '🏛️ Центральный')
+    yield database
+    database.close()
+
+def add_old_messages(db, count: int):
+    for n in range(count):
+        db.save_message('c1', 1, 2, 'u1', 'u2', f'старое сообщение {n} ' + 'x' * 500)
+    conn = db.get_connection()
+    conn.execute("UPDATE messages SET timestamp = '2020-01-15 12:00:00'")
+    conn.commit()
+    conn.close()
+
+def auto_vacuum(db) -> int:
+    conn = db.get_connection()
+    try:
+        return conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    finally:
+        conn.close()
+
+def test_vacuum_is_explicit(db):
+    """Запуск бота не перестраивает БД, режим включается командой"""
+    assert auto_vacuum(db) == 0
+    add_old_messages(db, 200)
+    assert db.archive_messages() == 200
+    
+    assert db.enable_incremental_vacuum()
+    assert auto_vacuum(db) == archive.INCREMENTAL
+    assert not db.enable_incremental_vacuum()
+
+def test_reclaim_needs_incremental_mode(db):
+    add_old_messages(db, 200)
+    conn = db.get_connection()
+    conn.execute('DELETE FROM messages')
+    conn.commit()
+    try:
+        assert conn.execute('PRAGMA freelist_count').fetchone()[0] > 0
+        assert archive.reclaim(conn, 1000) == 0
+    finally:
+        conn.close()
+    
+    db.enable_incremental_vacuum()
+    add_old_messages(db, 200)
+    conn = db.get_connection()
+    conn.execute('DELETE FROM messages')
+    conn.commit()
+    try:
+        assert archive.reclaim(conn, 1000) > 0
+    finally:
+        conn.close()
+
+def test_failed_archive_schema_is_detached(db, monkeypatch):
+    """Ошибка при создании архива не оставляет его подключенным к соединению пула"""
+    add_old_messages(db, 10)
+    
+    def broken_schema(conn, fts):
+        raise sqlite3.OperationalError('disk I/O error')
+    
+    monkeypatch.setattr(archive, '_create_schema', broken_schema)
+    conn = db.get_connection()
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            archive.move_batch(conn, db.db_name, '2021-01-01', 100)
+        assert [row[1] for row in conn.execute('PRAGMA database_list')] == ['main']
+    finally:
+        conn.close()
+    
+    monkeypatch.undo()
+    assert db.archive_messages() == 10
+    assert os.path.exists(archive.archive_path(db.db_name, '2020-01'))
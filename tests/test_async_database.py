@@ -0,0 +1,53 @@
+# Нагрузочная проверка AsyncDatabase: пока в потоке БД идет тяжелый запрос
+# админки, апдейты остальных пользователей обрабатываются без задержки.
+import time
+import asyncio
+from database import Database, AsyncDatabase
+
+# Запрос на сотни миллисекунд целиком внутри SQLite (GIL отпущен)
+HEAVY_QUERY = '''
+    WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 1000000)
+    SELECT COUNT(*) FROM n
+'''
+
+def heavy_admin_query(db: Database) -> float:
+    start = time.perf_counter()
+    conn = db.get_connection()
+    try:
+        conn.execute(HEAVY_QUERY).fetchone()
+    finally:
+        conn.close()
+    return time.perf_counter() - start
+
+async def update_latencies(db: AsyncDatabase, heavy) -> tuple:
+    """Задержки «апдейтов» (профиль + ЧС) каждые 2 мс, пока выполняется heavy"""
+    latencies = []
+    task = asyncio.ensure_future(heavy())
+    while not task.done():
+        start = time.perf_counter()
+        await asyncio.sleep(0.002)
+        await db.get_user(1)
+        await db.get_blacklist(1)
+        # Сверх сна: ожидание event loop и самих запросов
+        latencies.append(time.perf_counter() - start - 0.002)
+    latencies.sort()
+    return await task, latencies
+
+def p99(latencies: list) -> float:
+    return latencies[int(len(latencies) * 0.99)]
+
+def test_p99_stays_flat_during_heavy_query(tmp_path):
+    async def run():
+        db = AsyncDatabase(Database(str(tmp_path / 'load.db'), profile_cache_size=0))
+        await db.add_user(1, 'u1')
+        _, idle = await update_latencies(db, lambda: asyncio.sleep(0.3))
+        heavy, loaded = await update_latencies(db, lambda: db.run(heavy_admin_query, db.sync))
+        await db.close()
+        return idle, heavy, loaded
+    
+    idle, heavy, loaded = asyncio.run(run())
+    assert heavy > 0.2
+    assert len(loaded) > 20
+    # Без фасада каждый апдейт ждал бы весь тяжелый запрос
+    assert p99(loaded) < max(5 * p99(idle), 0.02)
+    assert p99(loaded) < heavy / 5
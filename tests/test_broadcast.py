@@ -0,0 +1,56 @@
+import asyncio
+import time
+from broadcast import TokenBucket
+
+def test_no_burst_after_pause():
+    """После RetryAfter токены копятся с конца паузы, а не с начала"""
+    async def run():
+        bucket = TokenBucket(rate=20, capacity=20)
+        bucket.pause(0.3)
+        start = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+        return time.monotonic() - start
+    
+    # Пауза 0.3 с + 5 токенов по 1/20 с; с пачкой было бы ~0.3 с
+    assert asyncio.run(run()) >= 0.3 + 4 / 20
+
+class SlowBot:
+    """Bot, который только считает отправленные сообщения"""
+    
+    def __init__(self):
+        self.sent = []
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0.01)
+        self.sent.append(chat_id)
+
+def test_broadcast_owned_by_one_process(tmp_path, monkeypatch):
+    """Рассылку ведет только владелец аренды, остановить ее можно из другого процесса"""
+    import broadcast
+    from database import Database, AsyncDatabase
+    monkeypatch.setattr(broadcast, 'BROADCAST_HEARTBEAT', 0.05)
+    
+    async def run():
+        path = str(tmp_path / 'bc.db')
+        db1, db2 = AsyncDatabase(Database(path)), AsyncDatabase(Database(path))
+        for user_id in range(1, 201):
+            await db1.add_user(user_id, f'u{user_id}')
+        bot1, bot2 = SlowBot(), SlowBot()
+        first = broadcast.BroadcastManager(bot1, db1, rate=1000, concurrency=2)
+        second = broadcast.BroadcastManager(bot2, db2, rate=1000, concurrency=2)
+        second.owner = 'other:1'
+        
+        job = await first.start(1, 'текст')
+        await second.resume_all()
+        assert not second.jobs
+        assert await second.stop(job.id)
+        await asyncio.wait_for(job.task, 5)
+        row = await db2.get_broadcast(job.id)
+        await db1.close()
+        await db2.close()
+        return row, bot1.sent, bot2.sent
+    
+    row, sent1, sent2 = asyncio.run(run())
+    assert row['status'] == 'cancelled'
+    assert sent2 == [] and 0 < len(sent1) < 200
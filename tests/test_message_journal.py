@@ -0,0 +1,33 @@
+from database import Database
+from message_journal import MAX_FLUSH_RETRIES
+
+def test_bad_row_does_not_block_the_journal(tmp_path):
+    """Строка, нарушающая ограничение, не держит остальные сообщения в буфере"""
+    db = Database(str(tmp_path / 'journal.db'), message_batch_size=1000, message_flush_interval=3600)
+    try:
+        for user_id in (1, 2):
+            db.add_user(user_id, f'u{user_id}')
+        db.create_chat('c1', 1, 2, 'u1', 'u2')
+        journal = db.journal
+        journal.append('c1', 1, 2, 'u1', 'u2', 'первое')
+        journal.append(None, 1, 2, 'u1', 'u2', 'без чата')     # chat_id NOT NULL
+        journal.append('c1', 1, 2, 'u1', 'u2', 'второе')
+        
+        for _ in range(MAX_FLUSH_RETRIES - 1):
+            assert journal.flush() == 0
+            assert journal.pending() == 3
+        assert journal.flush() == 2
+        assert journal.pending() == 0
+        assert journal.dropped == 1
+        
+        # Следующие пачки пишутся как обычно
+        journal.append('c1', 2, 1, 'u2', 'u1', 'ответ')
+        assert journal.flush() == 1
+        conn = db.get_connection()
+        texts = [row[0] for row in conn.execute('SELECT message_text FROM messages ORDER BY id')]
+        count = conn.execute("SELECT message_count FROM chats WHERE chat_id = 'c1'").fetchone()[0]
+        conn.close()
+        assert texts == ['первое', 'второе', 'ответ']
+        assert count == 3
+    finally:
+        db.close()
@@ -0,0 +1,33 @@
+import sqlite3
+import threading
+from migrations import apply_migrations, MIGRATIONS
+
+def test_concurrent_startup_applies_each_step_once(tmp_path):
+    """Два процесса бота стартуют одновременно на новой БД"""
+    path = str(tmp_path / 'race.db')
+    barrier = threading.Barrier(4)
+    results, errors = [], []
+    
+    def start():
+        conn = sqlite3.connect(path, timeout=30)
+        try:
+            barrier.wait()
+            results.append(apply_migrations(conn))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+    
+    threads = [threading.Thread(target=start) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    latest = MIGRATIONS[-1][0]
+    assert errors == []
+    assert results == [latest] * 4
+    conn = sqlite3.connect(path)
+    versions = [row[0] for row in conn.execute('SELECT version FROM schema_version ORDER BY version')]
+    conn.close()
+    assert versions == [m[0] for m in MIGRATIONS]
@@ -0,0 +1,112 @@
+# Регрессия индексов: каждый метод Database выполняется на тестовой БД,
+# все его запросы прогоняются через EXPLAIN QUERY PLAN, и любой проход
+# по таблице (SCAN, в том числе по чужому индексу) считается ошибкой,
+# если он не указан для метода в CALLS.
+import sqlite3
+import pytest
+from database import Database, ConnectionPool
+
+# Метод -> (вызов, ожидаемые проходы с объяснением, почему они допустимы)
+CALLS = {
+    'get_user': (lambda db: db.get_user(1), ()),
+    # LIKE '%...%' не ищется по индексу, обход идет сразу в порядке ORDER BY
+    'find_users_by_nickname': (lambda db: db.find_users_by_nickname('u'),
+                               ('SCAN u USING INDEX idx_users_last_activity',)),
+    'update_user_district': (lambda db: db.update_user_district(1, '🌳 Калининский'), ()),
+    'update_user_activity': (lambda db: db.update_user_activity(1), ()),
+    'update_nickname': (lambda db: db.update_nickname(1, 'new'), ()),
+    'toggle_anon_mode': (lambda db: db.toggle_anon_mode(1), ()),
+    'cast_vote': (lambda db: db.cast_vote(1, 1, 2, True), ()),
+    'flush_votes': (lambda db: db.flush_votes(), ()),
+    'ban_user': (lambda db: db.ban_user(3), ()),
+    'unban_user': (lambda db: db.unban_user(3), ()),
+    'get_banned_ids': (lambda db: db.get_banned_ids(), ()),
+    'get_banned_users': (lambda db: db.get_banned_users(), ()),
+    'sync_moderation': (lambda db: db.sync_moderation(), ()),
+    'sync_profiles': (lambda db: db.sync_profiles(), ()),
+    'get_top_users': (lambda db: db.get_top_users(), ()),
+    'add_to_blacklist': (lambda db: db.add_to_blacklist(1, 3), ()),
+    'get_blacklist': (lambda db: db.get_blacklist(1), ()),
+    'remove_from_blacklist': (lambda db: db.remove_from_blacklist(1, 3), ()),
+    'create_chat': (lambda db: db.create_chat('c2', 1, 3, 'u1', 'u3', '🏛️ Центральный'), ()),
+    'end_chat': (lambda db: db.end_chat('c1'), ()),
+    'save_message': (lambda db: db.save_message('c1', 1, 2, 'u1', 'u2', 'привет'), ()),
+    # hits - CTE с последними совпадениями FTS, уже ограниченный LIMIT
+    'search_messages': (lambda db: db.search_messages('привет'), ('SCAN h',)),
+    'get_users_by_district': (lambda db: db.get_users_by_district('🏛️ Центральный', 2), ()),
+    'update_daily_stats': (lambda db: db.update_daily_stats(), ()),
+    # totals и message_archives - несколько строк (по счетчику и по месяцу),
+    # stats читается с конца индекса по дате до LIMIT 7
+    'get_all_stats': (lambda db: db.get_all_stats(), (
+        'SCAN totals', 'SCAN message_archives', 'SCAN stats USING INDEX sqlite_autoindex_stats_1',
+    )),
+    'get_user_details': (lambda db: db.get_user_details(1), ()),
+    # Число получателей - по всем пользователям, но только по ключу
+    'create_broadcast': (lambda db: db.create_broadcast(1, 'текст'),
+                         ('SCAN u USING COVERING INDEX sqlite_autoindex_users_1',)),
+    'get_broadcast': (lambda db: db.get_broadcast(1), ()),
+    'claim_broadcasts': (lambda db: db.claim_broadcasts('host:1', 60.0, 0.0), ()),
+    'request_broadcast_stop': (lambda db: db.request_broadcast_stop(1), ()),
+    'release_broadcasts': (lambda db: db.release_broadcasts('host:1'), ()),
+    'get_broadcast_recipients': (lambda db: db.get_broadcast_recipients(0), ()),
+    'update_broadcast': (lambda db: db.update_broadcast(1, 1, 0, 2), ()),
+    'log_admin_action': (lambda db: db.log_admin_action(1, 'ban', 3), ()),
+    # Последние записи - с конца индекса по времени до LIMIT
+    'get_admin_logs': (lambda db: db.get_admin_logs(),
+                       ('SCAN admin_logs USING INDEX idx_admin_logs_timestamp',)),
+    'archive_messages': (lambda db: db.archive_messages(), ()),
+}
+
+# Строки плана, которые не означают прохода по таблице
+HARMLESS = ('SCAN CONSTANT ROW', 'VIRTUAL TABLE', '(subquery-')
+
+@pytest.fixture
+def traced_db(tmp_path, monkeypatch):
+    """Database, запоминающая все выполненные запросы (с подставленными значениями)"""
+    statements = []
+    connect = ConnectionPool.connect
+    
+    def traced_connect(self):
+        conn = connect(self)
+        conn.set_trace_callback(statements.append)
+        return conn
+    
+    monkeypatch.setattr(ConnectionPool, 'connect', traced_connect)
+    path = str(tmp_path / 'plans.db')
+    db = Database(path, message_batch_size=1)
+    for user_id in (1, 2, 3):
+        db.add_user(user_id, f'u{user_id}')
+    db.create_chat('c1', 1, 2, 'u1', 'u2', '🏛️ Центральный')
+    db.save_message('c1', 1, 2, 'u1', 'u2', 'привет')
+    db.create_broadcast(1, 'текст')
+    statements.clear()
+    yield db, statements, path
+    db.close()
+
+def table_scans(conn, sql: str) -> list:
+    """Строки плана с проходом по таблице"""
+    plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+    return [
+        line for line in plan
+        if line.startswith('SCAN ') and not any(mark in line for mark in HARMLESS)
+    ]
+
+@pytest.mark.parametrize('method', CALLS)
+def test_method_uses_indexes(traced_db, method):
+    db, statements, path = traced_db
+    call, expected = CALLS[method]
+    call(db)
+    
+    conn = sqlite3.connect(path)
+    try:
+        scans = set()
+        for sql in statements:
+            keyword = sql.split(None, 1)[0].upper()
+            # Служебные запросы FTS5 к своим таблицам ('main'.'messages_fts_...')
+            if keyword in ('BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA') or "'main'." in sql:
+                continue
+            scans.update(table_scans(conn, sql))
+    finally:
+        conn.close()
+    
+    assert scans == set(expected), f"{method}: полный проход по таблице {sorted(scans - set(expected))}"
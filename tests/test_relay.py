@@ -0,0 +1,130 @@
+import asyncio
+import datetime
+import pytest
+from aiogram.types import (Message, Chat, User, PhotoSize, Video, Animation, Audio, Document, Voice,
+                           Sticker, VideoNote, Location, Venue, Contact, Poll, PollOption, Dice,
+                           MessageEntity)
+from relay import MediaGroupBuffer, relay_message, relay_header, CAPTION_TYPES
+from sessions import RelayContext
+
+class FakeBot:
+    """Bot, который записывает вызовы API; send_media_group отвечает с задержкой"""
+    
+    def __init__(self, media_group_delay: float = 0.0):
+        self.calls = []
+        self.media_group_delay = media_group_delay
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(('send_message', chat_id, text, kwargs))
+    
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        self.calls.append(('copy_message', chat_id, message_id, kwargs))
+    
+    async def send_media_group(self, chat_id, media, **kwargs):
+        await asyncio.sleep(self.media_group_delay)
+        self.calls.append(('send_media_group', chat_id, media, kwargs))
+
+def make_message(message_id: int = 1, **fields) -> Message:
+    return Message(
+        message_id=message_id,
+        date=datetime.datetime.now(),
+        chat=Chat(id=10, type='private'),
+        from_user=User(id=10, is_bot=False, first_name='Test'),
+        **fields,
+    )
+
+def photo(file_id: str) -> list:
+    return [PhotoSize(file_id=file_id, file_unique_id=file_id, width=90, height=90)]
+
+def test_message_after_album_waits_for_its_send():
+    """Сообщение после альбома уходит только после send_media_group"""
+    async def run():
+        bot = FakeBot(media_group_delay=0.05)
+        albums = MediaGroupBuffer(bot, delay=0.01)
+        for n in (1, 2):
+            await albums.add(10, 20, make_message(n, photo=photo(f'p{n}'), media_group_id='g'), 'Кот')
+        # Таймер альбома уже забрал его и отправляет
+        await asyncio.sleep(0.02)
+        await albums.flush(10)
+        await relay_message(bot, 20, make_message(3, text='после альбома'), 'Кот')
+        return [call[0] for call in bot.calls]
+    
+    assert asyncio.run(run()) == ['send_media_group', 'send_message']
+
+# Тип -> (поля сообщения, file_id вложения)
+CONTENT = {
+    'photo': ({'photo': photo('photo1'), 'caption': 'фото'}, 'photo1'),
+    'video': ({'video': Video(file_id='video1', file_unique_id='v', width=1, height=1, duration=1)}, 'video1'),
+    'animation': ({'animation': Animation(file_id='gif1', file_unique_id='g', width=1, height=1, duration=1),
+                   'document': Document(file_id='gif1', file_unique_id='g')}, 'gif1'),
+    'audio': ({'audio': Audio(file_id='audio1', file_unique_id='a', duration=1), 'caption': 'песня'}, 'audio1'),
+    'document': ({'document': Document(file_id='doc1', file_unique_id='d')}, 'doc1'),
+    'voice': ({'voice': Voice(file_id='voice1', file_unique_id='vo', duration=1)}, 'voice1'),
+    'sticker': ({'sticker': Sticker(file_id='sticker1', file_unique_id='s', type='regular', width=1, height=1,
+                                    is_animated=False, is_video=False)}, 'sticker1'),
+    'video_note': ({'video_note': VideoNote(file_id='note1', file_unique_id='n', length=1, duration=1)}, 'note1'),
+    'location': ({'location': Location(latitude=57.15, longitude=65.53)}, None),
+    'venue': ({'venue': Venue(location=Location(latitude=57.15, longitude=65.53), title='Мост', address='Тюмень'),
+               'location': Location(latitude=57.15, longitude=65.53)}, None),
+    'contact': ({'contact': Contact(phone_number='+70000000000', first_name='Иван')}, None),
+    'poll': ({'poll': Poll(id='1', question='?', options=[PollOption(text='да', voter_count=0)],
+                           total_voter_count=0, is_closed=False, is_anonymous=True, type='regular',
+                           allows_multiple_answers=False)}, None),
+    'dice': ({'dice': Dice(emoji='🎲', value=3)}, None),
+}
+
+@pytest.mark.parametrize('content_type', CONTENT)
+def test_every_content_type_is_one_copy(content_type):
+    """Любое вложение пересылается одним copy_message, подпись - только где она допустима"""
+    fields, file_id = CONTENT[content_type]
+    message = make_message(5, **fields)
+    assert message.content_type == content_type
+    bot = FakeBot()
+    saved = asyncio.run(relay_message(bot, 20, message, 'Кот'))
+    
+    assert saved == (message.caption, content_type, file_id)
+    assert len(bot.calls) == 1
+    method, chat_id, message_id, kwargs = bot.calls[0]
+    assert (method, chat_id, message_id) == ('copy_message', 20, 5)
+    if content_type in CAPTION_TYPES:
+        expected = f"<b>Кот:</b> {message.caption}" if message.caption else "<b>Кот:</b>"
+        assert kwargs == {'caption': expected}
+    else:
+        assert kwargs == {}
+
+def test_text_keeps_formatting():
+    message = make_message(text='жирный текст', entities=[MessageEntity(type='bold', offset=0, length=6)])
+    bot = FakeBot()
+    saved = asyncio.run(relay_message(bot, 20, message, 'Кот'))
+    assert saved == ('жирный текст', 'text', None)
+    assert bot.calls == [('send_message', 20, '<b>Кот:</b> <b>жирный</b> текст', {})]
+
+@pytest.mark.parametrize('anon, expected', [(True, 'Кот'), (False, 'Test (@test)')])
+def test_sender_follows_anon_mode(anon, expected):
+    relay = RelayContext(20, 'c1', 'Кот', anon, 'Пес')
+    from_user = User(id=10, is_bot=False, first_name='Test', username='test')
+    assert relay.sender_name(from_user) == expected
+
+def test_sender_is_escaped():
+    """Ник с символами разметки не ломает HTML-заголовок"""
+    message = make_message(text='привет')
+    assert relay_header('<3 Кот & Co', message) == '<b>&lt;3 Кот &amp; Co:</b> привет'
+
+def test_album_is_one_media_group():
+    async def run():
+        bot = FakeBot()
+        albums = MediaGroupBuffer(bot, delay=60)
+        saved = [
+            await albums.add(10, 20, make_message(1, photo=photo('p1'), media_group_id='g'), 'Кот'),
+            await albums.add(10, 20, make_message(2, photo=photo('p2'), media_group_id='g', caption='два'), 'Кот'),
+            await albums.add(10, 20, make_message(3, photo=photo('p3'), media_group_id='g'), 'Кот'),
+        ]
+        await albums.flush(10)
+        return saved, bot.calls
+    
+    saved, calls = asyncio.run(run())
+    assert saved == [(None, 'photo', 'p1'), ('два', 'photo', 'p2'), (None, 'photo', 'p3')]
+    assert len(calls) == 1 and calls[0][0] == 'send_media_group'
+    media = calls[0][2]
+    assert [item.media for item in media] == ['p1', 'p2', 'p3']
+    assert [item.caption for item in media] == ['<b>Кот:</b>', '<b>Кот:</b> два', None]
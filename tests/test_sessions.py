@@ -0,0 +1,57 @@
+from sessions import RelayContext, RelayCache
+
+def relay(partner: int, chat_uuid: str, nickname: str, partner_nick: str) -> RelayContext:
+    return RelayContext(partner, chat_uuid, nickname, True, partner_nick)
+
+def test_relay_cache_is_per_chat():
+    relays = RelayCache()
+    relays.put(1, relay(2, 'c1', 'a', 'b'))
+    assert relays.get(1, 'c1').nickname == 'a'
+    # Новый чат того же пользователя не получает старый контекст
+    assert relays.get(1, 'c2') is None
+
+def test_profile_change_drops_partner_context():
+    """Смена ника сбрасывает и контекст собеседника, где этот ник записан"""
+    relays = RelayCache()
+    relays.put(1, relay(2, 'c1', 'a', 'b'))
+    relays.put(2, relay(1, 'c1', 'b', 'a'))
+    relays.put(3, relay(4, 'c2', 'c', 'd'))
+    relays.invalidate(1)
+    assert relays.get(1, 'c1') is None
+    assert relays.get(2, 'c1') is None
+    assert relays.get(3, 'c2') is not None
+    
+    # Контекст только у собеседника: сбрасывается по его ссылке
+    relays.put(2, relay(1, 'c1', 'b', 'a'))
+    relays.invalidate(1)
+    assert len(relays) == 1
+
+def test_profile_change_in_other_process_drops_context(tmp_path):
+    """Ник и анонимность, измененные другим процессом, сбрасывают контексты после sync_profiles"""
+    from database import Database
+    path = str(tmp_path / 'shared.db')
+    db1, db2 = Database(path, message_batch_size=1), Database(path, message_batch_size=1)
+    try:
+        db1.add_user(1, 'a')
+        db1.add_user(2, 'b')
+        relays = RelayCache()
+        db1.profiles.listeners.append(relays.invalidate)
+        assert db1.get_user(1)['nickname'] == 'a'
+        relays.put(1, relay(2, 'c1', 'a', 'b'))
+        relays.put(2, relay(1, 'c1', 'b', 'a'))
+        assert db1.sync_profiles() == 0
+        
+        db2.update_nickname(1, 'new')
+        assert relays.get(2, 'c1') is not None
+        assert db1.sync_profiles() == 1
+        assert relays.get(1, 'c1') is None and relays.get(2, 'c1') is None
+        assert db1.get_user(1)['nickname'] == 'new'
+        
+        relays.put(2, relay(1, 'c1', 'b', 'new'))
+        db2.toggle_anon_mode(1)
+        assert db1.sync_profiles() == 1
+        assert relays.get(2, 'c1') is None
+        assert not db1.get_user(1)['anon_mode']
+    finally:
+        db1.close()
+        db2.close()
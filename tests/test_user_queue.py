@@ -0,0 +1,75 @@
+import asyncio
+import datetime
+from aiogram import Bot, Dispatcher
+from aiogram.filters import Command, StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.types import Update, Message, Chat, User
+from user_queue import UserQueueMiddleware
+
+class S(StatesGroup):
+    nick = State()
+
+def message_update(update_id: int, text: str) -> Update:
+    user = User(id=42, is_bot=False, first_name='Test')
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id,
+        date=datetime.datetime.now(),
+        chat=Chat(id=42, type='private'),
+        from_user=user,
+        text=text,
+    ))
+
+def test_state_is_loaded_after_previous_update():
+    """Второй апдейт пользователя видит состояние, выставленное первым"""
+    seen = []
+    dp = Dispatcher()
+    UserQueueMiddleware().setup(dp)
+    
+    @dp.message(Command('nick'))
+    async def change_nick(message: Message, state: FSMContext):
+        await asyncio.sleep(0.05)
+        await state.set_state(S.nick)
+    
+    @dp.message(StateFilter(S.nick))
+    async def new_nick(message: Message, raw_state: str):
+        seen.append(raw_state)
+    
+    @dp.message()
+    async def other(message: Message, raw_state: str):
+        seen.append(raw_state)
+    
+    async def run():
+        bot = Bot('123456:TEST')
+        await asyncio.gather(
+            dp.feed_update(bot, message_update(1, '/nick')),
+            dp.feed_update(bot, message_update(2, 'Кот')),
+        )
+    
+    asyncio.run(run())
+    assert seen == [S.nick.state]
+
+def test_updates_over_limit_wait_instead_of_dropping():
+    """Апдейты сверх max_pending обрабатываются по порядку, предупреждение - одно"""
+    seen = []
+    notices = []
+    dp = Dispatcher()
+    UserQueueMiddleware(max_pending=2).setup(dp)
+    
+    @dp.message()
+    async def relay(message: Message):
+        await asyncio.sleep(0.01)
+        seen.append(message.text)
+    
+    async def run():
+        bot = Bot('123456:TEST')
+        
+        async def send_message(chat_id, text, **kwargs):
+            notices.append(chat_id)
+        
+        bot.send_message = send_message
+        await asyncio.gather(*(dp.feed_update(bot, message_update(n, str(n))) for n in range(1, 7)))
+    
+    asyncio.run(run())
+    assert seen == ['1', '2', '3', '4', '5', '6']
+    assert notices == [42]
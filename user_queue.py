@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from collections import deque
+from aiogram import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Сколько апдейтов обрабатывается одновременно
+UPDATE_CONCURRENCY = 64
+# Сколько апдейтов одного пользователя может ждать очереди, прежде чем
+# ему придет предупреждение (апдейты сверх лимита не отбрасываются)
+MAX_PENDING_PER_USER = 20
+THROTTLE_NOTICE = "⏳ Вы отправляете сообщения слишком быстро, они будут доставлены с задержкой"
+
+class UserQueueMiddleware(BaseMiddleware):
+    """Упорядочивает обработку апдейтов по пользователям.
+    
+    Апдейты одного пользователя обрабатываются строго по очереди (в
+    порядке поступления), разных пользователей - параллельно, но не
+    больше concurrency одновременно. Если у пользователя скопилось
+    больше max_pending необработанных апдейтов, новые все равно ждут
+    своей очереди, а пользователь один раз получает предупреждение.
+    Подключается через setup(dp).
+    """
+    
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY, max_pending: int = MAX_PENDING_PER_USER):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self._slots = asyncio.Semaphore(concurrency)
+        self._queues = {}       # user_id -> deque(future завершения апдейта)
+        self._warned = set()    # кому уже отправлено предупреждение
+        self.active = 0
+        self.processed = 0
+        self.throttled = 0
+        self.max_depth = 0
+    
+    def setup(self, dp):
+        """Регистрирует middleware на dp.update раньше FSMContextMiddleware.
+        
+        Состояние FSM (raw_state) читается в dp.fsm, поэтому оно должно
+        загружаться уже после ожидания предыдущих апдейтов пользователя,
+        иначе фильтры состояний увидят состояние до их обработки.
+        """
+        middlewares = dp.update.outer_middleware
+        middlewares.unregister(dp.fsm)
+        middlewares.register(self)
+        middlewares.register(dp.fsm)
+    
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None:
+            return await self._run(handler, event, data)
+        
+        queue = self._queues.get(user.id)
+        if queue is None:
+            queue = self._queues[user.id] = deque()
+        # Апдейт сверх лимита не отбрасывается, а ждет, как и остальные
+        warn = False
+        if len(queue) >= self.max_pending:
+            self.throttled += 1
+            if user.id not in self._warned:
+                self._warned.add(user.id)
+                logger.warning(f"Throttling updates from {user.id}: {len(queue)} pending")
+                warn = True
+        
+        previous = queue[-1] if queue else None
+        done = asyncio.get_running_loop().create_future()
+        queue.append(done)
+        self.max_depth = max(self.max_depth, len(queue))
+        try:
+            if warn:
+                # Уже после постановки в очередь, чтобы не нарушить порядок
+                await self._notify(data.get('bot'), user.id)
+            if previous is not None:
+                # shield: отмена этого апдейта не должна отменять ожидание чужого
+                await asyncio.shield(previous)
+            return await self._run(handler, event, data)
+        finally:
+            # Следующий апдейт пользователя стартует только после предыдущего,
+            # даже если этот был отменен, не дождавшись своей очереди
+            if previous is not None and not previous.done():
+                previous.add_done_callback(lambda _: done.set_result(None))
+            else:
+                done.set_result(None)
+            queue.remove(done)
+            if not queue and self._queues.get(user.id) is queue:
+                del self._queues[user.id]
+                self._warned.discard(user.id)
+    
+    async def _notify(self, bot, user_id: int):
+        if bot is None:
+            return
+        try:
+            await bot.send_message(user_id, THROTTLE_NOTICE)
+        except Exception as e:
+            logger.error(f"Error sending throttle notice to {user_id}: {e}")
+    
+    async def _run(self, handler, event, data):
+        async with self._slots:
+            self.active += 1
+            try:
+                return await handler(event, data)
+            finally:
+                self.active -= 1
+                self.processed += 1
+    
+    def stats(self) -> dict:
+        pending = sum(len(queue) for queue in self._queues.values())
+        return {
+            'users': len(self._queues),
+            'pending': pending,
+            'active': self.active,
+            'max_depth': self.max_depth,
+            'processed': self.processed,
+            'throttled': self.throttled,
+        }
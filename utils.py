@@ -9,10 +9,6 @@ logger = logging.getLogger(__name__)
 # Глобальные переменные (будут установлены из bot.py)
 bot = None
 chat_messages = {}
-waiting_users = []
-active_chats = {}
-active_chat_ids = {}
-search_mode = {}
 bot_stats = {
     "total_messages": 0,
     "total_messages_today": 0,
@@ -91,60 +87,3 @@ async def send_temp_message(user_id: int, text: str, reply_markup=None, delete_a
         asyncio.create_task(delete_message_after(user_id, msg.message_id, delete_after))
     
     return msg
-
-async def cleanup_invalid_chats(db):
-    """Очищает невалидные чаты"""
-    global bot_stats, waiting_users, active_chats, active_chat_ids
-    
-    to_remove = []
-    for user_id, partner_id in list(active_chats.items()):
-        if partner_id not in active_chats or active_chats.get(partner_id) != user_id:
-            to_remove.append(user_id)
-    
-    for user_id in to_remove:
-        if user_id in active_chats:
-            logger.info(f"Cleaning up invalid chat for user {user_id}")
-            # Завершаем чат в БД
-            if user_id in active_chat_ids:
-                db.end_chat(active_chat_ids[user_id])
-                del active_chat_ids[user_id]
-            
-            db.update_online_status(user_id, False)
-            del active_chats[user_id]
-    
-    bot_stats["active_chats"] = len(active_chats) // 2
-    bot_stats["online_users"] = len(set(active_chats.keys()) | set(waiting_users))
-
-async def force_cleanup_user(user_id: int, db):
-    """Принудительно очищает пользователя из всех очередей и чатов"""
-    global bot_stats, waiting_users, active_chats, active_chat_ids, search_mode
-    
-    # Обновляем онлайн статус
-    was_online = user_id in waiting_users or user_id in active_chats
-    if was_online:
-        db.update_online_status(user_id, False)
-    
-    if user_id in waiting_users:
-        waiting_users.remove(user_id)
-    
-    if user_id in active_chats:
-        partner_id = active_chats.get(user_id)
-        if partner_id in active_chats:
-            # Завершаем чат в БД
-            if partner_id in active_chat_ids:
-                db.end_chat(active_chat_ids[partner_id])
-                del active_chat_ids[partner_id]
-            db.update_online_status(partner_id, False)
-            del active_chats[partner_id]
-        
-        if user_id in active_chat_ids:
-            db.end_chat(active_chat_ids[user_id])
-            del active_chat_ids[user_id]
-        
-        del active_chats[user_id]
-    
-    if user_id in search_mode:
-        del search_mode[user_id]
-    
-    bot_stats["active_chats"] = len(active_chats) // 2
-    bot_stats["online_users"] = len(set(active_chats.keys()) | set(waiting_users))
\ No newline at end of file
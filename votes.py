@@ -0,0 +1,67 @@
+# Оценки собеседников пишутся в журнал votes: одна оценка на
+# (чат, кто оценил, кого оценил), повторные нажатия ничего не меняют.
+# Рейтинги пересчитываются пачкой - aggregate() применяет все еще не
+# учтенные оценки одной транзакцией и там же проверяет автобан.
+import json
+from collections import Counter
+
+# Автобан: не меньше AUTO_BAN_DISLIKES дизлайков при рейтинге ниже AUTO_BAN_RATING
+AUTO_BAN_DISLIKES = 30
+AUTO_BAN_RATING = 50
+AUTO_BAN_REASON = 'Автоматический бан (30+ дизлайков)'
+
+# Как часто применять накопленные оценки (сек)
+VOTE_FLUSH_INTERVAL = 2
+
+def record(cursor, chat_id: int, voter_id: int, target_id: int, is_like: bool) -> bool:
+    """Записывает оценку, если ее еще не было и оба участвовали в этом чате"""
+    cursor.execute('''
+        INSERT INTO votes (chat_id, voter, target, is_like)
+        SELECT :chat, :voter, :target, :like
+        WHERE EXISTS (
+            SELECT 1 FROM chats WHERE id = :chat AND (
+                (user1_id = :voter AND user2_id = :target) OR
+                (user1_id = :target AND user2_id = :voter)
+            )
+        )
+        ON CONFLICT (chat_id, voter, target) DO NOTHING
+    ''', {'chat': chat_id, 'voter': voter_id, 'target': target_id, 'like': int(is_like)})
+    return cursor.rowcount == 1
+
+def aggregate(cursor):
+    """Применяет неучтенные оценки к ratings.
+    
+    Возвращает (id пользователей с изменившимся рейтингом, id новых автобанов).
+    Оценки помечаются учтенными тем же UPDATE, которым выбираются, поэтому
+    оценка, записанная параллельно, попадет в следующий проход.
+    """
+    cursor.execute('''
+        UPDATE votes SET applied = 1 WHERE applied = 0
+        RETURNING target, is_like
+    ''')
+    likes = Counter()
+    dislikes = Counter()
+    for target, is_like in cursor.fetchall():
+        (likes if is_like else dislikes)[target] += 1
+    touched = list(likes.keys() | dislikes.keys())
+    if not touched:
+        return [], []
+    
+    # В SET справа старые значения, поэтому рейтинг считается с учетом прибавки
+    cursor.executemany('''
+        UPDATE ratings SET
+            likes = likes + :likes,
+            dislikes = dislikes + :dislikes,
+            rating = (likes + :likes) * 100.0 / (likes + dislikes + :likes + :dislikes)
+        WHERE user_id = :uid
+    ''', [{'uid': uid, 'likes': likes[uid], 'dislikes': dislikes[uid]} for uid in touched])
+    
+    cursor.execute('''
+        UPDATE ratings SET banned = 1, ban_date = CURRENT_TIMESTAMP, ban_reason = :reason
+        WHERE user_id IN (SELECT value FROM json_each(:ids))
+            AND banned = 0 AND dislikes >= :dislikes AND rating < :rating
+        RETURNING user_id
+    ''', {'ids': json.dumps(touched), 'reason': AUTO_BAN_REASON,
+          'dislikes': AUTO_BAN_DISLIKES, 'rating': AUTO_BAN_RATING})
+    banned = [row[0] for row in cursor.fetchall()]
+    return touched, banned
@@ -0,0 +1,59 @@
+import asyncio
+import signal
+import logging
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать обработки принятых апдейтов при остановке (сек)
+SHUTDOWN_TIMEOUT = 30
+
+class GracefulRequestHandler(SimpleRequestHandler):
+    """Webhook-обработчик: Telegram получает ответ сразу, апдейты
+    обрабатываются в фоне (порядок и лимиты - в UserQueueMiddleware).
+    При остановке дожидается уже принятых апдейтов.
+    """
+    
+    def __init__(self, dispatcher, bot, secret_token: str = None, **data):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+    
+    async def close(self):
+        """Дожидается принятых апдейтов и закрывает сессию бота"""
+        pending = set(self._background_feed_update_tasks)
+        if pending:
+            logger.info(f"Waiting for {len(pending)} updates before shutdown")
+            await asyncio.wait(pending, timeout=SHUTDOWN_TIMEOUT)
+        await super().close()
+
+async def run_webhook(dp, bot, url: str, path: str = "/webhook", secret: str = None,
+                      host: str = "0.0.0.0", port: int = 8080):
+    """Запускает aiohttp-сервер и регистрирует webhook в Telegram.
+    
+    Работает до SIGINT/SIGTERM. Webhook при остановке не удаляется:
+    Telegram копит апдейты, пока бот перезапускается.
+    """
+    app = web.Application()
+    GracefulRequestHandler(dp, bot, secret_token=secret).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    try:
+        await bot.set_webhook(
+            url.rstrip("/") + path,
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"Webhook listening on {host}:{port}{path}")
+        await stop.wait()
+    finally:
+        # on_shutdown: дожидаемся апдейтов, затем закрываем сессию и FSM
+        await runner.cleanup()